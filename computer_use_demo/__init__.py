@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The modules of the app import each other relative to this directory, as Streamlit runs
+# streamlit.py from it. This makes them importable when the package is used from outside,
+# e.g. with python -m computer_use_demo.batch. Appended, so streamlit.py doesn't shadow
+# the streamlit package.
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+if _APP_DIR not in sys.path:
+    sys.path.append(_APP_DIR)
@@ -2,29 +2,31 @@
 Agentic sampling loop that calls the Anthropic API and local implementation of anthropic-defined computer use tools.
 """
 
+import asyncio
+import json
+import os
 import platform
+import time
+import weakref
 from collections.abc import Callable
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import StrEnum
 from typing import Any, cast
-import time
-import jsonpickle
-import json
-from anthropic._legacy_response import LegacyAPIResponse
-import dill
-from computer_use_demo.models.sender import Sender
-from computer_use_demo.models.data_handler import ReportDataHandler
 
-import anthropic.types.beta_rate_limit_error as beta_rate_limit_error
+import dill
 import httpx
+import jsonpickle
 from anthropic import (
-    Anthropic,
-    AnthropicBedrock,
-    AnthropicVertex,
     APIError,
     APIResponseValidationError,
     APIStatusError,
+    AsyncAnthropic,
+    AsyncAnthropicBedrock,
+    AsyncAnthropicVertex,
+    DefaultAsyncHttpxClient,
 )
+from anthropic._legacy_response import LegacyAPIResponse
 from anthropic.types.beta import (
     BetaCacheControlEphemeralParam,
     BetaContentBlockParam,
@@ -36,8 +38,27 @@ from anthropic.types.beta import (
     BetaToolResultBlockParam,
     BetaToolUseBlockParam,
 )
-
 from tools import BashTool, ComputerTool, EditTool, ToolCollection, ToolResult
+from tools.ant import generate_unique_id
+
+from computer_use_demo.models.http_pool import pool_limits
+from computer_use_demo.models.image_index import ImageIndex
+from computer_use_demo.models.image_prep import (
+    DEFAULT_PROFILE,
+    ImageConsumer,
+    PreparedImage,
+)
+from computer_use_demo.models.instruction_compiler import CompiledInstruction
+from computer_use_demo.models.metering import Meter, anthropic_usage
+from computer_use_demo.models.rate_limiter import (
+    IMAGE_TOKENS,
+    count_content,
+    estimate_tokens,
+    rate_limiter,
+)
+from computer_use_demo.models.retry import retry_policy
+from computer_use_demo.models.screenshot_store import screenshot_store
+from computer_use_demo.models.sender import Sender
 
 COMPUTER_USE_BETA_FLAG = "computer-use-2024-10-22"
 PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
@@ -60,16 +81,33 @@ PROVIDER_TO_DEFAULT_MODEL_NAME: dict[APIProvider, str] = {
 }
 
 
+@dataclass
+class ExecutorSettings:
+    """Settings of the Anthropic computer use requests."""
+
+    model: str
+    provider: APIProvider
+    api_key: str
+    system_prompt_suffix: str = ""
+    only_n_most_recent_images: int | None = None
+    # seconds to wait after the tools of a step ran. The tools already wait for the screen
+    # to settle, STEP_DELAY only slows the agent down, e.g. for recordings.
+    step_delay: float = field(
+        default_factory=lambda: float(os.getenv("STEP_DELAY", "0"))
+    )
+
+
 # This system prompt is optimized for the Docker environment in this repository and
 # specific tool combinations enabled.
 # We encourage modifying this system prompt to ensure the model has context for the
 # environment it is running in, and to provide any additional information that may be
 # helpful for the task at hand.
+# {display_num} is filled in with the display of the session, see system_prompt.
 SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 * You are utilising an Ubuntu virtual machine using {platform.machine()} architecture with internet access.
 * You can feel free to install Ubuntu applications with your bash tool. Use curl instead of wget.
 * To open firefox, please just click on the firefox icon.  Note, firefox-esr is what is installed on your system.
-* Using bash tool you can start GUI applications, but you need to set export DISPLAY=:1 and use a subshell. For example "(DISPLAY=:1 xterm &)". GUI apps run with bash tool will appear within your desktop environment, but they may take some time to appear. Take a screenshot to confirm it did.
+* Using bash tool you can start GUI applications, but you need to set export DISPLAY=:{{display_num}} and use a subshell. For example "(DISPLAY=:{{display_num}} xterm &)". GUI apps run with bash tool will appear within your desktop environment, but they may take some time to appear. Take a screenshot to confirm it did.
 * When using your bash tool with commands that are expected to output very large quantities of text, redirect into a tmp file and use str_replace_editor or `grep -n -B <lines before> -A <lines after> <query> <filename>` to confirm output.
 * When viewing a page it can be helpful to zoom out so that you can see everything on the page.  Either that, or make sure you scroll down to see everything before deciding something isn't available.
 * When using your computer function calls, they take a while to run and send back to you.  Where possible/feasible, try to chain multiple of these calls all into one function calls request.
@@ -88,182 +126,371 @@ SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 </YOUR_TASK>"""
 
 
-async def sampling_loop(
-    *,
-    model: str,
-    provider: APIProvider,
-    system_prompt_suffix: str,
-    messages: list[BetaMessageParam],
-    prepped_messages: list[BetaMessageParam],
-    output_callback: Callable[[BetaContentBlockParam], None],
-    tool_output_callback: Callable[[ToolResult, str], None],
-    api_response_callback: Callable[
-        [httpx.Request, httpx.Response | object | None, Exception | None], None
-    ],
-    api_key: str,
-    only_n_most_recent_images: int | None = None,
-    max_tokens: int = 4096,
-):
-    """
-    Agentic sampling loop for the assistant/tool interaction of computer use.
-    """
-    tool_collection = ToolCollection(
-        ComputerTool(),
+# Function will return the system prompt for the display that the computer tool of the
+# session controls. Without a display number the tools use the default display :1.
+def system_prompt(tool_collection: ToolCollection) -> str:
+    display_num = getattr(tool_collection.tool_map.get("computer"), "display_num", None)
+    return SYSTEM_PROMPT.format(display_num=1 if display_num is None else display_num)
+
+
+def make_tool_collection(display_num: int | None = None) -> ToolCollection:
+    return ToolCollection(
+        ComputerTool(display_num),
         BashTool(),
         EditTool(),
     )
-    system = BetaTextBlockParam(
-        type="text",
-        text=f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}",
-    )
-    i = 1
-    # while True:
-
-    enable_prompt_caching = False
-    betas = [COMPUTER_USE_BETA_FLAG]
-    image_truncation_threshold = 10
-    if provider == APIProvider.ANTHROPIC:
-        client = Anthropic(api_key=api_key)
-        enable_prompt_caching = True
-    elif provider == APIProvider.VERTEX:
-        client = AnthropicVertex()
-    elif provider == APIProvider.BEDROCK:
-        client = AnthropicBedrock()
-
-    if enable_prompt_caching:
-        betas.append(PROMPT_CACHING_BETA_FLAG)
-        _inject_prompt_caching(messages)
-        _inject_prompt_caching(prepped_messages)
-        # Is it ever worth it to bust the cache with prompt caching?
-        image_truncation_threshold = 50
-        system["cache_control"] = {"type": "ephemeral"}
-
-    if only_n_most_recent_images:
-        _maybe_filter_to_n_most_recent_images(
-            messages,
-            only_n_most_recent_images,
-            min_removal_threshold=image_truncation_threshold,
+
+
+AnthropicClient = AsyncAnthropic | AsyncAnthropicVertex | AsyncAnthropicBedrock
+
+
+class AnthropicExecutor:
+    """
+    Long-lived executor for the computer use requests. It holds one async client per
+    provider for every event loop, so TLS connections and keep-alive are reused from step
+    to step, and marks the requests that needed a new connection.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self.transport = transport  # e.g. a mock transport in the benchmarks
+        # event loop -> (provider, api key) -> client. Streamlit runs every rerun in a
+        # new event loop, the clients of finished loops are dropped with them.
+        self._clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop,
+            dict[tuple[APIProvider, str], AnthropicClient],
+        ] = weakref.WeakKeyDictionary()
+
+    def client(self, provider: APIProvider, api_key: str) -> AnthropicClient:
+        clients = self._clients.setdefault(asyncio.get_running_loop(), {})
+        if (provider, api_key) not in clients:
+            http_client = DefaultAsyncHttpxClient(
+                limits=pool_limits("ANTHROPIC"),
+                transport=self.transport,
+                event_hooks={"request": [self._trace_connections]},
+            )
+            # retried by the retry policy
+            if provider == APIProvider.ANTHROPIC:
+                client = AsyncAnthropic(
+                    api_key=api_key, http_client=http_client, max_retries=0
+                )
+            elif provider == APIProvider.VERTEX:
+                client = AsyncAnthropicVertex(http_client=http_client, max_retries=0)
+            elif provider == APIProvider.BEDROCK:
+                client = AsyncAnthropicBedrock(http_client=http_client, max_retries=0)
+            clients[(provider, api_key)] = client
+        return clients[(provider, api_key)]
+
+    # Function will mark the request if it opens a new connection, the mark is metered
+    # with the usage of the request and counted per session
+    async def _trace_connections(self, request: httpx.Request):
+        async def trace(event_name: str, info: dict):
+            # only sent when the pool has no idle connection to the host
+            if event_name == "connection.connect_tcp.complete":
+                request.extensions["new_connection"] = True
+
+        request.extensions["trace"] = trace
+
+    async def sampling_loop(
+        self,
+        *,
+        model: str,
+        provider: APIProvider,
+        system_prompt_suffix: str,
+        messages: list[BetaMessageParam],
+        prepped_messages: list[BetaMessageParam],
+        output_callback: Callable[[BetaContentBlockParam], None],
+        tool_output_callback: Callable[[ToolResult, str], None],
+        api_response_callback: Callable[
+            [httpx.Request, httpx.Response | object | None, Exception | None], None
+        ],
+        api_key: str,
+        tool_collection: ToolCollection,
+        only_n_most_recent_images: int | None = None,
+        max_tokens: int = 4096,
+        step_delay: float = 0.0,
+        meter: Meter | None = None,
+        image_index: ImageIndex | None = None,
+    ):
+        """
+        Agentic sampling loop for the assistant/tool interaction of computer use.
+        """
+        response_params = await self.request_action(
+            model=model,
+            provider=provider,
+            system_prompt_suffix=system_prompt_suffix,
+            prepped_messages=prepped_messages,
+            api_response_callback=api_response_callback,
+            api_key=api_key,
+            tool_collection=tool_collection,
+            only_n_most_recent_images=only_n_most_recent_images,
+            max_tokens=max_tokens,
+            meter=meter,
         )
-        _maybe_filter_to_n_most_recent_images(
-            prepped_messages,
-            only_n_most_recent_images,
-            min_removal_threshold=image_truncation_threshold,
+        return await self.execute_action(
+            response_params=response_params,
+            provider=provider,
+            messages=messages,
+            prepped_messages=prepped_messages,
+            output_callback=output_callback,
+            tool_output_callback=tool_output_callback,
+            tool_collection=tool_collection,
+            only_n_most_recent_images=only_n_most_recent_images,
+            step_delay=step_delay,
+            image_index=image_index,
         )
 
-    # Call the API
-    retries = 0
-    while retries < 100:
-        try:
-            global ANTHROPIC_MOCK_INDEX
-            if mock_anthropic:
-                with open(
-                    f"./computer_use_demo/mock/{ANTHROPIC_MOCK_INDEX%6 + 1}.pkl", "rb"
-                ) as f:
-                    response = dill.load(f)
-                ANTHROPIC_MOCK_INDEX += 1
-            else:
-                response = client.beta.messages.create(
+    async def request_action(
+        self,
+        *,
+        model: str,
+        provider: APIProvider,
+        system_prompt_suffix: str,
+        prepped_messages: list[BetaMessageParam],
+        api_response_callback: Callable[
+            [httpx.Request, httpx.Response | object | None, Exception | None], None
+        ],
+        api_key: str,
+        tool_collection: ToolCollection,
+        only_n_most_recent_images: int | None = None,
+        max_tokens: int = 4096,
+        meter: Meter | None = None,
+        deadline: float | None = None,
+    ) -> list[BetaContentBlockParam] | None:
+        """
+        First half of the sampling loop: asks the model for the tool calls of the
+        instruction. Nothing is executed yet, so the request can be started speculatively
+        and cancelled. Returns None if the request failed. The usage of the request is
+        passed to `meter`, `deadline` is the retry deadline of the step.
+        """
+        # the suffix is set per session, so it comes after the system prompt shared by all
+        system = [BetaTextBlockParam(type="text", text=system_prompt(tool_collection))]
+        if system_prompt_suffix:
+            system.append(BetaTextBlockParam(type="text", text=system_prompt_suffix))
+
+        enable_prompt_caching = provider == APIProvider.ANTHROPIC
+        betas = [COMPUTER_USE_BETA_FLAG]
+        image_truncation_threshold = 10
+        client = self.client(provider, api_key)
+
+        if enable_prompt_caching:
+            betas.append(PROMPT_CACHING_BETA_FLAG)
+            # Is it ever worth it to bust the cache with prompt caching?
+            image_truncation_threshold = 50
+            # tools and system prompt are the cached prefix of every request, shared by all
+            # sessions on the same display, and the suffix is cached for the sessions that use it. The steps are
+            # only sent once, a breakpoint after them would pay for cache writes that are
+            # never read.
+            for block in system:
+                block["cache_control"] = BetaCacheControlEphemeralParam(
+                    type="ephemeral"
+                )
+        messages = list(prepped_messages)
+
+        if only_n_most_recent_images:
+            _maybe_filter_to_n_most_recent_images(
+                messages,
+                only_n_most_recent_images,
+                min_removal_threshold=image_truncation_threshold,
+            )
+
+        async def create_message() -> BetaMessage:
+            # wait for our share of the rate limit, shared with the other sessions
+            queue_wait = await rate_limiter.acquire(
+                provider,
+                model,
+                # the input token limit, unlike OpenAI's, doesn't count max_tokens
+                estimate_tokens([{"content": system}, *messages]),
+            )
+            start = time.perf_counter()
+            try:
+                raw_response = await client.beta.messages.with_raw_response.create(
                     max_tokens=max_tokens,
-                    messages=prepped_messages,
+                    messages=messages,
                     model=model,
-                    system=[system],
+                    system=system,
                     tools=tool_collection.to_params(),
                     betas=betas,
                 )
-                retries = 100
-        except (APIStatusError, APIResponseValidationError) as e:
-            if e.status_code == 429 and retries < 6:
-                time.sleep(60)
-                retries += 1
-            else:
+            except APIStatusError as e:
+                if e.status_code == 429:
+                    # the next acquire waits until the limit resets, in all sessions
+                    await rate_limiter.update_from_headers(
+                        provider, model, e.response.headers
+                    )
+                raise
+            await rate_limiter.update_from_headers(
+                provider, model, raw_response.headers
+            )
+            response = raw_response.parse()
+            if meter:
+                meter(
+                    anthropic_usage(
+                        response.usage,
+                        provider=provider,
+                        model=model,
+                        purpose="executor",
+                        image_tokens=count_content(prepped_messages)[1] * IMAGE_TOKENS,
+                        latency=time.perf_counter() - start,
+                        queue_wait=queue_wait,
+                        new_connection=raw_response.http_response.request.extensions.get(
+                            "new_connection", False
+                        ),
+                    )
+                )
+            return response
+
+        # Call the API
+        global ANTHROPIC_MOCK_INDEX
+        if mock_anthropic:
+            with open(
+                f"./computer_use_demo/mock/{ANTHROPIC_MOCK_INDEX%6 + 1}.pkl", "rb"
+            ) as f:
+                response = dill.load(f)
+            ANTHROPIC_MOCK_INDEX += 1
+        else:
+            try:
+                # transient errors are retried with backoff within the step's deadline
+                response = await retry_policy(provider).run(create_message, deadline)
+            except (APIStatusError, APIResponseValidationError) as e:
                 api_response_callback(e.request, e.response, e)
-                return messages
-        except APIError as e:
-            api_response_callback(e.request, e.body, e)
+                return None
+            except APIError as e:
+                api_response_callback(e.request, e.body, e)
+                return None
+
+        return _response_to_params(response)  # type: ignore
+
+    async def execute_action(
+        self,
+        *,
+        response_params: list[BetaContentBlockParam] | None,
+        provider: APIProvider,
+        messages: list[BetaMessageParam],
+        prepped_messages: list[BetaMessageParam],
+        output_callback: Callable[[BetaContentBlockParam], None],
+        tool_output_callback: Callable[[ToolResult, str], None],
+        tool_collection: ToolCollection,
+        only_n_most_recent_images: int | None = None,
+        step_delay: float = 0.0,
+        image_index: ImageIndex | None = None,
+    ):
+        """
+        Second half of the sampling loop: runs the tool calls the model returned with the
+        session's tools. `image_index` indexes the images of `messages` across the steps
+        of the session.
+        """
+        if provider == APIProvider.ANTHROPIC:
+            _inject_prompt_caching(messages)
+        if only_n_most_recent_images:
+            _maybe_filter_to_n_most_recent_images(
+                messages,
+                only_n_most_recent_images,
+                min_removal_threshold=50 if provider == APIProvider.ANTHROPIC else 10,
+                image_index=image_index,
+            )
+        if response_params is None:
             return messages
 
-    response_params = _response_to_params(response)  # type: ignore
-    messages.append(
-        {
-            "role": Sender.ANTHROPIC,
-            "content": response_params,
-        }
-    )
-    prepped_messages.append(
-        {
-            "role": "assistant",
-            "content": response_params,
-        }
-    )
+        messages.append(
+            {
+                "role": Sender.ANTHROPIC,
+                "content": response_params,
+            }
+        )
+        prepped_messages.append(
+            {
+                "role": "assistant",
+                "content": response_params,
+            }
+        )
 
-    tool_result_content: list[BetaToolResultBlockParam] = []
-    for content_block in response_params:
-        output_callback(content_block)
-        if content_block["type"] == "tool_use":
-            result = await tool_collection.run(
-                name=content_block["name"],
-                tool_input=cast(dict[str, Any], content_block["input"]),
-            )
-            tool_result_content.append(
-                _make_api_tool_result(result, content_block["id"])
+        tool_result_content: list[BetaToolResultBlockParam] = []
+        for content_block in response_params:
+            output_callback(content_block)
+            if content_block["type"] == "tool_use":
+                result = await tool_collection.run(
+                    name=content_block["name"],
+                    tool_input=cast(dict[str, Any], content_block["input"]),
+                )
+                tool_result_content.append(
+                    _make_api_tool_result(result, content_block["id"])
+                )
+                tool_output_callback(result, content_block["id"])
+
+        if not tool_result_content:
+            return messages
+
+        messages.append({"content": tool_result_content, "role": "user"})
+        prepped_messages.append({"content": tool_result_content, "role": "user"})
+        if step_delay:
+            await asyncio.sleep(step_delay)
+
+    async def execute_compiled(
+        self,
+        *,
+        compiled: CompiledInstruction,
+        provider: APIProvider,
+        messages: list[BetaMessageParam],
+        output_callback: Callable[[BetaContentBlockParam], None],
+        tool_output_callback: Callable[[ToolResult, str], None],
+        tool_collection: ToolCollection,
+        only_n_most_recent_images: int | None = None,
+        step_delay: float = 0.0,
+        image_index: ImageIndex | None = None,
+    ):
+        """
+        Runs an instruction the instruction compiler mapped onto computer tool actions.
+        The actions are recorded like an answer of the model, so they show up the same way.
+        """
+        if compiled.wait:
+            await asyncio.sleep(compiled.wait)
+        response_params: list[BetaContentBlockParam] = [
+            BetaTextBlockParam(type="text", text=compiled.description)
+        ]
+        for action in compiled.actions:
+            response_params.append(
+                BetaToolUseBlockParam(
+                    type="tool_use",
+                    id=generate_unique_id(),
+                    name="computer",
+                    input=action,
+                )
             )
-            tool_output_callback(result, content_block["id"])
+        return await self.execute_action(
+            response_params=response_params,
+            provider=provider,
+            messages=messages,
+            prepped_messages=[],
+            output_callback=output_callback,
+            tool_output_callback=tool_output_callback,
+            tool_collection=tool_collection,
+            only_n_most_recent_images=only_n_most_recent_images,
+            step_delay=step_delay,
+            image_index=image_index,
+        )
 
-    if not tool_result_content:
-        return messages
 
-    messages.append({"content": tool_result_content, "role": "user"})
-    prepped_messages.append({"content": tool_result_content, "role": "user"})
-    time.sleep(2.5)
+# Shared by all sessions of the process, the tools belong to the sessions
+executor = AnthropicExecutor()
 
 
 def _maybe_filter_to_n_most_recent_images(
     messages: list[BetaMessageParam],
     images_to_keep: int,
     min_removal_threshold: int,
+    image_index: ImageIndex | None = None,
 ):
     """
     With the assumption that images are screenshots that are of diminishing value as
     the conversation progresses, remove all but the final `images_to_keep` tool_result
     images in place, with a chunk of min_removal_threshold to reduce the amount we
-    break the implicit prompt cache.
+    break the implicit prompt cache. A long-lived history passes the index kept
+    alongside it, so only the messages added since the last call are scanned.
     """
     if images_to_keep is None:
         return messages
 
-    tool_result_blocks = cast(
-        list[BetaToolResultBlockParam],
-        [
-            item
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and item.get("type") == "tool_result"
-        ],
-    )
-
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and content.get("type") == "image"
-    )
-
-    images_to_remove = total_images - images_to_keep
-    # for better cache behavior, we want to remove in chunks
-    images_to_remove -= images_to_remove % min_removal_threshold
-
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            new_content = []
-            for content in tool_result.get("content", []):
-                if isinstance(content, dict) and content.get("type") == "image":
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
-                new_content.append(content)
-            tool_result["content"] = new_content
+    (image_index or ImageIndex()).prune(messages, images_to_keep, min_removal_threshold)
 
 
 def _response_to_params(
@@ -320,13 +547,17 @@ def _make_api_tool_result(
                 }
             )
         if result.base64_image:
+            # share the stored copy if this screen was already captured
+            image = screenshot_store.get_prepared(
+                screenshot_store.put(result.base64_image), ImageConsumer.EXECUTOR
+            ) or PreparedImage(result.base64_image, DEFAULT_PROFILE.media_type)
             tool_result_content.append(
                 {
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/png",
-                        "data": result.base64_image,
+                        "media_type": image.media_type,
+                        "data": image.data,
                     },
                 }
             )
@@ -0,0 +1,272 @@
+"""
+Headless batch runner. Runs the tasks of a test plan without the Streamlit UI and writes
+one report per session, so a whole study can be scripted:
+    python -m computer_use_demo.batch plan.yaml
+
+A plan lists sessions, each with the tasks the agent works on one after another:
+
+    output_dir: /home/computeruse/local  # optional
+    sessions:
+      - name: booking
+        tasks:
+          - task: Book a table for two people tomorrow at 7pm
+            done_when: The booking confirmation is shown
+          - task: Cancel the booking again
+            done_when: The booking is no longer listed
+
+A plan with a single session can also list its `tasks` at the top level (its `name` is
+used as the report name). Every session has its own conversation and report. Sessions
+run in parallel on the displays of the pool (DISPLAY_POOL_SIZE, see display_pool.py).
+There is nobody to give feedback, so the agent's own verdict from its final instruction
+(COMPLETED or FAILED with a summary) is recorded as the feedback of each task.
+A session that stops with an error doesn't stop the others. Its report is still written,
+with the error as the feedback of the task it happened in.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path, PosixPath
+
+import httpx
+import yaml
+from anthropic.types.beta import BetaContentBlockParam, BetaTextBlockParam
+
+import computer_use_demo.oai as oai
+from computer_use_demo.anthropic_access import (
+    PROVIDER_TO_DEFAULT_MODEL_NAME,
+    APIProvider,
+    ExecutorSettings,
+)
+from computer_use_demo.models.data_handler import ReportDataHandler
+from computer_use_demo.models.display_pool import DisplayPool, DisplaySlot
+from computer_use_demo.models.sender import Sender
+from computer_use_demo.openai_loop import custom_loop
+from computer_use_demo.reports import create_report
+from computer_use_demo.session import SessionContext
+from computer_use_demo.tools import ToolResult
+
+logger = logging.getLogger(__name__)
+
+FILE_OUTPUT_DIR = "/home/computeruse/local"
+API_KEY_FILE = PosixPath("~/.anthropic/api_key").expanduser()
+
+
+@dataclass
+class PlannedTask:
+    task: str
+    done_when: str = ""
+
+    @property
+    def mission(self) -> str:
+        # the same text the Streamlit form builds from its two fields
+        return f"{self.task}. {self.done_when}." if self.done_when else f"{self.task}."
+
+
+@dataclass
+class PlannedSession:
+    name: str
+    tasks: list[PlannedTask]
+
+
+def load_plan(path: Path) -> tuple[list[PlannedSession], str]:
+    """Returns the sessions of the plan and the directory the reports are written to."""
+    with open(path) as f:
+        plan = yaml.safe_load(f) or {}
+    raw_sessions = plan.get("sessions") or [
+        {"name": plan.get("name", path.stem), "tasks": plan.get("tasks", [])}
+    ]
+    sessions = []
+    for i, raw_session in enumerate(raw_sessions, 1):
+        tasks = [
+            PlannedTask(task=raw_task)
+            if isinstance(raw_task, str)
+            else PlannedTask(
+                task=raw_task["task"], done_when=raw_task.get("done_when", "")
+            )
+            for raw_task in raw_session.get("tasks", [])
+        ]
+        if not tasks:
+            raise ValueError(f"Session {i} of {path} has no tasks")
+        sessions.append(PlannedSession(raw_session.get("name", f"session-{i}"), tasks))
+    return sessions, plan.get("output_dir", FILE_OUTPUT_DIR)
+
+
+def executor_settings() -> ExecutorSettings:
+    provider = APIProvider(
+        os.getenv("API_PROVIDER", "anthropic") or APIProvider.ANTHROPIC
+    )
+    api_key = os.getenv("ANTHROPIC_API_KEY", "")
+    if not api_key and API_KEY_FILE.exists():
+        api_key = API_KEY_FILE.read_text().strip()
+    return ExecutorSettings(
+        model=os.getenv("ANTHROPIC_MODEL", PROVIDER_TO_DEFAULT_MODEL_NAME[provider]),
+        provider=provider,
+        api_key=api_key,
+        system_prompt_suffix=os.getenv("SYSTEM_PROMPT_SUFFIX", ""),
+        only_n_most_recent_images=int(os.getenv("ONLY_N_MOST_RECENT_IMAGES", "1")),
+    )
+
+
+class ConsoleOutput:
+    """Logs what the Streamlit app would render, prefixed with the session's name."""
+
+    def __init__(self, name: str, data_handler: ReportDataHandler):
+        self.name = name
+        self.data_handler = data_handler
+
+    def log(self, sender: str, text: str):
+        logger.info("[%s] [%s] %s", self.name, sender, text)
+
+    def render_message(
+        self, message: str | BetaContentBlockParam, sender: Sender, container=None
+    ):
+        if isinstance(message, dict):
+            if message["type"] == "text":
+                message = message["text"]
+            else:
+                message = f"Tool Use: {message['name']} {message['input']}"
+        if message:
+            self.log(sender, message)
+
+    def output_callback(self, block: BetaContentBlockParam):
+        self.render_message(block, Sender.ANTHROPIC)
+
+    def tool_output_callback(self, tool_output: ToolResult, tool_id: str):
+        if tool_output.settle_time is not None:
+            self.data_handler.add_settle_time(tool_output.settle_time)
+        if tool_output.output:
+            self.log(Sender.TOOL, tool_output.output)
+        if tool_output.error:
+            self.log(Sender.TOOL, f"error: {tool_output.error}")
+
+    def api_response_callback(
+        self,
+        request: httpx.Request,
+        response: httpx.Response | object | None,
+        error: Exception | None,
+    ):
+        if error:
+            self.log("error", f"{request.method} {request.url}: {error}")
+
+
+# Function will turn the agent's final instruction, e.g. "COMPLETED -> I booked the table",
+# into the feedback the user would have given in the pop-up
+def feedback_from_instruction(instruction: str) -> dict[str, str]:
+    verdict, _, summary = instruction.partition("->")
+    status = "failed" if verdict.strip().lower() == "failed" else "were successful"
+    return {"status": status, "text": f"Reported by the agent: {summary.strip()}"}
+
+
+async def run_session(
+    planned: PlannedSession,
+    settings: ExecutorSettings,
+    output_dir: str,
+    display: DisplaySlot,
+):
+    # every session has its own conversation, report and tools
+    session = SessionContext(display=display)
+    console = ConsoleOutput(planned.name, session.data_handler)
+    console.log("batch", f"runs on display :{display.display_num}")
+    try:
+        for task in planned.tasks:
+            await run_task(session, task, settings, console)
+    except Exception as e:
+        # the report is still written, with the error as the feedback of the task
+        logger.exception("[%s] the session stopped with an error", planned.name)
+        record_failure(session.data_handler, planned.tasks, e)
+
+    try:
+        await oai.generate_sus_answers(session)
+    except Exception:
+        logger.exception("[%s] the SUS answers could not be generated", planned.name)
+    # the SUS answers are already generated, the report doesn't need to ask again.
+    # Writing the PDF takes a while, the other sessions keep running meanwhile.
+    await asyncio.to_thread(create_report, session, output_dir, planned.name)
+
+
+async def run_task(
+    session: SessionContext,
+    task: PlannedTask,
+    settings: ExecutorSettings,
+    console: ConsoleOutput,
+):
+    console.log("batch", f"task: {task.mission}")
+    session.messages.append(
+        {
+            "role": Sender.USER,
+            "content": [BetaTextBlockParam(type="text", text=task.mission)],
+        }
+    )
+    session.data_handler.new_task(task.mission)
+    await custom_loop(
+        session=session,
+        mission=task.mission,
+        settings=settings,
+        context=None,
+        render_message=console.render_message,
+        output_callback=console.output_callback,
+        tool_output_callback=console.tool_output_callback,
+        api_response_callback=console.api_response_callback,
+    )
+    feedback = feedback_from_instruction(session.messages[-1]["content"][0]["text"])
+    message = await oai.give_feedback(session, feedback, console.render_message, None)
+    session.data_handler.new_feedback(feedback)
+    session.messages.append(
+        {"role": Sender.FEEDBACK, "content": [{"type": "text", "text": message}]}
+    )
+    session.data_handler.reset_task_interactions()
+
+
+# Function will record the error as the feedback of the task it happened in, and the tasks
+# after it as not run, so the report still lists every task of the plan
+def record_failure(
+    data_handler: ReportDataHandler, tasks: list[PlannedTask], error: Exception
+):
+    started = data_handler.get_action_data()
+    # a task with feedback was finished, the error happened before the next one started
+    if not started or started[-1]["feedback"]["status"]:
+        if len(started) == len(tasks):
+            return
+        data_handler.new_task(tasks[len(started)].mission)
+    data_handler.new_feedback(
+        {"status": "error", "text": f"The session stopped with an error: {error}"}
+    )
+    data_handler.reset_task_interactions()
+    for task in tasks[len(data_handler.get_action_data()) :]:
+        data_handler.new_task(task.mission)
+        data_handler.new_feedback({"status": "not run", "text": ""})
+        data_handler.reset_task_interactions()
+
+
+async def run_plan(path: Path) -> bool:
+    """Runs the plan and returns whether every session ran without an error."""
+    sessions, output_dir = load_plan(path)
+    settings = executor_settings()
+    pool = DisplayPool.from_env()
+    # as many sessions run at the same time as the pool has displays
+    results = await pool.run(
+        partial(run_session, planned, settings, output_dir) for planned in sessions
+    )
+    ok = True
+    for planned, result in zip(sessions, results, strict=True):
+        if isinstance(result, BaseException):
+            logger.error("[%s] no report was written: %r", planned.name, result)
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("plan", type=Path, help="YAML file with the sessions and tasks")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # the progress of the sessions, without a line per HTTP request
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not asyncio.run(run_plan(args.plan)):
+        raise SystemExit(1)
@@ -0,0 +1,53 @@
+"""
+Compares the screenshot latency of the in-process capture engine with the
+gnome-screenshot/scrot + ImageMagick subprocess path.
+
+Run inside the container (WIDTH, HEIGHT and DISPLAY_NUM must be set):
+    python -m computer_use_demo.benchmarks.capture_latency --iterations 20
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from computer_use_demo.tools.computer import ComputerTool
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(name: str, timings: list[float]):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))]
+    logger.info(
+        f"{name:<12} mean {statistics.mean(timings_ms):8.1f} ms | "
+        f"p50 {statistics.median(timings_ms):8.1f} ms | p95 {p95:8.1f} ms"
+    )
+
+
+async def measure(screenshot, iterations: int) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = await screenshot()
+        timings.append(time.perf_counter() - start)
+        assert result.base64_image, "screenshot returned no image"
+    return timings
+
+
+async def main(iterations: int):
+    tool = ComputerTool()
+    if tool._capture.available:
+        summarize("in-process", await measure(tool.screenshot, iterations))
+    else:
+        logger.warning("in-process capture is not available on this display")
+    summarize("subprocess", await measure(tool.subprocess_screenshot, iterations))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations))
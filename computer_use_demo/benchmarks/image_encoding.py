@@ -0,0 +1,75 @@
+"""
+Reports the bytes per request and the encode time of the planner screenshot for
+every image encoding.
+
+The screenshots are read from a directory of PNG files. By default these are the
+screenshots the subprocess capture path leaves in /tmp/outputs:
+    python -m computer_use_demo.benchmarks.image_encoding --images /tmp/outputs
+"""
+
+import argparse
+import base64
+import logging
+import statistics
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from computer_use_demo.models.image_prep import (
+    EncodingProfile,
+    crop_and_mask,
+    encode_image,
+    parse_encoding_profile,
+)
+from computer_use_demo.tools.computer import OUTPUT_DIR
+
+PROFILES = ["png", "jpeg:90", "jpeg:80", "jpeg:60", "webp:90", "webp:80", "webp:60"]
+
+logger = logging.getLogger(__name__)
+
+
+def measure(images: list[Image.Image], profile: EncodingProfile):
+    sizes = []
+    timings = []
+    for image in images:
+        start = time.perf_counter()
+        data = encode_image(image, profile)
+        timings.append(time.perf_counter() - start)
+        # the image is sent base64 encoded
+        sizes.append(len(base64.b64encode(data)))
+    return statistics.mean(sizes), statistics.mean(timings)
+
+
+def main(image_dir: Path, profiles: list[str]):
+    paths = sorted(image_dir.glob("*.png"))
+    if not paths:
+        raise SystemExit(f"No PNG screenshots found in {image_dir}")
+    images = []
+    for path in paths:
+        with Image.open(path) as image:
+            images.append(crop_and_mask(image.convert("RGB")))
+    logger.info(f"{len(images)} screenshots from {image_dir}")
+
+    baseline = None
+    for spec in profiles:
+        size, encode_time = measure(images, parse_encoding_profile(spec))
+        baseline = baseline or size
+        logger.info(
+            f"{spec:<18} {size / 1024:8.1f} KiB/request ({size / baseline:6.1%}) | "
+            f"encode {encode_time * 1000:7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=Path, default=Path(OUTPUT_DIR))
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        default=PROFILES,
+        help="encodings to compare, e.g. png jpeg:80 webp:75:1024x768",
+    )
+    args = parser.parse_args()
+    main(args.images, args.profiles)
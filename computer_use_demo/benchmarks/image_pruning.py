@@ -0,0 +1,111 @@
+"""
+Measures the pruning of old screenshots from a long chat history, with the image index
+kept alongside the history and with a full scan of the history on every step (what
+_maybe_filter_to_n_most_recent_images did without an index). Both must leave the same
+images in the history. No display or API key is needed:
+    python -m computer_use_demo.benchmarks.image_pruning --messages 10000 --steps 200
+"""
+
+import argparse
+import logging
+import time
+
+from anthropic.types.beta import BetaMessageParam
+
+from computer_use_demo.anthropic_access import (
+    _maybe_filter_to_n_most_recent_images,
+)
+from computer_use_demo.models.image_index import ImageIndex
+
+logger = logging.getLogger(__name__)
+
+
+# Function will return the two messages of a step: the screenshot call and its result
+def step_messages(step: int) -> list[BetaMessageParam]:
+    tool_id = f"toolu_{step}"
+    return [
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": f"Step {step}"},
+                {
+                    "type": "tool_use",
+                    "id": tool_id,
+                    "name": "computer",
+                    "input": {"action": "screenshot"},
+                },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": tool_id,
+                    "content": [
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/png",
+                                "data": f"screenshot {step}",
+                            },
+                        }
+                    ],
+                }
+            ],
+        },
+    ]
+
+
+def remaining_images(messages: list[BetaMessageParam]) -> list[str]:
+    return [
+        image["source"]["data"]
+        for message in messages
+        if isinstance(message["content"], list)
+        for block in message["content"]
+        if block.get("type") == "tool_result"
+        for image in block["content"]
+    ]
+
+
+def run(
+    history: int, steps: int, keep: int, threshold: int, indexed: bool
+) -> tuple[float, list[str]]:
+    messages: list[BetaMessageParam] = []
+    for step in range(history // 2):
+        messages.extend(step_messages(step))
+    image_index = ImageIndex() if indexed else None
+    # the history was pruned all along, only the steps after it are measured
+    _maybe_filter_to_n_most_recent_images(messages, keep, threshold, image_index)
+    start = time.perf_counter()
+    for step in range(history // 2, history // 2 + steps):
+        messages.extend(step_messages(step))
+        _maybe_filter_to_n_most_recent_images(messages, keep, threshold, image_index)
+    return (time.perf_counter() - start) / steps, remaining_images(messages)
+
+
+def main(history: int, steps: int, keep: int, threshold: int):
+    scan, scan_images = run(history, steps, keep, threshold, indexed=False)
+    indexed, indexed_images = run(history, steps, keep, threshold, indexed=True)
+    logger.info(f"history of {history} messages, {steps} steps, keeping {keep} images")
+    logger.info(f"full scan per step: {scan * 1e6:.1f}us")
+    logger.info(
+        f"indexed per step:   {indexed * 1e6:.1f}us ({scan / indexed:.0f}x faster)"
+    )
+    if scan_images != indexed_images:
+        raise SystemExit("the index left other images in the history than a full scan")
+    logger.info(f"both kept the same {len(indexed_images)} images")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--keep", type=int, default=10)
+    parser.add_argument("--threshold", type=int, default=50)
+    args = parser.parse_args()
+    main(args.messages, args.steps, args.keep, args.threshold)
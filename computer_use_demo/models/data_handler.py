@@ -1,23 +1,44 @@
-from models.sus_classes import SUSAnswer
 import pandas as pd
+from models.sus_classes import SUSAnswer
 
+from computer_use_demo.models.metering import CallUsage
+from computer_use_demo.models.planner_response import ParseStats
 
-class ReportDataHandler:
+USAGE_COLUMNS = [
+    "Calls",
+    "Prompt Tokens",
+    "Completion Tokens",
+    "Image Tokens",
+    "Cache Read Tokens",
+    "Cache Write Tokens",
+    "Cost ($)",
+    "Latency (s)",
+    "Queue Wait (s)",
+]
 
-    action_data = (
-        []
-    )  # Contains instructions, reasoning, reflections, and usability notes of the Control AI
-    sus_data: list[SUSAnswer] = []  # Contains the SUS answers of the Control AU
-    oai_messages = []  # Contains the whole messages of the OpenAI assistant
-    current_task_interactions = (
-        0  # Contains the number of interactions the user had with the task
-    )
-    task_interactions = (
-        []
-    )  # Contains the number of interactions the user had with the task
 
+class ReportDataHandler:
+    def __init__(self):
+        self.init()
+
+    # Function will reset the report, e.g. before the next session of a batch run
     def init(self):
+        # Contains instructions, reasoning, reflections, and usability notes of the Control AI
         self.action_data = []
+        self.sus_data: list[
+            SUSAnswer
+        ] = []  # Contains the SUS answers of the Control AU
+        # Contains the number of interactions the user had with the current task
+        self.current_task_interactions = 0
+        # Contains the number of interactions the user had with the task
+        self.task_interactions = []
+        # Contains the tokens, cost and latency of every LLM call
+        self.usage_data = []
+        # Visibility checks answered from the verdict cache and checks that were sent
+        self.verdict_hits = 0
+        self.verdict_misses = 0
+        # Structured planner answers that were parsed and that fell back to the regexes
+        self.parse_stats = ParseStats()
 
     def new_task(
         self,
@@ -40,6 +61,7 @@ class ReportDataHandler:
         usability_notes: str = "",
         flag: str = "",
         current_url: str = "",
+        verdict_cached: bool = False,
     ):
         self.action_data[-1]["actions"].append(
             {
@@ -49,9 +71,153 @@ class ReportDataHandler:
                 "Usability Notes": usability_notes,
                 "Flag": flag,
                 "Current URL": current_url,
+                "Settle Time (s)": 0.0,
+                "Screen Changed": True,
+                "Verdict Cached": verdict_cached,
+                "Fast Path": False,
+            }
+        )
+        # the planner and the visibility check of this action ran before it was created
+        step = len(self.action_data[-1]["actions"])
+        for usage in self.usage_data:
+            if usage["Task"] == len(self.action_data) and usage["Step"] is None:
+                if usage["Purpose"] in ("planner", "check"):
+                    usage["Step"] = step
+
+    # Function will note that the screen looked the same after the last action was executed
+    def mark_screen_unchanged(self):
+        if self.action_data and self.action_data[-1]["actions"]:
+            self.action_data[-1]["actions"][-1]["Screen Changed"] = False
+
+    # Function will note that the last action was executed without the LLM executor
+    def mark_fast_path(self):
+        if self.action_data and self.action_data[-1]["actions"]:
+            self.action_data[-1]["actions"][-1]["Fast Path"] = True
+
+    # Function returns how many steps were executed on the fast path
+    def get_fast_path_stats(self) -> pd.DataFrame:
+        actions = [action for task in self.action_data for action in task["actions"]]
+        fast_path_steps = sum(1 for action in actions if action.get("Fast Path"))
+        return pd.DataFrame(
+            {
+                "Steps": [len(actions)],
+                "Fast Path Steps": [fast_path_steps],
+                "Fast Path Fraction": [
+                    round(fast_path_steps / len(actions), 3) if actions else 0.0
+                ],
             }
         )
 
+    # Function will count a visibility check, answered from the verdict cache or not
+    def record_verdict(self, cached: bool):
+        if cached:
+            self.verdict_hits += 1
+        else:
+            self.verdict_misses += 1
+
+    # Function returns how many visibility checks of the session the verdict cache answered
+    def get_verdict_cache_stats(self) -> pd.DataFrame:
+        checks = self.verdict_hits + self.verdict_misses
+        return pd.DataFrame(
+            {
+                "Hits": [self.verdict_hits],
+                "Misses": [self.verdict_misses],
+                "Hit Rate": [round(self.verdict_hits / checks, 3) if checks else 0.0],
+            }
+        )
+
+    # Function will record the usage of a planner call. Calls of the planner and the check
+    # belong to the next action of the task, feedback and SUS answers only to the task.
+    def record_usage(self, usage: CallUsage):
+        self._add_usage(usage, None)
+
+    # Function will record the usage of a call of the last action, e.g. of the executor
+    def record_action_usage(self, usage: CallUsage):
+        step = len(self.action_data[-1]["actions"]) if self.action_data else 0
+        self._add_usage(usage, step or None)
+
+    def _add_usage(self, usage: CallUsage, step: int | None):
+        self.usage_data.append(
+            {
+                "Task": len(self.action_data),
+                "Step": step,
+                "Purpose": usage.purpose,
+                "Provider": str(usage.provider),
+                "Model": usage.model,
+                "Calls": 1,
+                "Prompt Tokens": usage.prompt_tokens,
+                "Completion Tokens": usage.completion_tokens,
+                "Image Tokens": usage.image_tokens,
+                "Cache Read Tokens": usage.cache_read_tokens,
+                "Cache Write Tokens": usage.cache_write_tokens,
+                "Cost ($)": usage.cost,
+                "Latency (s)": usage.latency,
+                "Queue Wait (s)": usage.queue_wait,
+                "New Connection": usage.new_connection,
+            }
+        )
+
+    # Function returns how many executor requests of the session reused a pooled connection
+    def get_connection_stats(self) -> pd.DataFrame:
+        requests = [u for u in self.usage_data if u["Purpose"] == "executor"]
+        new_connections = sum(1 for u in requests if u["New Connection"])
+        reused = len(requests) - new_connections
+        return pd.DataFrame(
+            {
+                "Requests": [len(requests)],
+                "New Connections": [new_connections],
+                "Reused Connections": [reused],
+                "Reuse Rate": [round(reused / len(requests), 3) if requests else 0.0],
+            }
+        )
+
+    # Function returns the usage rolled up per action, per task and for the whole session
+    def get_cost_latency_stats(self) -> pd.DataFrame:
+        columns = ["Level", "Task", "Task Name", "Step"] + USAGE_COLUMNS
+        # share of the prompt tokens read from the prompt cache
+        columns.insert(columns.index("Cache Write Tokens") + 1, "Cache Hit Rate")
+        if not self.usage_data:
+            return pd.DataFrame(columns=columns)
+        usage = pd.DataFrame(self.usage_data)
+        task_names = {
+            i: task["task_name"] for i, task in enumerate(self.action_data, 1)
+        }
+        rows = []
+        for task, task_usage in usage.groupby("Task", sort=True):
+            action_usage = task_usage.dropna(subset=["Step"])
+            for step, step_usage in action_usage.groupby("Step"):
+                rows.append(
+                    {
+                        "Level": "Action",
+                        "Task": task,
+                        "Step": int(step),
+                        **step_usage[USAGE_COLUMNS].sum(),
+                    }
+                )
+            rows.append(
+                {"Level": "Task", "Task": task, **task_usage[USAGE_COLUMNS].sum()}
+            )
+        rows.append({"Level": "Session", **usage[USAGE_COLUMNS].sum()})
+        stats = pd.DataFrame(rows, columns=["Level", "Task", "Step"] + USAGE_COLUMNS)
+        stats["Task Name"] = stats["Task"].map(task_names)
+        integer_columns = ["Task", "Step"] + USAGE_COLUMNS[:6]
+        stats[integer_columns] = stats[integer_columns].astype("Int64")
+        stats["Cache Hit Rate"] = (
+            (stats["Cache Read Tokens"] / stats["Prompt Tokens"])
+            .astype("Float64")
+            .fillna(0.0)
+            .round(3)
+        )
+        stats["Cost ($)"] = stats["Cost ($)"].round(4)
+        stats["Latency (s)"] = stats["Latency (s)"].round(2)
+        stats["Queue Wait (s)"] = stats["Queue Wait (s)"].round(2)
+        return stats[columns]
+
+    # Function will add the time the screen needed to settle after a tool call to the last action
+    def add_settle_time(self, seconds: float):
+        if self.action_data and self.action_data[-1]["actions"]:
+            self.action_data[-1]["actions"][-1]["Settle Time (s)"] += round(seconds, 2)
+
     def get_task_interactions(self) -> pd.DataFrame:
         if self.current_task_interactions > 0:
             self.task_interactions.append(self.current_task_interactions)
@@ -75,12 +241,6 @@ class ReportDataHandler:
     def reset_sus_data(self):
         self.sus_data = []
 
-    def set_oai_messages(self, messages: list[dict]):
-        self.oai_messages = messages
-
-    def get_oai_messages(self):
-        return self.oai_messages
-
     def new_feedback(self, feedback: dict[str, str]):
         self.action_data[-1]["feedback"] = feedback
 
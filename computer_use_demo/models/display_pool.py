@@ -0,0 +1,83 @@
+"""
+The display pool lets one container host several virtual desktops. Every slot is an Xvfb
+display with its own Firefox (own profile and remote debugging port), started by
+image/start_pool.sh with the same environment variables that are read here.
+Sessions ask the pool for a free slot and give it back when they are done, so N displays
+serve any number of sessions, at most N at a time.
+"""
+
+import asyncio
+import os
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class DisplaySlot:
+    display_num: int
+    debugging_port: int  # remote debugging port of the slot's Firefox
+    profile_dir: str  # Firefox profile of the slot
+
+
+class DisplayPool:
+    def __init__(self, slots: list[DisplaySlot]):
+        if not slots:
+            raise ValueError("The display pool needs at least one display")
+        self.slots = slots
+        self._free: asyncio.Queue[DisplaySlot] = asyncio.Queue()
+        for slot in slots:
+            self._free.put_nowait(slot)
+
+    @classmethod
+    def from_env(cls) -> "DisplayPool":
+        """
+        DISPLAY_POOL_SIZE displays starting at DISPLAY_NUM, with debugging ports starting at
+        FIREFOX_DEBUGGING_PORT and profiles in FIREFOX_PROFILE_DIR/display-<number>.
+        """
+        size = int(os.getenv("DISPLAY_POOL_SIZE", "1"))
+        first_display = int(os.getenv("DISPLAY_NUM", "1"))
+        first_port = int(os.getenv("FIREFOX_DEBUGGING_PORT", "9222"))
+        profile_root = os.getenv("FIREFOX_PROFILE_DIR", "/tmp/firefox-profiles")
+        return cls(
+            [
+                DisplaySlot(
+                    display_num=first_display + i,
+                    debugging_port=first_port + i,
+                    profile_dir=f"{profile_root}/display-{first_display + i}",
+                )
+                for i in range(size)
+            ]
+        )
+
+    @property
+    def free_slots(self) -> int:
+        return self._free.qsize()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[DisplaySlot]:
+        """Waits for a free display and holds it for the duration of the block."""
+        slot = await self._free.get()
+        try:
+            yield slot
+        finally:
+            self._free.put_nowait(slot)
+
+    async def run(
+        self, jobs: Iterable[Callable[[DisplaySlot], Awaitable[T]]]
+    ) -> list[T | BaseException]:
+        """
+        Runs every job on the next free display, as many at a time as there are displays.
+        A job that fails doesn't stop the others, its exception is returned in its place.
+        """
+
+        async def run_job(job: Callable[[DisplaySlot], Awaitable[T]]) -> T:
+            async with self.session() as slot:
+                return await job(slot)
+
+        return await asyncio.gather(
+            *(run_job(job) for job in jobs), return_exceptions=True
+        )
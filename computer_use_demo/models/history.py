@@ -0,0 +1,183 @@
+"""
+The planner history keeps the conversation with the planner bounded. The full transcript
+is kept for the report, but a request only contains the system prompt, a summary of the
+older turns and a sliding window of the most recent turns. Only the most recent
+screenshots are sent; an index of the messages that still hold an image lets the older
+ones be dropped without scanning the conversation. Turns that leave the window are folded
+into the summary in batches, in the background while the executor works on the step.
+If a request would still exceed the token budget, the oldest turns of the window are
+folded right away.
+
+The sizes can be configured with PLANNER_HISTORY_WINDOW (messages sent in full),
+PLANNER_IMAGE_WINDOW (recent messages sent with their screenshot), PLANNER_FOLD_BATCH
+(messages folded into the summary at once) and PLANNER_TOKEN_BUDGET (estimated input
+tokens per request).
+"""
+
+import asyncio
+import logging
+import os
+from collections import deque
+from collections.abc import Awaitable, Callable
+
+from computer_use_demo.models.rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Receives the summary so far and the turns to add to it, returns the new summary
+Summarizer = Callable[[str, list[dict]], Awaitable[str]]
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class PlannerHistory:
+    def __init__(
+        self,
+        window: int | None = None,
+        image_window: int | None = None,
+        fold_batch: int | None = None,
+        token_budget: int | None = None,
+    ):
+        self.window = window or int(os.getenv("PLANNER_HISTORY_WINDOW", "16"))
+        self.image_window = image_window or int(os.getenv("PLANNER_IMAGE_WINDOW", "8"))
+        self.fold_batch = fold_batch or int(os.getenv("PLANNER_FOLD_BATCH", "8"))
+        self.token_budget = token_budget or int(
+            os.getenv("PLANNER_TOKEN_BUDGET", "40000")
+        )
+        # Full transcript, images are dropped from the messages outside the image window
+        self.messages: list[dict] = []
+        self.summary = ""
+        self.folds = 0
+        # System messages, sent with every request
+        self._pinned: list[int] = []
+        # Estimated tokens of every message, kept up to date when its image is dropped
+        self._tokens: list[int] = []
+        # Indices of the messages that still hold an image, oldest first
+        self._images: deque[int] = deque()
+        # Messages before this index are in the summary (or were dropped without one)
+        self._start = 0
+        self._fold_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def append(self, message: dict):
+        index = len(self.messages)
+        self.messages.append(message)
+        self._tokens.append(estimate_tokens([message]))
+        if message["role"] == "system":
+            self._pinned.append(index)
+        if _image_parts(message):
+            self._images.append(index)
+        # drop the screenshots that left the image window
+        while self._images and self._images[0] < len(self.messages) - self.image_window:
+            self._drop_images(self._images.popleft())
+
+    def system_messages(self) -> list[dict]:
+        return [self.messages[i] for i in self._pinned]
+
+    # Function will remove the last message, e.g. a request that was cancelled
+    def pop(self) -> dict:
+        index = len(self.messages) - 1
+        if self._images and self._images[-1] == index:
+            self._images.pop()
+        if self._pinned and self._pinned[-1] == index:
+            self._pinned.pop()
+        self._tokens.pop()
+        self._start = min(self._start, index)
+        return self.messages.pop()
+
+    def _drop_images(self, index: int):
+        message = self.messages[index]
+        message["content"] = [
+            part for part in message["content"] if part["type"] != "image_ref"
+        ]
+        self._tokens[index] = estimate_tokens([message])
+
+    # Function will return the messages in the window, skipping the pinned ones
+    def _window(self) -> list[int]:
+        pinned = set(self._pinned)
+        return [i for i in range(self._start, len(self.messages)) if i not in pinned]
+
+    # Function will start folding the turns that left the window into the summary. It runs
+    # in the background, the next request waits for it in request_messages.
+    def compact(self, summarize: Summarizer | None):
+        if self._fold_task and not self._fold_task.done():
+            return
+        window = self._window()
+        if len(window) >= self.window + self.fold_batch:
+            self._fold_task = asyncio.create_task(
+                self._fold(window[: len(window) - self.window], summarize)
+            )
+
+    async def _fold(self, indices: list[int], summarize: Summarizer | None):
+        turns = [self.messages[i] for i in indices]
+        if summarize:
+            try:
+                self.summary = await summarize(self.summary, turns)
+            except Exception as e:
+                # the turns stay in the window and are folded with the next batch
+                logger.warning("Could not summarize the planner history: %s", e)
+                return
+        self._start = max(self._start, indices[-1] + 1)
+        self.folds += 1
+
+    @property
+    def folding(self) -> bool:
+        """Whether turns are being folded into the summary in the background."""
+        return bool(self._fold_task and not self._fold_task.done())
+
+    # Function will wait until the fold in the background is done, it has to run on the
+    # event loop that started it
+    async def wait_for_fold(self):
+        task, self._fold_task = self._fold_task, None
+        # a fold of an earlier run of the event loop was cancelled when the loop closed,
+        # its turns are folded with the next batch
+        if task and not task.cancelled():
+            await task
+
+    # Function will return the messages of the next request: the system messages, the
+    # summary and the window, within the token budget
+    async def request_messages(self, summarize: Summarizer | None) -> list[dict]:
+        await self.wait_for_fold()
+        window = self._window()
+        pinned_tokens = sum(self._tokens[i] for i in self._pinned)
+        summary_tokens = estimate_tokens([{"content": self.summary}])
+        tokens = pinned_tokens + summary_tokens + sum(self._tokens[i] for i in window)
+        # keep at least the message that is answered
+        overflow = 0
+        while tokens > self.token_budget and overflow < len(window) - 1:
+            tokens -= self._tokens[window[overflow]]
+            overflow += 1
+        if overflow:
+            logger.info(
+                "Planner request over the token budget, folding %d more messages",
+                overflow,
+            )
+            await self._fold(window[:overflow], summarize)
+            window = self._window()
+        request = self.system_messages()
+        if self.summary:
+            request.append(
+                {"role": "system", "content": f"{SUMMARY_PREFIX}{self.summary}"}
+            )
+        request.extend(self.messages[i] for i in window)
+        return request
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "Messages": len(self.messages),
+            "Window": len(self._window()),
+            "Folds": self.folds,
+            "Summary Characters": len(self.summary),
+        }
+
+
+def _image_parts(message: dict) -> list[dict]:
+    content = message["content"]
+    if not isinstance(content, list):
+        return []
+    return [part for part in content if part["type"] == "image_ref"]
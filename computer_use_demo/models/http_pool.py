@@ -0,0 +1,18 @@
+"""
+Connection pool settings of the HTTP clients used for the LLM APIs. They can be tuned
+per provider with environment variables, e.g. OPENAI_MAX_CONNECTIONS=20.
+"""
+
+import os
+
+import httpx
+
+
+def pool_limits(prefix: str) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv(f"{prefix}_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(
+            os.getenv(f"{prefix}_MAX_KEEPALIVE_CONNECTIONS", "10")
+        ),
+        keepalive_expiry=float(os.getenv(f"{prefix}_KEEPALIVE_EXPIRY", "120")),
+    )
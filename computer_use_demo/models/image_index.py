@@ -0,0 +1,85 @@
+"""
+Index of the screenshots in a chat history. The executor keeps only the most recent
+screenshots of the history it sends, and counting them by flattening every tool result of
+the whole history made each step O(n) in the length of the session. The index remembers
+how far the history was scanned and where the images still in it are, as
+(message index, block index) pairs in the order they were added. Only the messages added
+since the last call are scanned and the oldest images are removed from the front, so
+pruning is amortised O(1) per step.
+"""
+
+from collections import deque
+from typing import cast
+
+from anthropic.types.beta import BetaMessageParam, BetaToolResultBlockParam
+
+
+class ImageIndex:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.scanned = 0  # messages of the history that were scanned
+        self.total = 0  # images left in the scanned messages
+        # tool results with images, oldest first
+        self._tool_results: deque[tuple[int, int]] = deque()
+
+    # Function will add the images of the messages that were appended since the last call.
+    # If the history got shorter (e.g. it was reset), it is scanned again from the start.
+    def update(self, messages: list[BetaMessageParam]):
+        if len(messages) < self.scanned:
+            self.reset()
+        for message_index in range(self.scanned, len(messages)):
+            content = messages[message_index]["content"]
+            if not isinstance(content, list):
+                continue
+            for block_index, block in enumerate(content):
+                if isinstance(block, dict) and block.get("type") == "tool_result":
+                    images = _count_images(cast(BetaToolResultBlockParam, block))
+                    if images:
+                        self._tool_results.append((message_index, block_index))
+                        self.total += images
+        self.scanned = len(messages)
+
+    def prune(
+        self,
+        messages: list[BetaMessageParam],
+        images_to_keep: int,
+        min_removal_threshold: int,
+    ):
+        """
+        Remove all but the final `images_to_keep` tool_result images in place, with a
+        chunk of min_removal_threshold to reduce the amount we break the implicit prompt
+        cache.
+        """
+        self.update(messages)
+        images_to_remove = self.total - images_to_keep
+        # for better cache behavior, we want to remove in chunks
+        images_to_remove -= images_to_remove % min_removal_threshold
+
+        while images_to_remove > 0 and self._tool_results:
+            message_index, block_index = self._tool_results[0]
+            tool_result = cast(
+                BetaToolResultBlockParam,
+                messages[message_index]["content"][block_index],  # type: ignore
+            )
+            new_content = []
+            for content in tool_result.get("content", []):
+                if isinstance(content, dict) and content.get("type") == "image":
+                    if images_to_remove > 0:
+                        images_to_remove -= 1
+                        self.total -= 1
+                        continue
+                new_content.append(content)
+            tool_result["content"] = new_content  # type: ignore
+            if not _count_images(tool_result):
+                self._tool_results.popleft()
+
+
+def _count_images(tool_result: BetaToolResultBlockParam) -> int:
+    content = tool_result.get("content", [])
+    if not isinstance(content, list):
+        return 0
+    return sum(
+        1 for item in content if isinstance(item, dict) and item.get("type") == "image"
+    )
@@ -1,24 +1,24 @@
-from PIL import Image, ImageDraw
 import base64
+import os
+from dataclasses import dataclass
+from enum import StrEnum
 from io import BytesIO
 
+from PIL import Image, ImageDraw
+
 TOP_PIXELS = 0  # Would be 81 if you want to remove the option to close the browser or switch tabs
 BOTTOM_PIXELS = 60
 FILL_COLOR = "#f7f7f5"
 
 """
-This function crops the image that Open AI receives from the user's computer. It removes 
+This function crops the image that Open AI receives from the user's computer. It removes
 the the bottom part of the image that conains the OS Task bar. Also it draws a white rectangle over
-the browser URL bar to prevent the AI from switching the website. 
+the browser URL bar to prevent the AI from switching the website.
 This is to reduce distracitons on the screen.
 """
 
 
-def prep_image(b64_image: str) -> str:
-    # Convert base64 to Image
-    bytesio_image = BytesIO(base64.b64decode(b64_image))
-    image = Image.open(bytesio_image)
-
+def crop_and_mask(image: Image.Image) -> Image.Image:
     # Get the dimensions of the image
     width, height = image.size
 
@@ -39,11 +39,152 @@ def prep_image(b64_image: str) -> str:
     draw = ImageDraw.Draw(cropped_image)
 
     draw.rectangle([width - 880, 81, width, 81 + 40], fill=FILL_COLOR)
+    return cropped_image
+
+
+class ImageFormat(StrEnum):
+    PNG = "png"
+    JPEG = "jpeg"
+    WEBP = "webp"
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    image_format: ImageFormat = ImageFormat.PNG
+    quality: int = 85  # only used by the lossy formats
+    max_size: tuple[int, int] | None = None  # (width, height), keeps the aspect ratio
 
-    # Convert the image back to the desired output format
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.image_format}"
+
+
+DEFAULT_PROFILE = EncodingProfile()
+
+
+def parse_encoding_profile(spec: str) -> EncodingProfile:
+    """
+    Parses profiles like "png", "jpeg:80" or "webp:75:1024x768"
+    (format, optional quality, optional maximum size)
+    """
+    parts = spec.strip().lower().split(":")
+    profile = EncodingProfile(image_format=ImageFormat(parts[0]))
+    for part in parts[1:]:
+        if "x" in part:
+            width, height = part.split("x")
+            profile = EncodingProfile(
+                profile.image_format, profile.quality, (int(width), int(height))
+            )
+        else:
+            profile = EncodingProfile(profile.image_format, int(part), profile.max_size)
+    return profile
+
+
+def encode_image(
+    image: Image.Image, profile: EncodingProfile = DEFAULT_PROFILE
+) -> bytes:
+    if profile.max_size and (
+        image.width > profile.max_size[0] or image.height > profile.max_size[1]
+    ):
+        image = image.copy()
+        image.thumbnail(profile.max_size, Image.Resampling.LANCZOS)
     output_buffer = BytesIO()
-    cropped_image.save(output_buffer, format="PNG")
-    output_buffer.seek(0)
+    if profile.image_format == ImageFormat.PNG:
+        image.save(output_buffer, format="PNG")
+    else:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(
+            output_buffer, format=profile.image_format.upper(), quality=profile.quality
+        )
+    return output_buffer.getvalue()
+
+
+def prep_image(b64_image: str) -> str:
+    return (
+        ImagePipeline(base64.b64decode(b64_image)).prepare(ImageConsumer.PLANNER).data
+    )
+
+
+"""
+The image pipeline holds one screenshot and prepares it for every consumer. Every prepared
+variant is encoded once and cached. The raw pixels of the capture are used while the owner
+keeps them (see release_pixels), so the current step doesn't decode the screenshot at all.
+Without them, the screenshot is decoded for a new variant and the pixels are not kept.
+"""
+
+
+class ImageConsumer(StrEnum):
+    PLANNER = "planner"  # OpenAI assistant that decides on the next instruction
+    CHECKER = "checker"  # OpenAI visibility check of the instruction
+    EXECUTOR = "executor"  # Anthropic computer use request
+
+
+# The encoding of every consumer can be set with e.g. PLANNER_IMAGE_ENCODING=jpeg:80:1024x768.
+# The executor's screenshot is never resized, the coordinates the model returns refer to it.
+ENCODING_PROFILES: dict[ImageConsumer, EncodingProfile] = {
+    consumer: parse_encoding_profile(
+        os.getenv(f"{consumer.upper()}_IMAGE_ENCODING", "png")
+    )
+    for consumer in ImageConsumer
+}
+if ENCODING_PROFILES[ImageConsumer.EXECUTOR].max_size:
+    raise ValueError("EXECUTOR_IMAGE_ENCODING must not contain a maximum size")
+
+# Everything but the executor sees the cropped and masked screenshot
+MASKED_CONSUMERS = {ImageConsumer.PLANNER, ImageConsumer.CHECKER}
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    data: str  # base64
+    media_type: str
+
+
+class ImagePipeline:
+    def __init__(
+        self,
+        encoded: bytes,
+        pixels: Image.Image | None = None,
+        b64_encoded: str | None = None,
+    ):
+        self.encoded = encoded  # the screenshot as captured (already scaled), PNG
+        self._pixels = pixels
+        self._b64_encoded = b64_encoded
+        # cached variants, consumers with the same preparation share one
+        self._prepared: dict[tuple[bool, EncodingProfile], PreparedImage] = {}
+
+    @property
+    def pixels(self) -> Image.Image:
+        """The raw pixels of the capture, or else decoded for the caller and not kept."""
+        if self._pixels is not None:
+            return self._pixels
+        pixels = Image.open(BytesIO(self.encoded))
+        pixels.load()
+        return pixels
+
+    def release_pixels(self):
+        self._pixels = None
+
+    @property
+    def b64_encoded(self) -> str:
+        """The screenshot as it was captured, base64 encoded"""
+        if self._b64_encoded is None:
+            self._b64_encoded = base64.b64encode(self.encoded).decode("utf-8")
+        return self._b64_encoded
 
-    base64_output = base64.b64encode(output_buffer.getvalue()).decode("utf-8")
-    return base64_output
+    def prepare(self, consumer: ImageConsumer) -> PreparedImage:
+        """Return the encoded image for the given consumer."""
+        masked = consumer in MASKED_CONSUMERS
+        profile = ENCODING_PROFILES[consumer]
+        key = (masked, profile)
+        if key not in self._prepared:
+            if not masked and profile == DEFAULT_PROFILE:
+                # the captured screenshot can be used as it is, no need to re-encode it
+                data = self.b64_encoded
+            else:
+                pixels = self.pixels
+                image = crop_and_mask(pixels) if masked else pixels
+                data = base64.b64encode(encode_image(image, profile)).decode("utf-8")
+            self._prepared[key] = PreparedImage(data, profile.media_type)
+        return self._prepared[key]
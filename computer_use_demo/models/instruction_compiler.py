@@ -0,0 +1,181 @@
+"""
+The instruction compiler maps trivial planner instructions straight onto computer tool
+actions, so they don't need an Anthropic round trip. Only instructions that can be
+executed without looking at the screen are compiled: scrolling the page, pressing keys,
+typing quoted text into the focused element and waiting. Everything that refers to an
+element on the screen (click, hover, "press the 'Submit' button", "type ... into the
+search bar", scrolling inside a dropdown) returns None and goes to the LLM. This includes
+instructions whose additional info names an element or a place on the screen, e.g.
+`Type "x" -> [the search field below the header]`: the text is meant for that field,
+not for whatever has the focus, and only the LLM can use the planner's hint.
+"""
+
+import re
+from dataclasses import dataclass, field
+
+MAX_WAIT_SECONDS = 10.0
+DEFAULT_WAIT_SECONDS = 2.0
+
+# Names the planner uses for keys, mapped to xdotool keysyms
+KEY_NAMES = {
+    "enter": "Return",
+    "return": "Return",
+    "esc": "Escape",
+    "escape": "Escape",
+    "tab": "Tab",
+    "space": "space",
+    "spacebar": "space",
+    "backspace": "BackSpace",
+    "delete": "Delete",
+    "del": "Delete",
+    "home": "Home",
+    "end": "End",
+    "page down": "Page_Down",
+    "pagedown": "Page_Down",
+    "page up": "Page_Up",
+    "pageup": "Page_Up",
+    "up": "Up",
+    "down": "Down",
+    "left": "Left",
+    "right": "Right",
+    "up arrow": "Up",
+    "down arrow": "Down",
+    "left arrow": "Left",
+    "right arrow": "Right",
+    "arrow up": "Up",
+    "arrow down": "Down",
+    "arrow left": "Left",
+    "arrow right": "Right",
+    "ctrl": "ctrl",
+    "control": "ctrl",
+    "alt": "alt",
+    "shift": "shift",
+    "cmd": "super",
+}
+FUNCTION_KEY = re.compile(r"f([1-9]|1[0-2])")
+
+# Where the page is scrolled to, mapped to the key that does it
+SCROLL_KEYS = {
+    "down": "Page_Down",
+    "up": "Page_Up",
+    "to the bottom": "End",
+    "to the top": "Home",
+}
+
+SCROLL = re.compile(
+    r"^scroll\s+(down|up|to the bottom|to the top)"
+    r"(?:\s+(?:the page|on the page|of the page|the website|a bit|a little|further|again))?"
+    r"(?:\s+(?:to|in order to)\s+(?:see|view|reveal|find|check|look)\b.*)?$"
+)
+# Scrolling inside an element (a dropdown, a list, a map) needs the pointer over it
+SCOPED_SCROLL = re.compile(r"\b(in|inside|within|over|on)\s+the\b(?!\s+page\b)")
+PRESS = re.compile(
+    r"^press\s+(?:the\s+)?['\"]?(?P<keys>[\w +\-]+?)['\"]?"
+    r"(?:\s+key(?:s)?)?(?:\s+on the keyboard)?$"
+)
+WAIT = re.compile(
+    r"^wait(?:\s+(?:for\s+)?(?P<seconds>\d+(?:\.\d+)?)\s*(?:s|sec|secs|seconds?))?"
+    r"(?:\s+(?:for|until)\b.*)?$"
+)
+CLOSING_QUOTES = {"'": "'", '"': '"', "“": "”", "‘": "’"}
+# Additional info that names an element or a place on the screen. Info that only explains
+# the action ("[Press the Enter key to start the search]") doesn't match.
+TARGET_INFO = re.compile(
+    r"\b(?:field|input|box|(?<!space\s)bar|button|link|menu|drop-?down|list|option|"
+    r"checkbox|radio|form|textarea|editor|section|panel|sidebar|header|footer|dialog|"
+    r"pop-?up|modal|window|icon|element|table|row|column|cell|"
+    r"below|above|under|beneath|next to|beside|left of|right of|corner|located|"
+    r"cent(?:er|re)|middle)s?\b"
+)
+
+
+@dataclass(frozen=True)
+class CompiledInstruction:
+    description: str  # shown in place of the executor's answer
+    actions: list[dict[str, str]] = field(default_factory=list)  # computer tool inputs
+    wait: float = 0.0  # seconds to wait before the actions
+
+
+# Function will split "<instruction> -> <additional info>" into its two parts
+def _split_instruction(instruction: str) -> tuple[str, str]:
+    instruction, _, info = instruction.partition(" -> ")
+    instruction = " ".join(instruction.strip().rstrip(".").split())
+    return instruction, info.strip().strip("[]").strip()
+
+
+def _key_combination(keys: str) -> str | None:
+    keys = keys.strip().lower()
+    if keys in KEY_NAMES:
+        return KEY_NAMES[keys]
+    parts = [part.strip() for part in re.split(r"\s*\+\s*", keys)]
+    if len(parts) < 2:
+        return keys.upper() if FUNCTION_KEY.fullmatch(keys) else None
+    combination = []
+    for part in parts:
+        if part in KEY_NAMES:
+            combination.append(KEY_NAMES[part])
+        elif FUNCTION_KEY.fullmatch(part):
+            combination.append(part.upper())
+        elif len(part) == 1 and part.isalnum():
+            combination.append(part)
+        else:
+            return None
+    return "+".join(combination)
+
+
+def _compile_type(instruction: str) -> CompiledInstruction | None:
+    if not instruction.lower().startswith("type ") or len(instruction) < 8:
+        return None
+    quote = instruction[5]
+    if quote not in CLOSING_QUOTES or instruction[-1] != CLOSING_QUOTES[quote]:
+        return None
+    text = instruction[6:-1]
+    # "Type 'a' into the 'b' field" refers to an element, the quotes don't enclose one text
+    if not text or CLOSING_QUOTES[quote] in text:
+        return None
+    return CompiledInstruction(
+        description=f"Typing {text!r}.", actions=[{"action": "type", "text": text}]
+    )
+
+
+# Function will compile the instruction into computer tool actions, or return None if the
+# instruction needs the LLM
+def compile_instruction(instruction: str) -> CompiledInstruction | None:
+    instruction, info = _split_instruction(instruction)
+    lowered = instruction.lower()
+
+    if lowered.startswith("wait"):
+        # waiting doesn't touch an element, the info can only say what it waits for
+        match = WAIT.match(lowered)
+        if not match:
+            return None
+        seconds = float(match.group("seconds") or DEFAULT_WAIT_SECONDS)
+        seconds = min(seconds, MAX_WAIT_SECONDS)
+        return CompiledInstruction(description=f"Waiting {seconds:g}s.", wait=seconds)
+
+    if TARGET_INFO.search(info.lower()):
+        return None
+
+    if lowered.startswith("scroll"):
+        match = SCROLL.match(lowered)
+        if not match or SCOPED_SCROLL.search(lowered):
+            return None
+        key = SCROLL_KEYS[match.group(1)]
+        return CompiledInstruction(
+            description=f"Scrolling {match.group(1)} with {key}.",
+            actions=[{"action": "key", "text": key}],
+        )
+
+    if lowered.startswith("press"):
+        match = PRESS.match(lowered)
+        key = _key_combination(match.group("keys")) if match else None
+        if key is None:  # e.g. "Press the 'Submit' button" is a click
+            return None
+        return CompiledInstruction(
+            description=f"Pressing {key}.", actions=[{"action": "key", "text": key}]
+        )
+
+    if lowered.startswith("type"):
+        return _compile_type(instruction)
+
+    return None
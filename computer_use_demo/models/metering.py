@@ -0,0 +1,88 @@
+"""
+Metering of the LLM calls. Every call to the planner, the visibility check and the
+executor is recorded with its tokens, the cost derived from them, the latency of the
+request and how long it waited for the rate limiter. The records are rolled up per action,
+task and session by the ReportDataHandler.
+"""
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+# US$ per million tokens: input, output, cache read, cache write. Models are matched by
+# prefix, so the Bedrock and Vertex names of a model find the same prices.
+PRICES: dict[str, tuple[float, float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60, 0.075, 0.15),
+    "gpt-4o": (2.50, 10.00, 1.25, 2.50),
+    "claude-3-5-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "anthropic.claude-3-5-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-5-haiku": (0.80, 4.00, 0.08, 1.00),
+}
+
+
+@dataclass(frozen=True)
+class CallUsage:
+    provider: str
+    model: str
+    purpose: str  # planner, check, executor, summary, feedback or sus
+    prompt_tokens: int = 0  # all input tokens, including the cached ones
+    completion_tokens: int = 0
+    image_tokens: int = 0  # estimated share of the prompt tokens spent on screenshots
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    latency: float = 0.0  # seconds from sending the request to the complete response
+    queue_wait: float = 0.0  # seconds waited for the rate limiter before
+    new_connection: bool = False  # the request couldn't reuse a pooled connection
+
+    @property
+    def cost(self) -> float:
+        prices = next(
+            (
+                prices
+                for prefix, prices in sorted(PRICES.items(), key=lambda p: -len(p[0]))
+                if self.model.startswith(prefix)
+            ),
+            None,
+        )
+        if prices is None:
+            return 0.0
+        input_price, output_price, cache_read_price, cache_write_price = prices
+        uncached = self.prompt_tokens - self.cache_read_tokens - self.cache_write_tokens
+        return (
+            uncached * input_price
+            + self.completion_tokens * output_price
+            + self.cache_read_tokens * cache_read_price
+            + self.cache_write_tokens * cache_write_price
+        ) / 1_000_000
+
+
+# Receives the usage of every call, e.g. ReportDataHandler.record_usage
+Meter = Callable[[CallUsage], None]
+
+
+# Function will read the usage of an OpenAI chat completion (or the last chunk of a stream)
+def openai_usage(usage: Any, **call: Any) -> CallUsage:
+    details = getattr(usage, "prompt_tokens_details", None)
+    return CallUsage(
+        provider="openai",
+        prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+        cache_read_tokens=getattr(details, "cached_tokens", 0) or 0,
+        **call,
+    )
+
+
+# Function will read the usage of an Anthropic message. Anthropic counts the cached
+# input tokens separately from the input tokens.
+def anthropic_usage(usage: Any, **call: Any) -> CallUsage:
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    return CallUsage(
+        prompt_tokens=(getattr(usage, "input_tokens", 0) or 0)
+        + cache_read
+        + cache_write,
+        completion_tokens=getattr(usage, "output_tokens", 0) or 0,
+        cache_read_tokens=cache_read,
+        cache_write_tokens=cache_write,
+        **call,
+    )
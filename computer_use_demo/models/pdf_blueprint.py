@@ -1,8 +1,9 @@
-from fpdf import FPDF
-from PIL import Image
 import base64
 from io import BytesIO
 
+from fpdf import FPDF
+from PIL import Image
+
 
 class PDF(FPDF):
     def header(self):
@@ -0,0 +1,106 @@
+"""
+Structured planner protocol. Instead of marking the parts of its answer with <>, [], (),
+{} and !!, the planner answers with a JSON object that follows RESPONSE_SCHEMA, enforced
+by OpenAI's structured outputs. The answer is parsed in one pass and validated against the
+schema, so a bracket in the chain of thought can no longer end up in the instruction.
+The fields are in the order of the text protocol: the chain of thought comes first, the
+instruction and its additional information right after it.
+"""
+
+import json
+import re
+from dataclasses import dataclass
+
+from jsonschema import Draft202012Validator
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "chain_of_thought": {
+            "type": "string",
+            "description": "State of the website and the reasoning for the next action",
+        },
+        "instruction": {
+            "type": "string",
+            "description": "One atomic action, COMPLETED or FAILED, or empty when done",
+        },
+        "additional_info": {
+            "type": "string",
+            "description": "Where to find the element, or the summary when done",
+        },
+        "self_reflection": {"type": "string"},
+        "usability_notes": {"type": "string"},
+        "flag": {
+            "type": "string",
+            "description": "The issue to flag for review, empty if there is none",
+        },
+    },
+    "required": [
+        "chain_of_thought",
+        "instruction",
+        "additional_info",
+        "self_reflection",
+        "usability_notes",
+        "flag",
+    ],
+    "additionalProperties": False,
+}
+
+# response_format of the chat completion request
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "planner_step", "strict": True, "schema": RESPONSE_SCHEMA},
+}
+
+STRUCTURED_OUTPUT_PROMPT = """
+# Structured Output
+When you give an instruction, answer with a JSON object instead of the markers described above: the chain of thought goes into "chain_of_thought", the atomic action (without < >) into "instruction", the [ ] part into "additional_info", the ( ) part into "self_reflection", the { } part into "usability_notes" and the !! !! part into "flag". Use an empty string for "flag" if there is nothing to flag, and for "instruction" when all tasks are completed or determined to be unachievable.
+"""
+
+validator = Draft202012Validator(RESPONSE_SCHEMA)
+
+
+class PlannerResponseError(ValueError):
+    pass
+
+
+# Function will parse and validate a structured planner response into the response parts
+def parse_response(text: str) -> dict[str, str]:
+    try:
+        response = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise PlannerResponseError(f"The response is no JSON: {e}") from e
+    errors = sorted(validator.iter_errors(response), key=str)
+    if errors:
+        raise PlannerResponseError(
+            f"The response doesn't match the schema: {errors[0].message}"
+        )
+    return {
+        "instruction": response["instruction"].strip(),
+        "additional_info": response["additional_info"].strip(),
+        "self_reflection": response["self_reflection"].strip(),
+        "usability_notes": response["usability_notes"].strip(),
+        "flag": response["flag"].strip(),
+    }
+
+
+# Function will return a JSON string field of a streamed response once its value is
+# complete, e.g. `"instruction": "Click on \"Sign Up\""` before the object is closed
+def complete_field(text: str, field: str) -> str | None:
+    match = re.search(rf'"{field}"\s*:\s*("(?:[^"\\]|\\.)*")', text)
+    return json.loads(match.group(1)).strip() if match else None
+
+
+# Structured answers of the planner in one session, kept by the ReportDataHandler
+@dataclass
+class ParseStats:
+    parsed: int = 0
+    failures: int = 0  # answers that fell back to the regex extraction
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.parsed + self.failures
+        return {
+            "Parsed": self.parsed,
+            "Parse Failures": self.failures,
+            "Failure Rate": self.failures / total if total else 0.0,
+        }
@@ -0,0 +1,396 @@
+"""
+Client-side rate limiter for the LLM APIs. Every provider and model has a token bucket for
+requests and one for tokens per minute. The buckets live in a small SQLite database, so all
+sessions of a process and all processes that share the file (e.g. several containers with
+the same volume mounted at RATE_LIMIT_DIR) draw from the same budget. Every update runs in
+a BEGIN IMMEDIATE transaction, which SQLite serializes across processes.
+
+The configured limits are only the starting point. The rate limit headers of every response
+correct the limits and the remaining budget, and a retry-after of a 429 blocks the bucket,
+so the callers wait in the queue instead of all sleeping and retrying at the same time.
+The database is created on the first request, importing the module doesn't touch the disk.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DATABASE_NAME = "llm_rate_limits.sqlite"
+
+IMAGE_TOKENS = 1100  # rough cost of a 1024x768 screenshot for both providers
+CHARS_PER_TOKEN = 4
+
+# Requests and tokens per minute to start with, until the headers tell the real limits.
+# Can be set with e.g. OPENAI_REQUESTS_PER_MINUTE=500 and OPENAI_TOKENS_PER_MINUTE=30000.
+DEFAULT_LIMITS = {
+    "openai": (500.0, 30_000.0),
+    "anthropic": (50.0, 40_000.0),
+}
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    requests_per_minute: float
+    tokens_per_minute: float
+
+
+def default_limit(provider: str) -> RateLimit:
+    requests, tokens = DEFAULT_LIMITS.get(provider, (60.0, 40_000.0))
+    return RateLimit(
+        float(os.getenv(f"{provider.upper()}_REQUESTS_PER_MINUTE", requests)),
+        float(os.getenv(f"{provider.upper()}_TOKENS_PER_MINUTE", tokens)),
+    )
+
+
+# Function will count the characters of text and the images of the messages
+def count_content(messages: list) -> tuple[int, int]:
+    chars = 0
+    images = 0
+
+    def visit(content):
+        nonlocal chars, images
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                visit(part)
+        elif isinstance(content, dict):
+            if content.get("type") in ("image", "image_url", "image_ref"):
+                images += 1
+            elif "text" in content:
+                chars += len(content["text"])
+            elif "content" in content:
+                visit(content["content"])
+
+    for message in messages:
+        visit(message.get("content") if isinstance(message, dict) else message)
+    return chars, images
+
+
+# Function will estimate the tokens of a request: the text of the messages, a fixed amount
+# per image and the maximum length of the answer, as the providers count it up front
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    chars, images = count_content(messages)
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS + max_tokens
+
+
+def _parse_duration(value: str) -> float | None:
+    """Parses OpenAI's reset durations like "20ms", "1s" or "6m0s"."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    factors = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * factors[unit] for amount, unit in parts)
+
+
+def _parse_reset(value: str | None) -> float | None:
+    """Seconds until the reset, from a duration or an RFC 3339 timestamp (Anthropic)."""
+    if not value:
+        return None
+    try:
+        reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return max(0.0, reset.timestamp() - time.time())
+    except ValueError:
+        return _parse_duration(value)
+
+
+def _header(headers: Mapping[str, str], *names: str) -> str | None:
+    for name in names:
+        if (value := headers.get(name)) is not None:
+            return value
+    return None
+
+
+def _float(value: str | None) -> float | None:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class QueueWait:
+    """Running totals of the seconds the requests of one bucket waited in the queue."""
+
+    requests: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, seconds: float):
+        self.requests += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class RateLimiter:
+    def __init__(self, path: str | None = None):
+        """
+        `path` is the database file, by default llm_rate_limits.sqlite in RATE_LIMIT_DIR
+        (read on the first request, default /tmp).
+        """
+        self._path = path
+        self._created = False
+        self._create_lock = threading.Lock()
+        # seconds the requests of this process waited in the queue, by bucket
+        self.queue_wait: dict[str, QueueWait] = {}
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            self._path = os.path.join(
+                os.getenv("RATE_LIMIT_DIR", "/tmp"), DATABASE_NAME
+            )
+        return self._path
+
+    def _create(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        db = self._open()
+        try:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    requests_per_minute REAL,
+                    tokens_per_minute REAL,
+                    requests REAL,
+                    tokens REAL,
+                    updated REAL,
+                    blocked_until REAL
+                )"""
+            )
+        finally:
+            db.close()
+
+    def _open(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _connect(self) -> sqlite3.Connection:
+        # the transactions run in worker threads, the first ones may arrive together
+        if not self._created:
+            with self._create_lock:
+                if not self._created:
+                    self._create()
+                    self._created = True
+        return self._open()
+
+    def _transaction(self, key: str, limit: RateLimit, update) -> float:
+        """
+        Runs `update(bucket, now)` on the refilled bucket in one transaction and returns its
+        result. The bucket is a dict with the columns of the table.
+        """
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT requests_per_minute, tokens_per_minute, requests, tokens, updated, "
+                "blocked_until FROM buckets WHERE key = ?",
+                (key,),
+            ).fetchone()
+            now = time.time()
+            if row is None:
+                bucket = {
+                    "requests_per_minute": limit.requests_per_minute,
+                    "tokens_per_minute": limit.tokens_per_minute,
+                    "requests": limit.requests_per_minute,
+                    "tokens": limit.tokens_per_minute,
+                    "updated": now,
+                    "blocked_until": 0.0,
+                }
+            else:
+                bucket = dict(
+                    zip(
+                        (
+                            "requests_per_minute",
+                            "tokens_per_minute",
+                            "requests",
+                            "tokens",
+                            "updated",
+                            "blocked_until",
+                        ),
+                        row,
+                    )
+                )
+                # refill the buckets for the time since the last update
+                elapsed = max(0.0, now - bucket["updated"])
+                for amount, per_minute in (
+                    ("requests", "requests_per_minute"),
+                    ("tokens", "tokens_per_minute"),
+                ):
+                    bucket[amount] = min(
+                        bucket[per_minute],
+                        bucket[amount] + elapsed * bucket[per_minute] / 60,
+                    )
+                bucket["updated"] = now
+            result = update(bucket, now)
+            db.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    bucket["requests_per_minute"],
+                    bucket["tokens_per_minute"],
+                    bucket["requests"],
+                    bucket["tokens"],
+                    bucket["updated"],
+                    bucket["blocked_until"],
+                ),
+            )
+            db.execute("COMMIT")
+            return result
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def _try_acquire(self, key: str, limit: RateLimit, tokens: int) -> float:
+        """Takes one request and the tokens from the buckets, or returns how long to wait."""
+
+        def update(bucket, now):
+            if bucket["blocked_until"] > now:
+                return bucket["blocked_until"] - now
+            # a request larger than the whole bucket has to wait for a full bucket
+            needed = min(tokens, bucket["tokens_per_minute"])
+            if bucket["requests"] >= 1 and bucket["tokens"] >= needed:
+                bucket["requests"] -= 1
+                bucket["tokens"] -= needed
+                return 0.0
+            return max(
+                (1 - bucket["requests"]) * 60 / bucket["requests_per_minute"],
+                (needed - bucket["tokens"]) * 60 / bucket["tokens_per_minute"],
+                0.01,
+            )
+
+        return self._transaction(key, limit, update)
+
+    async def acquire(
+        self, provider: str, model: str, tokens: int, limit: RateLimit | None = None
+    ) -> float:
+        """Waits until the request fits into the budget. Returns the seconds it waited."""
+        key = f"{provider}:{model}"
+        limit = limit or default_limit(provider)
+        start = time.monotonic()
+        queued = False
+        while wait := await asyncio.to_thread(self._try_acquire, key, limit, tokens):
+            queued = True
+            await asyncio.sleep(wait)
+        waited = time.monotonic() - start
+        self.queue_wait.setdefault(key, QueueWait()).add(waited)
+        if queued:
+            logger.info("%s request waited %.2fs in the queue", key, waited)
+        return waited
+
+    async def update_from_headers(
+        self, provider: str, model: str, headers: Mapping[str, str]
+    ):
+        """
+        Corrects the buckets with the rate limit headers of a response (OpenAI's
+        x-ratelimit-*, Anthropic's anthropic-ratelimit-*) and a retry-after.
+        """
+        key = f"{provider}:{model}"
+        limit_requests = _float(
+            _header(
+                headers,
+                "x-ratelimit-limit-requests",
+                "anthropic-ratelimit-requests-limit",
+            )
+        )
+        limit_tokens = _float(
+            _header(
+                headers,
+                "x-ratelimit-limit-tokens",
+                "anthropic-ratelimit-input-tokens-limit",
+                "anthropic-ratelimit-tokens-limit",
+            )
+        )
+        remaining_requests = _float(
+            _header(
+                headers,
+                "x-ratelimit-remaining-requests",
+                "anthropic-ratelimit-requests-remaining",
+            )
+        )
+        remaining_tokens = _float(
+            _header(
+                headers,
+                "x-ratelimit-remaining-tokens",
+                "anthropic-ratelimit-input-tokens-remaining",
+                "anthropic-ratelimit-tokens-remaining",
+            )
+        )
+        reset_requests = _parse_reset(
+            _header(
+                headers,
+                "x-ratelimit-reset-requests",
+                "anthropic-ratelimit-requests-reset",
+            )
+        )
+        reset_tokens = _parse_reset(
+            _header(
+                headers,
+                "x-ratelimit-reset-tokens",
+                "anthropic-ratelimit-input-tokens-reset",
+                "anthropic-ratelimit-tokens-reset",
+            )
+        )
+        retry_after = _float(headers.get("retry-after"))
+        if not any(
+            value is not None
+            for value in (
+                limit_requests,
+                limit_tokens,
+                remaining_requests,
+                remaining_tokens,
+                retry_after,
+            )
+        ):
+            return
+
+        def update(bucket, now):
+            if limit_requests:
+                bucket["requests_per_minute"] = limit_requests
+            if limit_tokens:
+                bucket["tokens_per_minute"] = limit_tokens
+            # the server's count includes the other users of the key
+            if remaining_requests is not None:
+                bucket["requests"] = min(bucket["requests"], remaining_requests)
+                if remaining_requests < 1 and reset_requests:
+                    bucket["blocked_until"] = max(
+                        bucket["blocked_until"], now + reset_requests
+                    )
+            if remaining_tokens is not None:
+                bucket["tokens"] = min(bucket["tokens"], remaining_tokens)
+                if remaining_tokens < 1 and reset_tokens:
+                    bucket["blocked_until"] = max(
+                        bucket["blocked_until"], now + reset_tokens
+                    )
+            if retry_after is not None:
+                bucket["blocked_until"] = max(
+                    bucket["blocked_until"], now + retry_after
+                )
+                bucket["requests"] = 0.0
+
+        await asyncio.to_thread(self._transaction, key, default_limit(provider), update)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        return {
+            key: {
+                "Requests": waits.requests,
+                "Total Wait (s)": round(waits.total, 2),
+                "Max Wait (s)": round(waits.max, 2),
+            }
+            for key, waits in self.queue_wait.items()
+        }
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,155 @@
+"""
+Retry policy for the calls to the LLM APIs. Transient errors (rate limits, overloaded or
+failing servers, timeouts and dropped connections) are retried with exponential backoff and
+full jitter, so sessions that failed at the same time don't retry at the same time. A
+retry-after sent by the server is honoured. Every step of the agent loop has a deadline,
+shared by all its calls (planner, visibility check and executor), after which the last
+error is raised instead of waiting any longer. Calls outside a step (feedback, SUS answers,
+summaries) get the deadline of their provider's policy.
+
+The SDK clients are created with max_retries=0, so their own retries don't add up with these.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import TypeVar
+
+import anthropic
+import httpx
+import openai
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# seconds for all calls of one step of the agent loop together, e.g. STEP_RETRY_DEADLINE=180
+STEP_DEADLINE = float(os.getenv("STEP_RETRY_DEADLINE", "120"))
+
+# 529: Anthropic is overloaded
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    name: str
+    max_attempts: int = 6
+    base_delay: float = 1.0  # seconds, doubled with every attempt
+    max_delay: float = 30.0
+    deadline: float = 120.0  # seconds for all attempts of a call outside a step
+
+    @classmethod
+    def from_env(cls, provider: str) -> "RetryPolicy":
+        """e.g. OPENAI_RETRY_ATTEMPTS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY and
+        OPENAI_RETRY_DEADLINE"""
+        prefix = provider.upper()
+        return cls(
+            name=provider,
+            max_attempts=int(os.getenv(f"{prefix}_RETRY_ATTEMPTS", cls.max_attempts)),
+            base_delay=float(os.getenv(f"{prefix}_RETRY_BASE_DELAY", cls.base_delay)),
+            max_delay=float(os.getenv(f"{prefix}_RETRY_MAX_DELAY", cls.max_delay)),
+            deadline=float(os.getenv(f"{prefix}_RETRY_DEADLINE", cls.deadline)),
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: a random delay up to the exponential backoff of the attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def run(
+        self, call: Callable[[], Awaitable[T]], deadline: float | None = None
+    ) -> T:
+        """
+        Calls `call` until it succeeds, the error isn't transient or the budget is spent.
+        `deadline` is the time.monotonic() of the step's deadline, see step_deadline().
+        Without it, the policy's deadline counts from now.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except Exception as e:
+                attempt += 1
+                if not is_retryable(e) or attempt >= self.max_attempts:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                else:
+                    # the server knows when it recovers, the jitter spreads the sessions out
+                    delay += random.uniform(0, self.base_delay)
+                if time.monotonic() + delay > deadline:
+                    raise
+                logger.warning(
+                    "%s request failed (%s), retry %d/%d in %.1fs",
+                    self.name,
+                    describe(e),
+                    attempt,
+                    self.max_attempts - 1,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(
+        error,
+        (
+            openai.APIConnectionError,  # includes timeouts
+            anthropic.APIConnectionError,
+            httpx.TransportError,
+        ),
+    ):
+        return True
+    if isinstance(error, (openai.APIStatusError, anthropic.APIStatusError)):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+# Function will read how long the server wants us to wait from the error's response
+def retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    if not isinstance(response, httpx.Response):
+        return None
+    if (value := response.headers.get("retry-after-ms")) is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if (value := response.headers.get("retry-after")) is not None:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def describe(error: Exception) -> str:
+    status_code = getattr(error, "status_code", None)
+    return (
+        f"{status_code} {type(error).__name__}" if status_code else type(error).__name__
+    )
+
+
+# Function will return the deadline of a step that starts now, for RetryPolicy.run
+def step_deadline() -> float:
+    return time.monotonic() + STEP_DEADLINE
+
+
+retry_policies: dict[str, RetryPolicy] = {}
+
+
+# Function will return the retry policy of a provider ("openai", "anthropic", "bedrock", ...)
+def retry_policy(provider: str) -> RetryPolicy:
+    if provider not in retry_policies:
+        retry_policies[provider] = RetryPolicy.from_env(provider)
+    return retry_policies[provider]
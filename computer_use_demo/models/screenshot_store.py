@@ -0,0 +1,119 @@
+"""
+The screenshot store keeps every screenshot of a session exactly once. Screenshots are
+addressed by the hash of their content, so all layers (planner, visibility checker,
+executor) can pass the ID around instead of carrying their own base64 copy, and two
+screenshots with the same ID show exactly the same screen.
+The store is bounded and shared by all sessions, so a screenshot that is still referenced
+(e.g. by the planner history) can be evicted while other sessions run. Without a spill
+directory it is gone then, and get_prepared returns None instead of the image.
+Only the newest screenshot keeps its raw pixels, the current step prepares it from them.
+The older ones hold their encoded bytes and the variants already prepared.
+The store is used from worker threads, a lock guards it.
+"""
+
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from PIL import Image
+
+from computer_use_demo.models.image_prep import (
+    ImageConsumer,
+    ImagePipeline,
+    PreparedImage,
+)
+
+
+@dataclass
+class StoredScreenshot:
+    image_id: str
+    pipeline: ImagePipeline
+
+    @property
+    def data(self) -> bytes:
+        return self.pipeline.encoded
+
+
+class ScreenshotStore:
+    """Content addressed screenshot store with a bounded LRU and optional on-disk spill."""
+
+    def __init__(self, max_items: int = 64, spill_dir: str | None = None):
+        self.max_items = max_items
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self._entries: OrderedDict[str, StoredScreenshot] = OrderedDict()
+        self._newest: StoredScreenshot | None = None  # the one that keeps its pixels
+        self._lock = threading.Lock()
+
+    def put(self, image: bytes | str, pixels: Image.Image | None = None) -> str:
+        """
+        Store an encoded image (raw bytes or base64) and return its ID. If the caller
+        still has the raw pixels of the image, passing them avoids decoding it again.
+        """
+        data = base64.b64decode(image) if isinstance(image, str) else image
+        image_id = hashlib.sha256(data).hexdigest()[:32]
+
+        with self._lock:
+            if image_id in self._entries:
+                self._entries.move_to_end(image_id)
+                return image_id
+
+            entry = StoredScreenshot(
+                image_id,
+                ImagePipeline(data, pixels, image if isinstance(image, str) else None),
+            )
+            if self._newest:
+                self._newest.pipeline.release_pixels()
+            self._newest = entry
+            self._entries[image_id] = entry
+            self._evict()
+        return image_id
+
+    def get(self, image_id: str) -> StoredScreenshot:
+        with self._lock:
+            if image_id in self._entries:
+                self._entries.move_to_end(image_id)
+                return self._entries[image_id]
+            path = self._spill_path(image_id)
+            if path and path.exists():
+                entry = StoredScreenshot(image_id, ImagePipeline(path.read_bytes()))
+                self._entries[image_id] = entry
+                self._evict()
+                return entry
+        raise KeyError(f"Unknown screenshot: {image_id}")
+
+    def get_b64(self, image_id: str) -> str:
+        """Return the screenshot as it was captured, base64 encoded."""
+        return self.get(image_id).pipeline.b64_encoded
+
+    def get_prepared(
+        self, image_id: str, consumer: ImageConsumer
+    ) -> PreparedImage | None:
+        """Return the screenshot prepared for the given consumer, None if it is gone."""
+        try:
+            entry = self.get(image_id)
+        except KeyError:
+            return None
+        return entry.pipeline.prepare(consumer)
+
+    def _spill_path(self, image_id: str) -> Path | None:
+        return self.spill_dir / f"{image_id}.png" if self.spill_dir else None
+
+    # Function will spill or drop the least recently used screenshots, with the lock held
+    def _evict(self):
+        while len(self._entries) > self.max_items:
+            image_id, entry = self._entries.popitem(last=False)
+            path = self._spill_path(image_id)
+            if path:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if not path.exists():
+                    path.write_bytes(entry.data)
+
+
+screenshot_store = ScreenshotStore(
+    max_items=int(os.getenv("SCREENSHOT_STORE_SIZE", "64")),
+    spill_dir=os.getenv("SCREENSHOT_SPILL_DIR"),
+)
@@ -0,0 +1,74 @@
+"""
+The verdict cache remembers the answers of the visibility check. The agent often proposes
+the same instruction for an unchanged screen (e.g. in the correction loop or after an
+action without effect), and the check would then make the same vision call again.
+Verdicts are keyed by the screenshot's ID, the hash of its content, and the normalized
+instruction, so a verdict is only reused for exactly the same screen. A perceptual hash
+would also match a screen where the element just changed or disappeared. Verdicts expire
+after a TTL, as the page can change without a visible difference (e.g. a pop up that is
+about to appear), and the least recently used ones are evicted.
+The cache is shared by the sessions of the process, which run in their own threads, so a
+lock guards it. How many checks were answered from it is counted per session, in the
+session's ReportDataHandler.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from computer_use_demo.models.oai_rule import OaiRule
+
+
+# Function will normalize the instruction, so that differences in case, whitespace,
+# punctuation and the "Instruction:" prefix of the first check don't miss the cache
+def normalize_instruction(instruction: str) -> str:
+    instruction = instruction.strip().lower()
+    instruction = re.sub(r"^instruction:\s*", "", instruction)
+    instruction = re.sub(r"[^\w\s]", " ", instruction)
+    return " ".join(instruction.split())
+
+
+class VerdictCache:
+    def __init__(self, ttl: float = 300.0, max_items: int = 256):
+        self.ttl = ttl
+        self.max_items = max_items
+        # (screenshot ID, instruction) -> (verdict, time it was stored)
+        self._verdicts: OrderedDict[tuple[str, str], tuple[OaiRule, float]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def _key(self, image_id: str, instruction: str) -> tuple[str, str]:
+        return image_id, normalize_instruction(instruction)
+
+    def get(self, image_id: str, instruction: str) -> OaiRule | None:
+        key = self._key(image_id, instruction)
+        with self._lock:
+            entry = self._verdicts.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._verdicts[key]
+                entry = None
+            if entry is None:
+                return None
+            self._verdicts.move_to_end(key)
+            return entry[0]
+
+    def put(self, image_id: str, instruction: str, verdict: OaiRule):
+        key = self._key(image_id, instruction)
+        with self._lock:
+            self._verdicts[key] = (verdict, time.monotonic())
+            self._verdicts.move_to_end(key)
+            while len(self._verdicts) > self.max_items:
+                self._verdicts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._verdicts.clear()
+
+
+verdict_cache = VerdictCache(
+    ttl=float(os.getenv("VERDICT_CACHE_TTL", "300")),
+    max_items=int(os.getenv("VERDICT_CACHE_SIZE", "256")),
+)
@@ -1,19 +1,51 @@
-from openai import OpenAI, RateLimitError
+import asyncio
 import base64
-from io import BytesIO
-from typing import Any
-import re
-from models.sender import Sender
-from models.sus_classes import SUSQuestion, SUSAnswer, get_question_by_number
-from models.data_handler import ReportDataHandler
-from computer_use_demo.models.oai_rule import OaiRule
-from computer_use_demo.models.firefox_connect import get_firefox_current_url
+import logging
 import os
+import re
 import time
-from computer_use_demo.models.image_prep import prep_image
+import weakref
+from collections.abc import Awaitable, Callable
+from io import BytesIO
+from typing import TYPE_CHECKING
+
+from models.sender import Sender
+from models.sus_classes import SUSAnswer, SUSQuestion, get_question_by_number
+from openai import NOT_GIVEN, AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError
 from PIL import Image
 
-openai_client = OpenAI()
+from computer_use_demo.models.firefox_connect import get_firefox_current_url
+from computer_use_demo.models.history import Summarizer
+from computer_use_demo.models.http_pool import pool_limits
+from computer_use_demo.models.image_prep import ImageConsumer
+from computer_use_demo.models.metering import Meter, openai_usage
+from computer_use_demo.models.oai_rule import OaiRule
+from computer_use_demo.models.planner_response import (
+    RESPONSE_FORMAT,
+    STRUCTURED_OUTPUT_PROMPT,
+    ParseStats,
+    PlannerResponseError,
+    complete_field,
+    parse_response,
+)
+from computer_use_demo.models.rate_limiter import (
+    IMAGE_TOKENS,
+    count_content,
+    estimate_tokens,
+    rate_limiter,
+)
+from computer_use_demo.models.retry import retry_policy
+from computer_use_demo.models.screenshot_store import screenshot_store
+from computer_use_demo.models.verdict_cache import verdict_cache
+
+if TYPE_CHECKING:
+    from computer_use_demo.session import SessionContext
+
+logger = logging.getLogger(__name__)
+
+# One client per event loop, as the pooled connections of an async client are bound to the
+# loop they were opened in. Streamlit starts a new loop for every run of the script.
+openai_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
 SYSTEM_PROMPT = """
 You are subject of an important study where you are testing a new website on usability. You will be given a series of tasks to complete on the website using a series of screenshots. For each screenshot, you need to give clear instructions regarding what action to take next, while also noting aspects of usability. All actions must be atomic, using one of the following: click, hover, scroll, press a button, or type. If you need to see more of the page to understand its elements, make sure to scroll accordingly. In addition, you should be prepared to answer the System Usability Scale (SUS) questionnaire at the end to evaluate the overall user experience, taking into account all performed tasks.
 
@@ -125,9 +157,13 @@ If the instruction is to scroll or nothing/empty, always answer with "Yes"
 Look at the whole picture. If you are wrong, you die. 
 """
 CONTINUATION_PROMPT = "You failed at completing the last task."
+SUMMARY_PROMPT = """
+You keep the notes of an AI agent that tests a website on usability. You get the notes so far and the next turns of the conversation between the test leader and the agent. Update the notes with the new turns and return only the updated notes.
+Keep: the tasks and whether they were completed, the pages and elements the agent visited and what it found there, actions that didn't work, the usability notes, flags and the feedback on the tasks. They are needed to answer the System Usability Scale questionnaire at the end.
+Drop: the chain of thought and the descriptions of the screenshots. Keep the notes under 400 words.
+"""
 MODEL = "gpt-4o"
 MAX_TOKENS = 1000
-OPENAI_MOCK_INDEX = 0
 MOCK_SUS_RESULT = """
     Chain of Thought: (Reflecting on my experience, I found the website generally intuitive, though there were several areas where accessibility could be improved. Navigation was mostly logical, but design inconsistencies and usability flaws like unclear buttons and small click areas impacted the experience.)
 
@@ -205,8 +241,15 @@ Reflect on your experience before providing each answer.
 Make sure you consider both your negative and positive experiences with the website when answering the SUS questions.
 """
 
-messages = []
 mock_oai: bool = os.getenv("MOCK_OPENAI", 0) == "1"
+# The planner's response is streamed and its instruction checked and executed as soon as
+# it is complete. STREAMING_PLANNER=0 waits for the whole response.
+streaming_planner: bool = os.getenv("STREAMING_PLANNER", "1") == "1"
+# PLANNER_PROTOCOL=json asks the planner for JSON-schema structured output instead of the
+# <instruction> [info] (reflection) {notes} !!flag!! text protocol. Mock responses use text.
+structured_planner: bool = (
+    os.getenv("PLANNER_PROTOCOL", "text") == "json" and not mock_oai
+)
 mock_responses = [
     """
     Instruction: <Click on the search bar>
@@ -235,12 +278,120 @@ mock_responses = [
 ]
 
 
+def get_openai_client() -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    if loop not in openai_clients:
+        openai_clients[loop] = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(limits=pool_limits("OPENAI")),
+            max_retries=0,  # retried by the retry policy
+        )
+    return openai_clients[loop]
+
+
+# Function will send a chat completion request once the shared rate limiter lets it through
+# and correct the limiter with the rate limit headers of the response
+async def create_completion(
+    messages: list[dict],
+    temperature: float,
+    response_format: dict | None = None,
+    meter: Meter | None = None,
+    purpose: str = "planner",
+):
+    queue_wait = await rate_limiter.acquire(
+        "openai", MODEL, estimate_tokens(messages, MAX_TOKENS)
+    )
+    start = time.perf_counter()
+    try:
+        raw_response = (
+            await get_openai_client().chat.completions.with_raw_response.create(
+                model=MODEL,
+                messages=messages,
+                max_tokens=MAX_TOKENS,
+                temperature=temperature,
+                response_format=response_format or NOT_GIVEN,
+            )
+        )
+    except RateLimitError as e:
+        # the next acquire waits until the limit resets, in all sessions
+        await rate_limiter.update_from_headers("openai", MODEL, e.response.headers)
+        raise
+    await rate_limiter.update_from_headers("openai", MODEL, raw_response.headers)
+    response = raw_response.parse()
+    if meter and response.usage:
+        meter(
+            openai_usage(
+                response.usage,
+                model=MODEL,
+                purpose=purpose,
+                image_tokens=count_content(messages)[1] * IMAGE_TOKENS,
+                latency=time.perf_counter() - start,
+                queue_wait=queue_wait,
+            )
+        )
+    return response
+
+
+# Function will stream a chat completion like create_completion and call `on_text` with the
+# text received so far after every chunk. Returns the whole text.
+async def stream_completion(
+    messages: list[dict],
+    temperature: float,
+    on_text: Callable[[str], None],
+    response_format: dict | None = None,
+    meter: Meter | None = None,
+    purpose: str = "planner",
+) -> str:
+    queue_wait = await rate_limiter.acquire(
+        "openai", MODEL, estimate_tokens(messages, MAX_TOKENS)
+    )
+    start = time.perf_counter()
+    try:
+        raw_response = (
+            await get_openai_client().chat.completions.with_raw_response.create(
+                model=MODEL,
+                messages=messages,
+                max_tokens=MAX_TOKENS,
+                temperature=temperature,
+                response_format=response_format or NOT_GIVEN,
+                stream=True,
+                # the usage comes with an extra chunk at the end
+                stream_options={"include_usage": True},
+            )
+        )
+    except RateLimitError as e:
+        # the next acquire waits until the limit resets, in all sessions
+        await rate_limiter.update_from_headers("openai", MODEL, e.response.headers)
+        raise
+    await rate_limiter.update_from_headers("openai", MODEL, raw_response.headers)
+    text = ""
+    usage = None
+    async for chunk in raw_response.parse():
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            on_text(text)
+    if meter and usage:
+        meter(
+            openai_usage(
+                usage,
+                model=MODEL,
+                purpose=purpose,
+                image_tokens=count_content(messages)[1] * IMAGE_TOKENS,
+                latency=time.perf_counter() - start,
+                queue_wait=queue_wait,
+            )
+        )
+    return text or "No Message"
+
+
 # Generates the SUS answers and adds them to the report data
-def generate_sus_answers(data_handler: ReportDataHandler):
+async def generate_sus_answers(session: "SessionContext"):
+    data_handler = session.data_handler
     if mock_oai:
         sus_response = MOCK_SUS_RESULT
     else:
-        sus_response = send_message(SUS_PROMPT)
+        sus_response = await send_message(session, SUS_PROMPT, purpose="sus")
 
     sus_response_parts = extract_sus_response_parts(sus_response)
 
@@ -252,29 +403,31 @@ def generate_sus_answers(data_handler: ReportDataHandler):
         )  # Adds specific SUS answer to the report data
 
 
-# Function will get the next instruction from the OpenAI assistant
-def get_next_instruction(
+# Function will get the next instruction from the OpenAI assistant. The URL lookup runs
+# while the assistant is thinking, it can also be started earlier by the caller.
+async def get_next_instruction(
+    session: "SessionContext",
     text: str,
-    report_data: ReportDataHandler,
     render_message,
     container,
-    b64_image: str = "",
+    image_id: str = "",
+    current_url: Awaitable[str | None] | None = None,
+    speculate: Callable[[str], asyncio.Task | None] | None = None,
+    deadline: float | None = None,
 ) -> str:
-    if len(messages) >= 8:
-        index = len(messages) - 8
-        for i in range(0, index):
-            message = messages[i]
-            if message["role"] == "user" and len(message["content"]) > 1:
-                message["content"].pop(1)
-            messages[i] = message
-
-    current_url = get_firefox_current_url()
-    message_response = send_message(text, b64_image)
-    response_parts = extract_response_parts(message_response)
-
-    correction = check_instruction(
-        f"Instruction: {response_parts['instruction']}. {response_parts['additional_info']}",
-        b64_image,
+    report_data = session.data_handler
+    if current_url is None:
+        current_url = asyncio.create_task(
+            asyncio.to_thread(get_firefox_current_url, session.debugging_port)
+        )
+    response_parts, correction, verdict_cached = await request_checked_instruction(
+        session,
+        text,
+        image_id,
+        lambda parts: f"Instruction: {parts['instruction']}. {parts['additional_info']}",
+        speculate,
+        last_try=False,
+        deadline=deadline,
     )
 
     correction_tries = 0
@@ -284,12 +437,14 @@ def get_next_instruction(
         render_message(
             sender=Sender.USER, message=correction_message, container=container
         )
-        message_response = send_message(correction_message, b64_image)
-        response_parts = extract_response_parts(message_response)
-
-        correction = check_instruction(
-            f"{response_parts['instruction']}. {response_parts['additional_info']}",
-            b64_image,
+        response_parts, correction, verdict_cached = await request_checked_instruction(
+            session,
+            correction_message,
+            image_id,
+            lambda parts: f"{parts['instruction']}. {parts['additional_info']}",
+            speculate,
+            last_try=correction_tries == 2,
+            deadline=deadline,
         )
 
     if contains_click_or_scroll_or_press(response_parts["instruction"]):
@@ -301,18 +456,129 @@ def get_next_instruction(
         self_reflection=response_parts["self_reflection"],
         usability_notes=response_parts["usability_notes"],
         flag=response_parts["flag"],
-        current_url=current_url or "",
-    )
-    instruction = (
-        f"{response_parts['instruction']} -> {response_parts['additional_info']}"
+        current_url=(await current_url) or "",
+        verdict_cached=verdict_cached,
     )
+    instruction = format_instruction(response_parts)
     render_message(sender=Sender.OPENAI, message=instruction, container=container)
     return instruction
 
 
-def give_feedback(feedback: dict[str, str], render_message, container):
+# Function will send the message and run the visibility check of the instruction in the
+# response. While streaming, the check (and with it the speculative execution) starts as
+# soon as the instruction and its additional info are complete, while the reflection and
+# usability notes are still being generated.
+# Returns the parsed response, the verdict and whether it came from the verdict cache.
+async def request_checked_instruction(
+    session: "SessionContext",
+    text: str,
+    image_id: str,
+    check_text: Callable[[dict[str, str]], str],
+    speculate: Callable[[str], asyncio.Task | None] | None,
+    last_try: bool,
+    deadline: float | None = None,
+) -> tuple[dict[str, str], OaiRule, bool]:
+    early_parts: dict[str, str] | None = None
+    early_check: asyncio.Task | None = None
+
+    def on_instruction(parts: dict[str, str]):
+        nonlocal early_parts, early_check
+        # a retried stream reports its instruction again, it may be a different one
+        if early_check:
+            early_check.cancel()
+        early_parts = parts
+        early_check = asyncio.create_task(
+            check_speculatively(
+                check_text(parts),
+                parts,
+                image_id,
+                speculate,
+                last_try,
+                session.data_handler.record_usage,
+                deadline,
+            )
+        )
+
+    try:
+        message_response = await send_message(
+            session,
+            text,
+            image_id,
+            on_instruction,
+            structured_planner,
+            deadline=deadline,
+        )
+        response_parts = parse_planner_response(
+            message_response, structured_planner, session.data_handler.parse_stats
+        )
+        if early_check and all(
+            early_parts[key] == response_parts[key] for key in early_parts
+        ):
+            correction, verdict_cached = await early_check
+        else:
+            if early_check:
+                early_check.cancel()
+            correction, verdict_cached = await check_speculatively(
+                check_text(response_parts),
+                response_parts,
+                image_id,
+                speculate,
+                last_try,
+                session.data_handler.record_usage,
+                deadline,
+            )
+    except BaseException:
+        if early_check:
+            early_check.cancel()
+        raise
+    session.data_handler.record_verdict(verdict_cached)
+    return response_parts, correction, verdict_cached
+
+
+# Function will format the parsed response as the instruction for the executor
+def format_instruction(response_parts: dict[str, str]) -> str:
+    return f"{response_parts['instruction']} -> {response_parts['additional_info']}"
+
+
+# Function will run the visibility check of the instruction. With `speculate`, the execution
+# of the instruction is started at the same time and cancelled if the check fails, so the
+# executor request no longer waits for the check. On the last try the instruction is used
+# whatever the check says, so its execution is kept.
+# Returns the verdict and whether it came from the verdict cache.
+async def check_speculatively(
+    check_text: str,
+    response_parts: dict[str, str],
+    image_id: str,
+    speculate: Callable[[str], asyncio.Task | None] | None,
+    last_try: bool,
+    meter: Meter | None = None,
+    deadline: float | None = None,
+) -> tuple[OaiRule, bool]:
+    correction = verdict_cache.get(image_id, check_text) if image_id else None
+    if correction is not None:
+        if speculate and (correction == OaiRule.OK or last_try):
+            speculate(format_instruction(response_parts))
+        return correction, True
+
+    execution = speculate(format_instruction(response_parts)) if speculate else None
+    try:
+        correction = await check_instruction(check_text, image_id, meter, deadline)
+    except BaseException:
+        if execution:
+            execution.cancel()
+        raise
+    if image_id:
+        verdict_cache.put(image_id, check_text, correction)
+    if correction != OaiRule.OK and not last_try and execution:
+        execution.cancel()
+    return correction, False
+
+
+async def give_feedback(
+    session: "SessionContext", feedback: dict[str, str], render_message, container
+):
     feedback_message = f"You {feedback['status']} at the last task. {feedback['text']}. Reflect on your experience, and take notes regarding your expectation, surprises and usability. Then await your next instruction"
-    send_message(feedback_message)
+    await send_message(session, feedback_message, purpose="feedback")
     message_suffix = (
         "Success:" if feedback["status"] == "were successful" else "Failure:"
     )
@@ -321,42 +587,107 @@ def give_feedback(feedback: dict[str, str], render_message, container):
     return message_text
 
 
-# Function will send a message to the OpenAI assistant and return the response
-def send_message(text: str, b64_image: str = "") -> str:
-    tries = 0
-    rate_limit_tries = 0
-    add_message(Sender.USER, text, b64_image)
+# Function will send a message to the OpenAI assistant and return the response. With
+# streaming, `on_instruction` is called with the instruction and additional info as soon
+# as both are complete, before the rest of the response. `structured` requests the
+# JSON-schema answer of the structured planner protocol. The usage of the call is recorded
+# in the session's report as `purpose` (planner, feedback or sus). `deadline` is the retry
+# deadline of the step, see models/retry.py
+async def send_message(
+    session: "SessionContext",
+    text: str,
+    image_id: str = "",
+    on_instruction: Callable[[dict[str, str]], None] | None = None,
+    structured: bool = False,
+    purpose: str = "planner",
+    deadline: float | None = None,
+) -> str:
+    history = session.planner_history
+    add_message(session, Sender.USER, text, image_id)
+    response_format = RESPONSE_FORMAT if structured else None
     response_text = ""
     if mock_oai:
-        response_text = get_mock_response()
+        response_text = get_mock_response(session)
     else:
-        while tries < 2:
-            try:
-                response = openai_client.chat.completions.create(
-                    model=MODEL,
-                    messages=messages,
-                    max_tokens=MAX_TOKENS,
-                    temperature=0.7,
+        try:
+            messages = resolve_images(
+                await history.request_messages(summarizer(session))
+            )
+            # transient errors are retried with backoff within the step's deadline
+            if streaming_planner and on_instruction:
+                response_text = await retry_policy("openai").run(
+                    lambda: stream_completion(
+                        messages,
+                        temperature=0.7,
+                        on_text=InstructionStream(on_instruction, structured).feed,
+                        response_format=response_format,
+                        meter=session.data_handler.record_usage,
+                        purpose=purpose,
+                    ),
+                    deadline,
+                )
+            else:
+                response = await retry_policy("openai").run(
+                    lambda: create_completion(
+                        messages,
+                        temperature=0.7,
+                        response_format=response_format,
+                        meter=session.data_handler.record_usage,
+                        purpose=purpose,
+                    ),
+                    deadline,
                 )
-                response_text: str = response.choices[0].message.content or "No Message"
-                tries = 2
-            except RateLimitError as rle:
-                if rate_limit_tries >= 2:
-                    raise rle
-                rate_limit_tries += 1
-                print(f"Rate limit reached. Retrying in 30 seconds...")
-                rate_limit_tries += 1
-                time.sleep(30)
-
-            except Exception as e:
-                tries += 1
-                if tries >= 2:
-                    raise e
-    add_message(Sender.BOT, response_text)
+                response_text = response.choices[0].message.content or "No Message"
+        except asyncio.CancelledError:
+            # don't leave the unanswered message in the conversation
+            history.pop()
+            raise
+    add_message(session, Sender.BOT, response_text)
+    # fold the turns that left the window while the executor works on the instruction
+    history.compact(None if mock_oai else summarizer(session))
     return response_text
 
 
-def check_instruction(instruction: str, image: str) -> OaiRule:
+# Function will return the summarizer of the session's planner history. It folds the
+# turns that left the window into the notes of the planner, see models/history.py
+def summarizer(session: "SessionContext") -> Summarizer:
+    async def summarize(summary: str, turns: list[dict]) -> str:
+        transcript = "\n\n".join(
+            f"{message['role']}: {message_text(message)}" for message in turns
+        )
+        response = await retry_policy("openai").run(
+            lambda: create_completion(
+                [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {
+                        "role": "user",
+                        "content": f"Notes so far:\n{summary or 'None'}\n\nNext turns:\n{transcript}",
+                    },
+                ],
+                temperature=0.2,
+                meter=session.data_handler.record_usage,
+                purpose="summary",
+            )
+        )
+        return response.choices[0].message.content or summary
+
+    return summarize
+
+
+# Function will return the text parts of a message
+def message_text(message: dict) -> str:
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return "\n".join(part["text"] for part in content if part["type"] == "text")
+
+
+async def check_instruction(
+    instruction: str,
+    image_id: str,
+    meter: Meter | None = None,
+    deadline: float | None = None,
+) -> OaiRule:
     hist = []
     hist.append(
         {
@@ -377,18 +708,13 @@ def check_instruction(instruction: str, image: str) -> OaiRule:
                     "type": "text",
                     "text": f"{instruction}",
                 },
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{image}"},
-                },
+                image_url_part(image_id, ImageConsumer.CHECKER),
             ],
         }
     )
-    response = openai_client.chat.completions.create(
-        model=MODEL,
-        messages=hist,
-        max_tokens=MAX_TOKENS,
-        temperature=0.8,
+    response = await retry_policy("openai").run(
+        lambda: create_completion(hist, temperature=0.8, meter=meter, purpose="check"),
+        deadline,
     )
     response_text: str = response.choices[0].message.content or "No Message"
     response_text = response_text.lower()
@@ -399,7 +725,7 @@ def check_instruction(instruction: str, image: str) -> OaiRule:
 
 
 # Function will upload the image to OpenAI and return the file ID
-def upload_image(b64_image: str):
+async def upload_image(b64_image: str):
     print("Uploading image...")
 
     # Convert the base64 string to a file
@@ -409,7 +735,7 @@ def upload_image(b64_image: str):
     image = Image.open(image_file)
     width, height = image.size
 
-    file = openai_client.files.create(file=image_file, purpose="vision")
+    file = await get_openai_client().files.create(file=image_file, purpose="vision")
     print("Image uploaded")
     return file
 
@@ -434,31 +760,29 @@ def save_bytesio_to_file(bytes_io_obj):
         print(f"Failed to save the file: {e}")
 
 
-def reset_openai():
-    messages.append(
-        {
-            "role": "system",
-            "content": SYSTEM_PROMPT,
-        }
-    )
+def reset_openai(session: "SessionContext"):
+    prompt = SYSTEM_PROMPT + (STRUCTURED_OUTPUT_PROMPT if structured_planner else "")
+    # every task starts with a reset, the system prompt is only needed once
+    history = session.planner_history
+    if not any(message["content"] == prompt for message in history.system_messages()):
+        history.append({"role": "system", "content": prompt})
 
 
 def contains_click_or_scroll_or_press(text: str) -> bool:
     return bool(re.search(r"\b(click|scroll|press)\b", text, re.IGNORECASE))
 
 
-def get_mock_response() -> str:
-    global OPENAI_MOCK_INDEX
-    global mock_responses
-    response = mock_responses[OPENAI_MOCK_INDEX % 4]
-    OPENAI_MOCK_INDEX += 1
+def get_mock_response(session: "SessionContext") -> str:
+    response = mock_responses[session.mock_index % 4]
+    session.mock_index += 1
     return response
 
 
-# Function will add a message to the conversation
-def add_message(role: str, text: str, b64_image: str = ""):
-    if b64_image:
-        image = prep_image(b64_image)
+# Function will add a message to the conversation. Images are only referenced by their
+# screenshot store ID and resolved when the request is sent, see resolve_images
+def add_message(session: "SessionContext", role: str, text: str, image_id: str = ""):
+    messages = session.planner_history
+    if image_id:
         messages.append(
             {
                 "role": role,
@@ -468,8 +792,8 @@ def add_message(role: str, text: str, b64_image: str = ""):
                         "text": text,
                     },
                     {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{image}"},
+                        "type": "image_ref",
+                        "image_id": image_id,
                     },
                 ],
             }
@@ -488,6 +812,37 @@ def add_message(role: str, text: str, b64_image: str = ""):
         )
 
 
+# Function will replace the image references of the conversation with the prepared images
+def resolve_images(conversation: list[dict]) -> list[dict]:
+    resolved = []
+    for message in conversation:
+        content = message["content"]
+        if isinstance(content, list) and any(
+            part["type"] == "image_ref" for part in content
+        ):
+            content = [
+                image_url_part(part["image_id"], ImageConsumer.PLANNER)
+                if part["type"] == "image_ref"
+                else part
+                for part in content
+            ]
+            message = {**message, "content": content}
+        resolved.append(message)
+    return resolved
+
+
+# Function will return the message part of the screenshot, or a text part if the capture
+# produced no screenshot (the image ID is empty then) or it was evicted from the store
+def image_url_part(image_id: str, consumer: ImageConsumer) -> dict:
+    image = screenshot_store.get_prepared(image_id, consumer) if image_id else None
+    if image is None:
+        return {"type": "text", "text": "No screenshot of the screen is available."}
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:{image.media_type};base64,{image.data}"},
+    }
+
+
 """
 Extraction methods to parse the response from OpenAI and put them into a format that is usable
 """
@@ -504,6 +859,60 @@ def extract_response_parts(text: str) -> dict[str, str]:
     }
 
 
+# Function will parse the planner's answer to an instruction request. A structured answer
+# that doesn't parse is counted in the session's `stats` and read with the regexes of the
+# text protocol instead.
+def parse_planner_response(
+    text: str, structured: bool, stats: ParseStats
+) -> dict[str, str]:
+    if not structured:
+        return extract_response_parts(text)
+    try:
+        response_parts = parse_response(text)
+    except PlannerResponseError as e:
+        stats.failures += 1
+        logger.warning("%s. Falling back to the text protocol.", e)
+        return extract_response_parts(text)
+    stats.parsed += 1
+    return response_parts
+
+
+class InstructionStream:
+    """
+    Incremental extraction of the instruction <...> and the additional info [...] from a
+    streamed response. `.` doesn't match line breaks, so once the first match of a pattern
+    is complete in the received text, it is also the first match of the whole response.
+    Structured responses are read field by field once their JSON strings are complete.
+    """
+
+    def __init__(
+        self, on_instruction: Callable[[dict[str, str]], None], structured: bool = False
+    ):
+        self.on_instruction = on_instruction
+        self.structured = structured
+        self.done = False
+
+    def feed(self, text: str):
+        if self.done:
+            return
+        if self.structured:
+            instruction = complete_field(text, "instruction")
+            additional_info = complete_field(text, "additional_info")
+        else:
+            instruction = match_group(r"<(.*?)>", text)
+            additional_info = match_group(r"\[(.*?)\]", text)
+        if instruction is not None and additional_info is not None:
+            self.done = True
+            self.on_instruction(
+                {"instruction": instruction, "additional_info": additional_info}
+            )
+
+
+def match_group(pattern: str, text: str) -> str | None:
+    match = re.search(pattern, text)
+    return match.group(1) if match else None
+
+
 # Function will extract the different parts of the SUS response
 def extract_sus_response_parts(text: str) -> dict[str, int]:
     pattern = r"(\d+):\s*(.*?)\s*->\s*(\d+)"
@@ -514,10 +923,6 @@ def extract_sus_response_parts(text: str) -> dict[str, int]:
     return responses
 
 
-def get_messages():
-    return messages
-
-
 # Function will extract the instruction from the text
 def extract_instruction(text: str):
     match = re.search(r"<(.*?)>", text)
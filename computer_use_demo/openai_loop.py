@@ -1,31 +1,32 @@
+import asyncio
+import os
+from collections.abc import Awaitable, Callable
 from typing import Any, cast
-import streamlit as st
-from functools import partial
-from computer_use_demo import oai as OaiTool
-from computer_use_demo.anthropic_access import sampling_loop
-from tools.ant import prep_execution_request
-
-import time
-from anthropic.types.beta import BetaMessageParam
 
+import httpx
+from anthropic.types.beta import BetaContentBlockParam, BetaMessageParam
 from models.sender import Sender
+from tools import ToolCollection, ToolResult
+from tools.ant import prep_execution_request
 
-import requests
+from computer_use_demo import oai as OaiTool
+from computer_use_demo.anthropic_access import ExecutorSettings, executor
+from computer_use_demo.models.firefox_connect import get_firefox_current_url
+from computer_use_demo.models.instruction_compiler import compile_instruction
+from computer_use_demo.models.metering import CallUsage
+from computer_use_demo.models.retry import step_deadline
+from computer_use_demo.models.screenshot_store import screenshot_store
+from computer_use_demo.session import SessionContext
 
-from tools import (
-    BashTool,
-    ComputerTool,
-    EditTool,
-    ToolCollection,
-    ToolResult,
-)
+# In the pipelined mode the executor request of an instruction starts while the planner's
+# visibility check is still running, instead of after it. PIPELINED_PLANNING=0 turns it off.
+pipelined_planning: bool = os.getenv("PIPELINED_PLANNING", "1") == "1"
 
+# Trivial instructions (scroll, press a key, type, wait) are executed without the LLM
+# executor. FAST_PATH_EXECUTION=0 sends every instruction to the LLM.
+fast_path_execution: bool = os.getenv("FAST_PATH_EXECUTION", "1") == "1"
 
-tool_collection = ToolCollection(
-    ComputerTool(),
-    BashTool(),
-    EditTool(),
-)
+LAST_INSTRUCTION_PATTERNS = ["completed->", "failed->", "->", "nothing->"]
 
 PROMPT_ADDITION = """
 Reflection Reminder:
@@ -37,97 +38,190 @@ You can only interact with elements that are visible. If you can't see an elemen
 
 
 async def custom_loop(
+    session: SessionContext,
     mission: str,
-    messages: list[BetaMessageParam],
+    settings: ExecutorSettings,
     context,
-    exchange_logs,
-    _render_message,
-    _tool_output_callback,
-    _api_response_callback,
+    render_message,
+    output_callback: Callable[[BetaContentBlockParam], None],
+    tool_output_callback: Callable[[ToolResult, str], None],
+    api_response_callback: Callable[
+        [httpx.Request, httpx.Response | object | None, Exception | None], None
+    ],
+    checkpoint: Callable[[], Awaitable[None]] | None = None,
 ):
+    """
+    Runs one task of the session until the assistant declares it completed or failed.
+    All state is passed in, so the loop runs the same in the Streamlit app and in the
+    batch runner, and several sessions can run at the same time.
+    `render_message(sender=..., message=..., container=context)` shows the assistant's
+    messages, the callbacks receive the executor's answers, tool results and API errors.
+    `checkpoint` is awaited before every step, e.g. to hold the loop while it is paused.
+    """
     manual_mode = False
     first = True  # First iteration of the loop
+    previous_screenshot_id = ""
+    messages = session.messages
+    data_handler = session.data_handler
+    tool_collection = session.tool_collection
     # Initialize the OpenAI assistant
-    OaiTool.reset_openai()
+    OaiTool.reset_openai(session)
+
+    def request_params(
+        prepped_messages: list[BetaMessageParam], deadline: float
+    ) -> dict[str, Any]:
+        return dict(
+            system_prompt_suffix=settings.system_prompt_suffix,
+            model=settings.model,
+            provider=settings.provider,
+            prepped_messages=prepped_messages,
+            api_response_callback=api_response_callback,
+            api_key=settings.api_key,
+            only_n_most_recent_images=settings.only_n_most_recent_images,
+            tool_collection=tool_collection,
+            meter=executor_usage.append,
+            deadline=deadline,
+        )
 
     while True:
-        screenshot = await get_base64_screenshot()
+        if checkpoint:
+            await checkpoint()
+        # the planner, check and executor calls of the step share one retry budget
+        deadline = step_deadline()
+        # look up the URL while the screenshot is taken and the assistant is thinking
+        current_url = asyncio.create_task(
+            asyncio.to_thread(get_firefox_current_url, session.debugging_port)
+        )
+        screenshot_id = await get_screenshot_id(tool_collection)
+        # the IDs are content hashes, so an equal ID means not a single pixel changed
+        if screenshot_id and screenshot_id == previous_screenshot_id:
+            # the last action had no visible effect, e.g. scrolling at the end of the page
+            data_handler.mark_screen_unchanged()
+        previous_screenshot_id = screenshot_id
+        # usage of the executor requests of this step, also of the discarded speculative ones
+        executor_usage: list[CallUsage] = []
+        # executor requests started for the instructions of this step, by instruction
+        speculative_requests: dict[
+            str, tuple[list[BetaMessageParam], asyncio.Task]
+        ] = {}
+
+        # the step's screenshot and requests are bound now, the loop rebinds the names
+        def speculate(
+            instruction: str,
+            screenshot_id: str = screenshot_id,
+            speculative_requests: dict[
+                str, tuple[list[BetaMessageParam], asyncio.Task]
+            ] = speculative_requests,
+            deadline: float = deadline,
+        ) -> asyncio.Task | None:
+            if (
+                manual_mode
+                or is_last_instruction(instruction)
+                or (fast_path_execution and compile_instruction(instruction))
+            ):
+                return None
+            prepped_messages = prep_execution_request(instruction, screenshot_id)
+            task = asyncio.create_task(
+                executor.request_action(**request_params(prepped_messages, deadline))
+            )
+            speculative_requests[instruction] = (prepped_messages, task)
+            return task
+
         prompt = (
             f"New Task: {mission}"
             if first
             else f"What's the next step? As a reminder, this is the current task: {mission}"
         )
-        instruction: str = OaiTool.get_next_instruction(
-            f"{prompt}. {PROMPT_ADDITION}",
-            st.session_state.data_handler,
-            _render_message,
-            context,
-            screenshot,
-        )  # Get the next instruction from the OpenAI assistant
-        st.session_state.messages.append(
+        try:
+            instruction: str = await OaiTool.get_next_instruction(
+                session,
+                f"{prompt}. {PROMPT_ADDITION}",
+                render_message,
+                context,
+                screenshot_id,
+                current_url,
+                speculate if pipelined_planning else None,
+                deadline,
+            )  # Get the next instruction from the OpenAI assistant
+        except BaseException:
+            for _, task in speculative_requests.values():
+                task.cancel()
+            raise
+        # only the request of the final instruction is used, drop the others
+        speculative_request = speculative_requests.pop(instruction, None)
+        for _, task in speculative_requests.values():
+            task.cancel()
+        messages.append(
             {"role": Sender.OPENAI, "content": [{"type": "text", "text": instruction}]}
         )
-        # messages.append(
-        #     {"role": "assistant", "content": [{"type": "text", "text": instruction}]}
-        # )
-        # Define the patterns to check
-        last_instruction = False
-        patterns = ["completed->", "failed->", "->", "nothing->"]
-        instruction_copy = instruction
-        instruction_copy = "".join(instruction_copy.lower().split())
-        # Check which pattern the string starts with
-        for pattern in patterns:
-            if (instruction_copy).startswith(pattern):
-                last_instruction = True
-
-        if last_instruction:  # Mission is completed or failed
-            # Show Feedback pop-up
-            st.session_state.popup = True
+        if is_last_instruction(instruction):  # Mission is completed or failed
             break
         # Execute the instruction
-        prepped_messages: list[BetaMessageParam] = prep_execution_request(
-            instruction, screenshot
-        )
+        compiled = compile_instruction(instruction) if fast_path_execution else None
         if manual_mode:
-            time.sleep(4)
+            await asyncio.sleep(4)
+        elif compiled:
+            await executor.execute_compiled(
+                compiled=compiled,
+                provider=settings.provider,
+                messages=messages,
+                output_callback=output_callback,
+                tool_output_callback=tool_output_callback,
+                only_n_most_recent_images=settings.only_n_most_recent_images,
+                tool_collection=tool_collection,
+                step_delay=settings.step_delay,
+                image_index=session.image_index,
+            )
+            data_handler.mark_fast_path()
         else:
-            await sampling_loop(
-                system_prompt_suffix=st.session_state.custom_system_prompt,
-                model=st.session_state.model,
-                provider=st.session_state.provider,
-                messages=st.session_state.messages,
+            # cancelling() also counts a cancel that the task has not processed yet, e.g.
+            # from a failed visibility check; awaiting such a task would raise
+            # CancelledError out of the loop
+            if speculative_request and not speculative_request[1].cancelling():
+                prepped_messages, task = speculative_request
+                response_params = await task
+            else:
+                prepped_messages: list[BetaMessageParam] = prep_execution_request(
+                    instruction, screenshot_id
+                )
+                response_params = await executor.request_action(
+                    **request_params(prepped_messages, deadline)
+                )
+            await executor.execute_action(
+                response_params=response_params,
+                provider=settings.provider,
+                messages=messages,
                 prepped_messages=prepped_messages,
-                output_callback=partial(
-                    _render_message, sender=Sender.ANTHROPIC, container=context
-                ),
-                tool_output_callback=partial(
-                    _tool_output_callback,
-                    tool_state=st.session_state.tools,
-                    context=context,
-                ),
-                api_response_callback=partial(
-                    _api_response_callback,
-                    tab=exchange_logs,
-                    response_state=st.session_state.responses,
-                ),
-                api_key=st.session_state.api_key,
-                only_n_most_recent_images=st.session_state.only_n_most_recent_images,
+                output_callback=output_callback,
+                tool_output_callback=tool_output_callback,
+                only_n_most_recent_images=settings.only_n_most_recent_images,
+                tool_collection=tool_collection,
+                step_delay=settings.step_delay,
+                image_index=session.image_index,
             )
+        for usage in executor_usage:
+            data_handler.record_action_usage(usage)
         first = False
 
-    return st.session_state.messages
-    # Get specific instructions for the action // Call Anthropic API with openAI response and screenshot as input
+    return messages
+
 
-    # Execute the action
+# Checks whether the instruction ends the task (completed, failed or nothing to do)
+def is_last_instruction(instruction: str) -> bool:
+    instruction_copy = "".join(instruction.lower().split())
+    return any(
+        instruction_copy.startswith(pattern) for pattern in LAST_INSTRUCTION_PATTERNS
+    )
 
 
-async def get_base64_screenshot() -> str:
+# Takes a screenshot, puts it into the screenshot store and returns its ID
+async def get_screenshot_id(tool_collection: ToolCollection) -> str:
     screenshot = (
         await tool_collection.run(
             name="computer", tool_input=cast(dict[str, Any], {"action": "screenshot"})
         )
     ).base64_image
-    return screenshot if screenshot else ""
+    return screenshot_store.put(screenshot) if screenshot else ""
 
 
 async def execute_instruction(instruction: str, screenshot: str):
@@ -1,24 +1,34 @@
+import os
+from typing import TYPE_CHECKING
+
 import pandas as pd
 from models.pdf_blueprint import PDF
-from models.data_handler import ReportDataHandler
-import os
+
+if TYPE_CHECKING:
+    from computer_use_demo.session import SessionContext
 
 
 def create_report(
-    data_handler: ReportDataHandler,
+    session: "SessionContext",
     output_path: str,
     file_name: str,
-    generate_sus_answers,
+    generate_sus_answers=None,
 ):
+    """
+    Writes the PDF and Excel report of the session. `generate_sus_answers(session)` is
+    called first if given, without it the SUS answers must already be in the report data.
+    """
+    data_handler = session.data_handler
 
     pdf_path = f"{output_path}/{file_name}.pdf"
     excel_path = f"{output_path}/{file_name}.xlsx"
 
-    generate_sus_answers(data_handler)
+    if generate_sus_answers:
+        generate_sus_answers(session)
     sus_non_formatted = data_handler.get_sus_data()  # For PDF report
     sus_formatted_data = data_handler.get_formatted_SUS_data()  # For Excel report
 
-    conversation_history = data_handler.get_oai_messages()
+    conversation_history = session.planner_history
 
     # Create a pandas dataframe from the SUS data
     sus_df = pd.DataFrame(sus_formatted_data)
@@ -26,6 +36,24 @@ def create_report(
     # Create a pandas DataFrame for the Interactions Count
     interactions_df = data_handler.get_task_interactions()
 
+    # Create a pandas DataFrame for the hits and misses of the visibility check cache
+    verdict_cache_df = data_handler.get_verdict_cache_stats()
+
+    # Create a pandas DataFrame for the reuse of the executor's HTTP connections
+    connections_df = data_handler.get_connection_stats()
+
+    # Create a pandas DataFrame for the structured planner answers that could not be parsed
+    planner_parsing_df = pd.DataFrame([data_handler.parse_stats.stats()])
+
+    # Create a pandas DataFrame for the size of the planner conversation and its summary
+    planner_history_df = pd.DataFrame([session.planner_history.stats()])
+
+    # Create a pandas DataFrame for the tokens, cost and latency per action, task and session
+    cost_latency_df = data_handler.get_cost_latency_stats()
+
+    # Create a pandas DataFrame for the share of steps executed without the LLM executor
+    fast_path_df = data_handler.get_fast_path_stats()
+
     # Fetch and process the new action data structure
     tasks_data = data_handler.get_action_data()  # New structure
 
@@ -54,6 +82,10 @@ def create_report(
         "Usability Notes",
         "Flag",
         "Current URL",
+        "Settle Time (s)",
+        "Screen Changed",
+        "Verdict Cached",
+        "Fast Path",
         "Feedback",
         "Feedback Text",
     ]
@@ -157,6 +189,16 @@ def create_report(
             interactions_df.to_excel(
                 writer, sheet_name="Interactions Count", index=False
             )
+            cost_latency_df.to_excel(writer, sheet_name="Cost & Latency", index=False)
+            verdict_cache_df.to_excel(writer, sheet_name="Verdict Cache", index=False)
+            fast_path_df.to_excel(writer, sheet_name="Fast Path", index=False)
+            connections_df.to_excel(writer, sheet_name="Connections", index=False)
+            planner_parsing_df.to_excel(
+                writer, sheet_name="Planner Parsing", index=False
+            )
+            planner_history_df.to_excel(
+                writer, sheet_name="Planner History", index=False
+            )
 
     except OSError as e:
         print(f"Error writing to file: {e}")
@@ -0,0 +1,40 @@
+"""
+The session context holds everything that belongs to one test session: the conversation
+with the planner, the chat history, the report data and the tools that control the
+session's display. Every function that works on a session gets it passed explicitly, so
+several sessions can run in one process without sharing any state.
+"""
+
+from dataclasses import dataclass, field
+
+from anthropic.types.beta import BetaMessageParam
+from tools import ToolCollection
+
+from computer_use_demo.anthropic_access import make_tool_collection
+from computer_use_demo.models.data_handler import ReportDataHandler
+from computer_use_demo.models.display_pool import DisplaySlot
+from computer_use_demo.models.history import PlannerHistory
+from computer_use_demo.models.image_index import ImageIndex
+
+
+@dataclass
+class SessionContext:
+    display: DisplaySlot | None = None  # None uses DISPLAY_NUM and Firefox on port 9222
+    # Conversation with the OpenAI assistant, images are referenced by screenshot ID
+    planner_history: PlannerHistory = field(default_factory=PlannerHistory)
+    # Chat history of the user, the assistant, the executor and the tools
+    messages: list[BetaMessageParam] = field(default_factory=list)
+    # Screenshots in the chat history, for pruning them without scanning the history
+    image_index: ImageIndex = field(default_factory=ImageIndex)
+    data_handler: ReportDataHandler = field(default_factory=ReportDataHandler)
+    tool_collection: ToolCollection = field(init=False)
+    mock_index: int = 0  # next mock response of the assistant
+
+    def __post_init__(self):
+        self.tool_collection = make_tool_collection(
+            self.display.display_num if self.display else None
+        )
+
+    @property
+    def debugging_port(self) -> int:
+        return self.display.debugging_port if self.display else 9222
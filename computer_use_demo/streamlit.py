@@ -4,35 +4,32 @@ Entrypoint for streamlit, see https://docs.streamlit.io/
 
 import asyncio
 import base64
-import websocket
+import math
 import os
 import subprocess
 import traceback
 from datetime import datetime, timedelta
-from enum import StrEnum
-from functools import partial
+from io import BytesIO
 from pathlib import PosixPath
 from typing import cast
-from reports import ReportDataHandler, create_report
 
 import httpx
 import streamlit as st
 from anthropic import RateLimitError
-from anthropic.types.beta import (
-    BetaContentBlockParam,
-    BetaTextBlockParam,
-)
+from anthropic.types.beta import BetaContentBlockParam
 from models.sender import Sender
-import computer_use_demo.oai as oai
-
+from PIL import Image
 from streamlit.delta_generator import DeltaGenerator
 
 from computer_use_demo.anthropic_access import (
     PROVIDER_TO_DEFAULT_MODEL_NAME,
     APIProvider,
-    sampling_loop,
+    ExecutorSettings,
 )
+from computer_use_demo.models.image_prep import encode_image, parse_encoding_profile
+from computer_use_demo.session import SessionContext
 from computer_use_demo.tools import ToolResult
+from computer_use_demo.worker import AgentWorker, EventKind
 
 FILE_OUTPUT_DIR = "/home/computeruse/local"
 FILE_OUTPUT_NAME = "report"
@@ -59,10 +56,22 @@ WARNING_TEXT = "⚠️ Security Alert: Never provide access to sensitive account
 tool_instruction = os.getenv("TOOL_INSTRUCTION", None)
 tool_termination = os.getenv("TOOL_TERMINATION", None)
 
+# Only one page of the chat history and the HTTP logs is rendered per rerun, so a rerun
+# takes the same time at the start and after hours of testing
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "30"))  # messages
+HTTP_LOG_PAGE_SIZE = int(os.getenv("HTTP_LOG_PAGE_SIZE", "10"))  # exchanges
+# Screenshots in the chat are shown downscaled, e.g. THUMBNAIL_IMAGE_ENCODING=png:800x600
+THUMBNAIL_PROFILE = parse_encoding_profile(
+    os.getenv("THUMBNAIL_IMAGE_ENCODING", "jpeg:80:640x480")
+)
+# seconds between two looks at the background worker while it runs a task
+UI_POLL_INTERVAL = float(os.getenv("UI_POLL_INTERVAL", "1"))
+
 
 def setup_state():
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    if "session" not in st.session_state:
+        # planner conversation, chat history, report data and tools of this browser session
+        st.session_state.session = SessionContext()
     if "api_key" not in st.session_state:
         # Try to load API key from file first, then environment
         st.session_state.api_key = load_from_storage("api_key") or os.getenv(
@@ -82,20 +91,30 @@ def setup_state():
         st.session_state.responses = {}
     if "tools" not in st.session_state:
         st.session_state.tools = {}
+    if "thumbnails" not in st.session_state:
+        # screenshots of the tool results, downscaled and encoded once, by tool ID
+        st.session_state.thumbnails = {}
     if "only_n_most_recent_images" not in st.session_state:
         st.session_state.only_n_most_recent_images = 1
     if "custom_system_prompt" not in st.session_state:
         st.session_state.custom_system_prompt = load_from_storage("system_prompt") or ""
     if "hide_images" not in st.session_state:
         st.session_state.hide_images = False
-    if "data_handler" not in st.session_state:
-        st.session_state.data_handler = ReportDataHandler()
     if "popup" not in st.session_state:
         st.session_state.popup = False  # whether or not feedback popup is shown
     if "feedback" not in st.session_state:
         st.session_state.feedback = None
-    if "wait_for_task" not in st.session_state:
-        st.session_state.wait_for_task = True
+    if "worker" not in st.session_state:
+        # runs the tasks of the session in the background, see worker.py
+        st.session_state.worker = AgentWorker(
+            st.session_state.session,
+            st.session_state.tools,
+            st.session_state.responses,
+        )
+    if "last_message" not in st.session_state:
+        st.session_state.last_message = ""  # latest message of the running task
+    if "errors" not in st.session_state:
+        st.session_state.errors = []  # errors of the running task
 
 
 def _reset_model():
@@ -112,7 +131,18 @@ def main():
 
     st.title(f"Automated Testing Tool {os.getenv('HOST_APP_PORT', '')}")
 
-    st.button("Early Stop and give feedback", on_click=stop_and_give_feedback)
+    worker: AgentWorker = st.session_state.worker
+    stop, pause = st.columns(2)
+    stop.button("Early Stop and give feedback", on_click=stop_and_give_feedback)
+    if worker.paused:
+        pause.button("Resume", on_click=worker.resume)
+    else:
+        pause.button(
+            "Pause",
+            on_click=worker.pause,
+            disabled=not worker.current_task,
+            help="Holds the agent before its next step",
+        )
 
     # if not os.getenv("HIDE_WARNING", False):
     #     st.warning(WARNING_TEXT)
@@ -162,6 +192,7 @@ def main():
 
         if st.button("Reset", type="primary"):
             with st.spinner("Resetting..."):
+                st.session_state.worker.shutdown()
                 st.session_state.clear()
                 setup_state()
 
@@ -178,35 +209,18 @@ def main():
         else:
             st.session_state.auth_validated = True
 
-    chat, http_logs = st.tabs(["Chat", "HTTP Exchange Logs"])
+    # the chat follows the worker while it has something to do
+    st.session_state.worker_busy = worker.busy
+    st.fragment(run_every=UI_POLL_INTERVAL if worker.busy else None)(_render_activity)()
 
     # new_message = st.chat_input(
     #     "Input new task to test system",
     # )
 
-    # render past chats
-    for message in st.session_state.messages:
-        if isinstance(message["content"], str):
-            _render_message(message["content"], message["role"], chat)
-        elif isinstance(message["content"], list):
-            for block in message["content"]:
-                # the tool result we send back to the Anthropic API isn't sufficient to render all details,
-                # so we store the tool use responses
-                if isinstance(block, dict) and block["type"] == "tool_result":
-                    _render_message(
-                        st.session_state.tools[block["tool_use_id"]], Sender.TOOL, chat
-                    )
-                else:
-                    _render_message(
-                        cast(BetaContentBlockParam | ToolResult, block),
-                        message["role"],
-                        chat,
-                    )
-
-    if (
-        st.session_state.wait_for_task and st.session_state.popup == False
-    ):  # Waiting for new task input by user
-        st.markdown("### Input your next task")
+    if not st.session_state.popup:  # Waiting for new task input by user
+        st.markdown(
+            "### Input your next task" if not worker.busy else "### Queue another task"
+        )
         with st.form(key="popup_form"):
             task_description = st.text_input("Enter your task description:")
             task_done = st.text_input("When is the task done?")
@@ -214,21 +228,18 @@ def main():
 
             if submit:
                 new_message = f"{task_description}. {task_done}."
-                st.session_state.wait_for_task = False
-                st.session_state.messages.append(
-                    {
-                        "role": Sender.USER,
-                        "content": [BetaTextBlockParam(type="text", text=new_message)],
-                    }
+                worker.submit(
+                    new_message,
+                    ExecutorSettings(
+                        model=st.session_state.model,
+                        provider=st.session_state.provider,
+                        api_key=st.session_state.api_key,
+                        system_prompt_suffix=st.session_state.custom_system_prompt,
+                        only_n_most_recent_images=st.session_state.only_n_most_recent_images,
+                    ),
                 )
-                _render_message(new_message, Sender.USER, chat)
-                st.session_state.data_handler.new_task(new_message)
                 st.rerun()
 
-    # render past http exchanges
-    for identity, (request, response) in st.session_state.responses.items():
-        _render_api_response(request, response, identity, http_logs)
-
     # render past chats
     # if new_message:
     #     st.session_state.messages.append(
@@ -255,71 +266,93 @@ def main():
                     "text": user_input,
                 }
                 st.session_state.popup = False  # Close popup after submission
-                message = oai.give_feedback(
-                    st.session_state.feedback, _render_message, chat
-                )
-                st.session_state.data_handler.new_feedback(st.session_state.feedback)
-                st.session_state.messages.append(
-                    {
-                        "role": Sender.FEEDBACK,
-                        "content": [{"type": "text", "text": message}],
-                    }
-                )
-                st.session_state.wait_for_task = True
-                st.session_state.data_handler.reset_task_interactions()
+                # the worker sends the feedback and then starts the next queued task
+                worker.give_feedback(st.session_state.feedback)
                 st.rerun()
 
             if failed_button:
                 st.session_state.feedback = {"status": "failed", "text": user_input}
                 st.session_state.popup = False
-                message = oai.give_feedback(
-                    st.session_state.feedback, _render_message, chat
-                )
-                st.session_state.data_handler.new_feedback(st.session_state.feedback)
-                st.session_state.messages.append(
-                    {
-                        "role": Sender.FEEDBACK,
-                        "content": [{"type": "text", "text": message}],
-                    }
-                )
-                st.session_state.wait_for_task = (
-                    True  # Enable option to add the next task
-                )
-                st.session_state.data_handler.reset_task_interactions()
+                worker.give_feedback(st.session_state.feedback)
                 st.rerun()
 
+    # the report is generated by the worker, which owns the session and its history
     st.button(
         label="Generate Report",
-        on_click=partial(_init_report, chat),
+        on_click=worker.create_report,
+        args=(FILE_OUTPUT_DIR, FILE_OUTPUT_NAME),
+        disabled=worker.busy,
+        help="Available when the agent is idle",
     )
 
-    try:
-        most_recent_message = st.session_state["messages"][-1]
-    except IndexError:
-        return
-
-    if most_recent_message["role"] is not Sender.USER:
-        # we don't have a user message to respond to, exit early
-        return
 
-    with st.spinner("Running Agent..."):
-        # run the opena ai loop and execute the actions proposed by the agent
-        from computer_use_demo.openai_loop import custom_loop
-
-        most_recent_message = st.session_state["messages"][-1]["content"][0]["text"]
-        st.session_state.messages = asyncio.run(
-            custom_loop(
-                mission=most_recent_message,
-                messages=st.session_state.messages,
-                context=chat,
-                exchange_logs=http_logs,
-                _render_message=_render_message,
-                _tool_output_callback=_tool_output_callback,
-                _api_response_callback=_api_response_callback,
-            )
-        )
+def _render_activity():
+    """
+    Render the chat and the HTTP logs. While the worker is busy, this fragment reruns
+    every UI_POLL_INTERVAL seconds and picks up the worker's events.
+    """
+    worker: AgentWorker = st.session_state.worker
+    finished = False
+    for event in worker.drain():
+        if event.kind == EventKind.TASK_STARTED:
+            st.session_state.errors = []
+            st.session_state.history_page = 0
+        elif event.kind == EventKind.MESSAGE:
+            st.session_state.last_message = f"{event.sender}: {event.text}"
+        elif event.kind == EventKind.ERROR and event.error:
+            st.session_state.errors.append(_format_error(event.error))
+        elif event.kind == EventKind.TASK_FINISHED:
+            st.session_state.last_message = ""
+            finished = True
+    if finished:
+        # Mission is completed, failed or stopped, show the feedback pop-up
+        st.session_state.popup = True
+        st.rerun()
+    if st.session_state.worker_busy and not worker.busy:
+        # e.g. the feedback was sent or the report created, enable the buttons again
         st.rerun()
 
+    chat, http_logs = st.tabs(["Chat", "HTTP Exchange Logs"])
+
+    # render past chats, one page at a time
+    messages = st.session_state.session.messages
+    start, end = _paginate(chat, "history", len(messages), HISTORY_PAGE_SIZE)
+    for message in messages[start:end]:
+        if isinstance(message["content"], str):
+            _render_message(message["content"], message["role"], chat)
+        elif isinstance(message["content"], list):
+            for block in message["content"]:
+                # the tool result we send back to the Anthropic API isn't sufficient to render all details,
+                # so we store the tool use responses
+                if isinstance(block, dict) and block["type"] == "tool_result":
+                    _render_message(
+                        st.session_state.tools[block["tool_use_id"]],
+                        Sender.TOOL,
+                        chat,
+                        tool_id=block["tool_use_id"],
+                    )
+                else:
+                    _render_message(
+                        cast(BetaContentBlockParam | ToolResult, block),
+                        message["role"],
+                        chat,
+                    )
+
+    with chat:
+        for error in st.session_state.errors:
+            st.error(error, icon=":material/error:")
+        if worker.current_task:
+            status = "Paused" if worker.paused else "Running Agent..."
+            st.info(f"**{status}** {st.session_state.last_message}")
+        if worker.queued:
+            st.caption(f"Queued tasks: {', '.join(worker.queued)}")
+
+    # render past http exchanges, one page at a time
+    responses = list(st.session_state.responses.items())
+    start, end = _paginate(http_logs, "http_log", len(responses), HTTP_LOG_PAGE_SIZE)
+    for identity, (request, response) in responses[start:end]:
+        _render_api_response(request, response, identity, http_logs)
+
 
 def validate_auth(provider: APIProvider, api_key: str | None):
     if provider == APIProvider.ANTHROPIC:
@@ -369,40 +402,22 @@ def save_to_storage(filename: str, data: str) -> None:
         st.write(f"Debug: Error saving {filename}: {e}")
 
 
-def _api_response_callback(
-    request: httpx.Request,
-    response: httpx.Response | object | None,
-    error: Exception | None,
-    tab: DeltaGenerator,
-    response_state: dict[str, tuple[httpx.Request, httpx.Response | object | None]],
-):
-    """
-    Handle an API response by storing it to state and rendering it.
-    """
-    response_id = datetime.now().isoformat()
-    response_state[response_id] = (request, response)
-    if error:
-        _render_error(error)
-    _render_api_response(request, response, response_id, tab)
-
-
-def _tool_output_callback(
-    tool_output: ToolResult, tool_id: str, tool_state: dict[str, ToolResult], context
-):
-    """Handle a tool output by storing it to state and rendering it."""
-    tool_state[tool_id] = tool_output
-    _render_message(tool_output, Sender.TOOL, context)
-
-
 def _render_api_response(
     request: httpx.Request,
     response: httpx.Response | object | None,
     response_id: str,
     tab: DeltaGenerator,
 ):
-    """Render an API response to a streamlit tab"""
+    """
+    Render an API response to a streamlit tab. The request and response are only
+    rendered once the exchange is opened, as the requests contain the screenshots.
+    """
+    status = response.status_code if isinstance(response, httpx.Response) else "error"
     with tab:
-        with st.expander(f"Request/Response ({response_id})"):
+        if st.toggle(
+            f"Request/Response ({response_id}): `{request.method} {request.url.path}` {status}",
+            key=f"http_log_{response_id}",
+        ):
             newline = "\n\n"
             st.markdown(
                 f"`{request.method} {request.url}`{newline}{newline.join(f'`{k}: {v}`' for k, v in request.headers.items())}"
@@ -418,7 +433,7 @@ def _render_api_response(
                 st.write(response)
 
 
-def _render_error(error: Exception):
+def _format_error(error: Exception) -> str:
     if isinstance(error, RateLimitError):
         body = "You have been rate limited."
         if retry_after := error.response.headers.get("retry-after"):
@@ -430,17 +445,66 @@ def _render_error(error: Exception):
         lines = "\n".join(traceback.format_exception(error))
         body += f"\n\n```{lines}```"
     save_to_storage(f"error_{datetime.now().timestamp()}.md", body)
-    st.error(f"**{error.__class__.__name__}**\n\n{body}", icon=":material/error:")
+    return f"**{error.__class__.__name__}**\n\n{body}"
 
 
 def stop_and_give_feedback():
+    st.session_state.worker.cancel()
     st.session_state.popup = True
 
 
+def _paginate(container, key: str, total: int, page_size: int) -> tuple[int, int]:
+    """
+    Render the navigation of a paginated list and return the bounds of the current page.
+    Page 0 holds the latest entries.
+    """
+    page_key = f"{key}_page"
+    pages = max(math.ceil(total / page_size), 1)
+    page = min(st.session_state.get(page_key, 0), pages - 1)
+    end = total - page * page_size
+    start = max(end - page_size, 0)
+    if pages > 1:
+        with container:
+            older, position, newer = st.columns([1, 4, 1])
+            older.button(
+                "Older",
+                key=f"{key}_older",
+                disabled=page == pages - 1,
+                on_click=_set_page,
+                args=(page_key, page + 1),
+            )
+            position.caption(f"{start + 1}-{end} of {total}")
+            newer.button(
+                "Newer",
+                key=f"{key}_newer",
+                disabled=page == 0,
+                on_click=_set_page,
+                args=(page_key, page - 1),
+            )
+    return start, end
+
+
+def _set_page(page_key: str, page: int):
+    st.session_state[page_key] = page
+
+
+def _thumbnail(base64_image: str, tool_id: str | None) -> bytes:
+    """Downscale the screenshot of a tool result, once per tool ID."""
+    thumbnails = st.session_state.thumbnails
+    if tool_id in thumbnails:
+        return thumbnails[tool_id]
+    image = Image.open(BytesIO(base64.b64decode(base64_image)))
+    thumbnail = encode_image(image, THUMBNAIL_PROFILE)
+    if tool_id:
+        thumbnails[tool_id] = thumbnail
+    return thumbnail
+
+
 def _render_message(
     message: str | BetaContentBlockParam | ToolResult,
     sender: Sender,
     container,
+    tool_id: str | None = None,
 ):
     """Convert input from the user or output from the agent to a streamlit message."""
     # streamlit's hotreloading breaks isinstance checks, so we need to check for class names
@@ -473,7 +537,9 @@ def _render_message(
                 if message.error:
                     st.error(message.error)
                 if message.base64_image and not st.session_state.hide_images:
-                    st.image(base64.b64decode(message.base64_image))
+                    st.image(_thumbnail(message.base64_image, tool_id))
+                if getattr(message, "settle_time", None) is not None:
+                    st.caption(f"Screen settled after {message.settle_time:.2f}s")
             elif isinstance(message, dict):
                 if message["type"] == "text":
                     st.write(message["text"])
@@ -486,14 +552,4 @@ def _render_message(
                 st.markdown(message)
 
 
-def _init_report(chat):
-    st.session_state.data_handler.set_oai_messages(oai.get_messages())
-    create_report(
-        st.session_state.data_handler,
-        FILE_OUTPUT_DIR,
-        FILE_OUTPUT_NAME,
-        oai.generate_sus_answers,
-    )
-
-
 main()
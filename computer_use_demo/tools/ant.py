@@ -1,7 +1,13 @@
-import uuid
 import base64
+import hashlib
+import uuid
+
+from anthropic.types.beta import BetaImageBlockParam, BetaTextBlockParam
 from anthropic.types.beta.beta_message_param import BetaMessageParam
 
+from computer_use_demo.models.image_prep import ImageConsumer
+from computer_use_demo.models.screenshot_store import screenshot_store
+
 
 def generate_unique_id():
     # Generate a UUID4 and convert it to bytes
@@ -16,10 +22,38 @@ def generate_unique_id():
     return unique_id
 
 
-def prep_execution_request(
-    instruction: str, base64_image: str
-) -> list[BetaMessageParam]:
-    toolu_id = generate_unique_id()
+# Function will derive the tool use ID from the given parts, so the same request is sent
+# byte for byte again, e.g. when an instruction is retried on the same screenshot
+def stable_tool_id(*parts: str) -> str:
+    digest = hashlib.sha256("\0".join(parts).encode("utf-8")).digest()[:16]
+    return f"toolu_{base64.urlsafe_b64encode(digest).decode('utf-8').rstrip('=')}"
+
+
+# Function will build the per-step part of the executor conversation. It follows the
+# cached tools and system prompt of the executor (see anthropic_access.request_action).
+def prep_execution_request(instruction: str, image_id: str) -> list[BetaMessageParam]:
+    toolu_id = stable_tool_id(instruction, image_id)
+    # the image ID is empty if the capture produced no screenshot, and the screenshot is
+    # gone if the store evicted it
+    screenshot: list[BetaImageBlockParam | BetaTextBlockParam] = [
+        {"type": "text", "text": "The screenshot could not be taken."}
+    ]
+    image = (
+        screenshot_store.get_prepared(image_id, ImageConsumer.EXECUTOR)
+        if image_id
+        else None
+    )
+    if image:
+        screenshot = [
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": image.media_type,  # type: ignore
+                    "data": image.data,
+                },
+            }
+        ]
     messages: list[BetaMessageParam] = []
     messages.append(
         BetaMessageParam(
@@ -55,18 +89,9 @@ def prep_execution_request(
             content=[
                 {
                     "type": "tool_result",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/png",
-                                "data": base64_image,
-                            },
-                        }
-                    ],
+                    "content": screenshot,
                     "tool_use_id": toolu_id,
-                    "is_error": False,
+                    "is_error": image is None,
                 }
             ],
         )
@@ -0,0 +1,106 @@
+"""In-process screen capture for the Xvfb display used by ComputerTool."""
+
+from io import BytesIO
+
+from PIL import Image
+
+try:
+    import mss
+except ImportError:  # pragma: no cover - depends on the container image
+    mss = None
+
+
+class CaptureError(Exception):
+    """Raised when the framebuffer cannot be read in-process."""
+
+
+class ScreenCapture:
+    """
+    Grabs the framebuffer of an X display directly (via mss, which uses the X shared
+    memory extension where available) and resizes/encodes it in memory. This avoids
+    spawning gnome-screenshot/scrot and ImageMagick and never touches the disk.
+    """
+
+    def __init__(self, display_num: int | None = None):
+        self.display = f":{display_num}" if display_num is not None else None
+        self._sct = None
+        self._failed = mss is None
+
+    @property
+    def available(self) -> bool:
+        """Whether in-process capture can be used. Turns False after the first failure."""
+        return not self._failed
+
+    def _connect(self):
+        if self._sct is None:
+            try:
+                self._sct = mss.mss(display=self.display) if self.display else mss.mss()
+            except Exception as e:
+                self._failed = True
+                raise CaptureError(f"Cannot open display {self.display}: {e}") from e
+        return self._sct
+
+    def _grab(self, region: tuple[int, int, int, int] | None = None):
+        if self._failed:
+            raise CaptureError("In-process capture is not available")
+        sct = self._connect()
+        monitor = sct.monitors[0]
+        if region:
+            left, top, width, height = region
+            monitor = {
+                "left": monitor["left"] + left,
+                "top": monitor["top"] + top,
+                "width": width,
+                "height": height,
+            }
+        try:
+            return sct.grab(monitor)
+        except Exception as e:
+            self._failed = True
+            raise CaptureError(f"Failed to grab screen: {e}") from e
+
+    def grab(self) -> Image.Image:
+        """Return the current screen content as an RGB image."""
+        shot = self._grab()
+        return Image.frombytes("RGB", shot.size, shot.bgra, "raw", "BGRX")
+
+    def grab_sample(
+        self,
+        size: tuple[int, int],
+        region: tuple[int, int, int, int] | None = None,
+    ) -> Image.Image:
+        """
+        Return a small grayscale sample of the screen, or of `region` (left, top, width,
+        height in pixels). The raw BGRX pixels are box-reduced in place, the frame is
+        never converted to a full size RGB image.
+        """
+        shot = self._grab(region)
+        width, height = shot.size
+        # each pixel is 4 bytes, averaging them gives a gray value (offset by the X byte)
+        raw = Image.frombuffer("L", (width * 4, height), shot.raw, "raw", "L", 0, 1)
+        # reduce() averages whole blocks and is faster than a BOX resize of the same size
+        sample = raw.reduce((max(1, width * 4 // size[0]), max(1, height // size[1])))
+        if sample.size != size:
+            sample = sample.resize(size, Image.Resampling.BOX)
+        return sample
+
+    def capture_image(self, size: tuple[int, int] | None = None) -> Image.Image:
+        """Grab the screen and optionally resize it to `size`."""
+        image = self.grab()
+        if size and image.size != size:
+            image = image.resize(size, Image.Resampling.LANCZOS)
+        return image
+
+    def capture(
+        self, size: tuple[int, int] | None = None, image_format: str = "PNG"
+    ) -> bytes:
+        """Grab the screen, optionally resize it to `size` and return the encoded bytes."""
+        image = self.capture_image(size)
+        buffer = BytesIO()
+        image.save(buffer, format=image_format)
+        return buffer.getvalue()
+
+    def close(self):
+        if self._sct is not None:
+            self._sct.close()
+            self._sct = None
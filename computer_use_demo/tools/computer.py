@@ -1,8 +1,11 @@
 import asyncio
 import base64
+import inspect
+import logging
 import os
 import shlex
 import shutil
+from collections.abc import Awaitable, Callable
 from enum import StrEnum
 from pathlib import Path
 from typing import Literal, TypedDict
@@ -10,11 +13,19 @@ from uuid import uuid4
 
 from anthropic.types.beta import BetaToolComputerUse20241022Param
 
+from computer_use_demo.models.image_prep import encode_image
+from computer_use_demo.models.screenshot_store import screenshot_store
+
 from .base import BaseAnthropicTool, ToolError, ToolResult
+from .capture import CaptureError, ScreenCapture
 from .run import run
+from .settle import SettleDetector
+from .xinput import InputError, XTestInput
 
 OUTPUT_DIR = "/tmp/outputs"
 
+logger = logging.getLogger(__name__)
+
 TYPING_DELAY_MS = 12
 TYPING_GROUP_SIZE = 50
 
@@ -73,7 +84,10 @@ class ComputerTool(BaseAnthropicTool):
     height: int
     display_num: int | None
 
-    _screenshot_delay = 2.0
+    _screenshot_delay = 2.0  # fixed delay if the screen can't be sampled in-process
+    _settle_max_wait = float(os.getenv("SETTLE_MAX_WAIT", "5"))
+    # "left,top,width,height" of the screen that is sampled while waiting, default all
+    _settle_region = os.getenv("SETTLE_REGION")
     _scaling_enabled = True
 
     @property
@@ -90,20 +104,32 @@ class ComputerTool(BaseAnthropicTool):
     def to_params(self) -> BetaToolComputerUse20241022Param:
         return {"name": self.name, "type": self.api_type, **self.options}
 
-    def __init__(self):
+    def __init__(self, display_num: int | None = None):
+        """Controls the given display, or the one in DISPLAY_NUM if none is given."""
         super().__init__()
 
         self.width = int(os.getenv("WIDTH") or 0)
         self.height = int(os.getenv("HEIGHT") or 0)
         assert self.width and self.height, "WIDTH, HEIGHT must be set"
-        if (display_num := os.getenv("DISPLAY_NUM")) is not None:
-            self.display_num = int(display_num)
+        if display_num is None and os.getenv("DISPLAY_NUM") is not None:
+            display_num = int(os.environ["DISPLAY_NUM"])
+        if display_num is not None:
+            self.display_num = display_num
             self._display_prefix = f"DISPLAY=:{self.display_num} "
         else:
             self.display_num = None
             self._display_prefix = ""
 
         self.xdotool = f"{self._display_prefix}xdotool"
+        self._input = XTestInput(self.display_num)
+        self._capture = ScreenCapture(self.display_num)
+        settle_region = None
+        if self._settle_region:
+            left, top, width, height = map(int, self._settle_region.split(","))
+            settle_region = (left, top, width, height)
+        self._settle_detector = SettleDetector(
+            self._capture, max_wait=self._settle_max_wait, region=settle_region
+        )
 
     async def __call__(
         self,
@@ -113,6 +139,14 @@ class ComputerTool(BaseAnthropicTool):
         coordinate: tuple[int, int] | None = None,
         **kwargs,
     ):
+        return await self.act(action, text, coordinate)
+
+    async def act(
+        self,
+        action: Action,
+        text: str | None = None,
+        coordinate: tuple[int, int] | None = None,
+    ) -> ToolResult:
         if action in ("mouse_move", "left_click_drag"):
             if coordinate is None:
                 raise ToolError(f"coordinate is required for {action}")
@@ -128,10 +162,20 @@ class ComputerTool(BaseAnthropicTool):
             )
 
             if action == "mouse_move":
-                return await self.shell(f"{self.xdotool} mousemove --sync {x} {y}")
+                return await self.inject(
+                    lambda: self._input.mouse_move(x, y),
+                    f"{self.xdotool} mousemove --sync {x} {y}",
+                )
             elif action == "left_click_drag":
-                return await self.shell(
-                    f"{self.xdotool} mousedown 1 mousemove --sync {x} {y} mouseup 1"
+
+                def drag():
+                    self._input.mouse_down(1)
+                    self._input.mouse_move(x, y)
+                    self._input.mouse_up(1)
+
+                return await self.inject(
+                    drag,
+                    f"{self.xdotool} mousedown 1 mousemove --sync {x} {y} mouseup 1",
                 )
 
         if action in ("key", "type"):
@@ -143,17 +187,27 @@ class ComputerTool(BaseAnthropicTool):
                 raise ToolError(output=f"{text} must be a string")
 
             if action == "key":
-                return await self.shell(f"{self.xdotool} key -- {text}")
+                return await self.inject(
+                    lambda: self._input.key(text),
+                    f"{self.xdotool} key -- {text}",
+                )
             elif action == "type":
+                if self._input.available:
+                    # e.g. characters without a key in the layout, xdotool remaps keys for those
+                    interrupted = await self._try_inject(
+                        lambda: self._input.type_text(text, TYPING_DELAY_MS / 1000),
+                    )
+                    if interrupted is not None:
+                        return await self._after_input(interrupted)
                 results: list[ToolResult] = []
                 for chunk in chunks(text, TYPING_GROUP_SIZE):
                     cmd = f"{self.xdotool} type --delay {TYPING_DELAY_MS} -- {shlex.quote(chunk)}"
                     results.append(await self.shell(cmd, take_screenshot=False))
-                screenshot_base64 = (await self.screenshot()).base64_image
-                return ToolResult(
-                    output="".join(result.output or "" for result in results),
-                    error="".join(result.error or "" for result in results),
-                    base64_image=screenshot_base64,
+                return await self._after_input(
+                    ToolResult(
+                        output="".join(result.output or "" for result in results),
+                        error="".join(result.error or "" for result in results),
+                    ),
                 )
 
         if action in (
@@ -172,6 +226,14 @@ class ComputerTool(BaseAnthropicTool):
             if action == "screenshot":
                 return await self.screenshot()
             elif action == "cursor_position":
+                if self._input.available:
+                    try:
+                        x, y = self.scale_coordinates(
+                            ScalingSource.COMPUTER, *self._input.cursor_position()
+                        )
+                        return ToolResult(output=f"X={x},Y={y}")
+                    except InputError:
+                        pass
                 result = await self.shell(
                     f"{self.xdotool} getmouselocation --shell",
                     take_screenshot=False,
@@ -184,18 +246,80 @@ class ComputerTool(BaseAnthropicTool):
                 )
                 return result.replace(output=f"X={x},Y={y}")
             else:
-                click_arg = {
-                    "left_click": "1",
-                    "right_click": "3",
-                    "middle_click": "2",
-                    "double_click": "--repeat 2 --delay 500 1",
+                button, repeat = {
+                    "left_click": (1, 1),
+                    "right_click": (3, 1),
+                    "middle_click": (2, 1),
+                    "double_click": (1, 2),
                 }[action]
-                return await self.shell(f"{self.xdotool} click {click_arg}")
+                click_arg = f"--repeat {repeat} --delay 500 {button}"
+                return await self.inject(
+                    lambda: self._input.click(button, repeat, delay=0.5),
+                    f"{self.xdotool} click {click_arg}",
+                )
 
         raise ToolError(f"Invalid action: {action}")
 
+    async def inject(
+        self,
+        event: Callable[[], Awaitable[None] | None],
+        fallback_command: str,
+    ) -> ToolResult:
+        """Inject an input event in-process, or run the xdotool command if that is not possible."""
+        if self._input.available:
+            result = await self._try_inject(event)
+            if result is not None:
+                return await self._after_input(result)
+        return await self.shell(fallback_command)
+
+    async def _try_inject(
+        self, event: Callable[[], Awaitable[None] | None]
+    ) -> ToolResult | None:
+        """
+        Inject the events in-process. Returns None if nothing was injected, so the caller
+        can run the action with xdotool instead. If the injection failed part-way, e.g.
+        between mouse down and mouse up, repeating the whole action would click or type
+        twice: the held buttons and keys are released and the error is returned.
+        """
+        sent = self._input.events_sent
+        try:
+            if inspect.isawaitable(pending := event()):
+                await pending
+            return ToolResult()
+        except InputError as e:
+            self._input.release_held()
+            if self._input.events_sent == sent:
+                return None
+            return ToolResult(error=f"The action was interrupted part-way: {e}")
+
+    async def _after_input(self, result: ToolResult):
+        settle_time = await self.wait_for_settle()
+        return result.replace(
+            base64_image=(await self.screenshot()).base64_image,
+            settle_time=settle_time,
+        )
+
     async def screenshot(self):
         """Take a screenshot of the current screen and return the base64 encoded image."""
+        if self._capture.available:
+            try:
+                size = None
+                if self._scaling_enabled:
+                    size = self.scale_coordinates(
+                        ScalingSource.COMPUTER, self.width, self.height
+                    )
+                image = self._capture.capture_image(size)
+                data = encode_image(image)
+                # hand the raw pixels to the store, so the image never has to be decoded
+                image_id = screenshot_store.put(data, pixels=image)
+                return ToolResult(base64_image=screenshot_store.get_b64(image_id))
+            except CaptureError:
+                # the display can't be read in-process, use the external tools instead
+                pass
+        return await self.subprocess_screenshot()
+
+    async def subprocess_screenshot(self):
+        """Take a screenshot with gnome-screenshot/scrot and resize it with ImageMagick."""
         output_dir = Path(OUTPUT_DIR)
         output_dir.mkdir(parents=True, exist_ok=True)
         path = output_dir / f"screenshot_{uuid4().hex}.png"
@@ -226,13 +350,32 @@ class ComputerTool(BaseAnthropicTool):
         """Run a shell command and return the output, error, and optionally a screenshot."""
         _, stdout, stderr = await run(command)
         base64_image = None
+        settle_time = None
 
         if take_screenshot:
-            # delay to let things settle before taking a screenshot
-            await asyncio.sleep(self._screenshot_delay)
+            # let things settle before taking a screenshot
+            settle_time = await self.wait_for_settle()
             base64_image = (await self.screenshot()).base64_image
 
-        return ToolResult(output=stdout, error=stderr, base64_image=base64_image)
+        return ToolResult(
+            output=stdout,
+            error=stderr,
+            base64_image=base64_image,
+            settle_time=settle_time,
+        )
+
+    async def wait_for_settle(self) -> float:
+        """Wait until the screen stops changing and return how long that took in seconds."""
+        if self._capture.available:
+            try:
+                result = await self._settle_detector.wait()
+                if not result.settled:
+                    logger.warning("Screen did not settle within %.2fs", result.elapsed)
+                return result.elapsed
+            except CaptureError:
+                pass
+        await asyncio.sleep(self._screenshot_delay)
+        return self._screenshot_delay
 
     def scale_coordinates(self, source: ScalingSource, x: int, y: int):
         """Scale coordinates to a target maximum resolution."""
@@ -0,0 +1,69 @@
+"""Detects when the screen has stopped changing after an action."""
+
+import asyncio
+import time
+from dataclasses import dataclass
+
+from PIL import ImageChops, ImageStat
+
+from .capture import ScreenCapture
+
+# Frames are compared at this size, which is enough to notice spinners and page loads
+SAMPLE_SIZE = (128, 96)
+
+
+@dataclass(frozen=True)
+class SettleResult:
+    """Outcome of waiting for the screen to settle."""
+
+    settled: bool  # False if max_wait was reached while the screen was still changing
+    elapsed: float  # seconds
+    frames: int
+
+
+class SettleDetector:
+    """
+    Samples cheap low resolution frames in a tight loop and returns as soon as
+    `stable_frames` consecutive frames differ from their predecessor by less than
+    `tolerance` (mean absolute difference of the grayscale pixels, 0-255). Only `region`
+    (left, top, width, height) is sampled if it is given, e.g. to leave out a clock.
+    """
+
+    def __init__(
+        self,
+        capture: ScreenCapture,
+        stable_frames: int = 3,
+        tolerance: float = 0.5,
+        interval: float = 0.05,  # seconds between two frames
+        min_wait: float = 0.2,  # give the action time to start changing the screen
+        max_wait: float = 5.0,
+        region: tuple[int, int, int, int] | None = None,
+    ):
+        self.capture = capture
+        self.stable_frames = stable_frames
+        self.tolerance = tolerance
+        self.interval = interval
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.region = region
+
+    def _sample(self):
+        return self.capture.grab_sample(SAMPLE_SIZE, self.region)
+
+    async def wait(self) -> SettleResult:
+        """Wait until the screen is stable. Raises CaptureError if it can't be sampled."""
+        start = time.perf_counter()
+        await asyncio.sleep(self.min_wait)
+        previous = self._sample()
+        frames = 1
+        stable = 0
+        while stable < self.stable_frames:
+            if time.perf_counter() - start >= self.max_wait:
+                return SettleResult(False, time.perf_counter() - start, frames)
+            await asyncio.sleep(self.interval)
+            frame = self._sample()
+            frames += 1
+            difference = ImageStat.Stat(ImageChops.difference(frame, previous)).mean[0]
+            stable = stable + 1 if difference < self.tolerance else 0
+            previous = frame
+        return SettleResult(True, time.perf_counter() - start, frames)
@@ -0,0 +1,199 @@
+"""In-process input injection for the X display used by ComputerTool."""
+
+import asyncio
+
+try:
+    from Xlib import XK, X, display as xdisplay
+    from Xlib.ext import xtest
+except ImportError:  # pragma: no cover - depends on the container image
+    xdisplay = None
+
+
+class InputError(Exception):
+    """Raised when an input event cannot be injected in-process."""
+
+
+# xdotool accepts these short names for the modifier keys
+MODIFIER_ALIASES = {
+    "ctrl": "Control_L",
+    "control": "Control_L",
+    "alt": "Alt_L",
+    "shift": "Shift_L",
+    "super": "Super_L",
+    "meta": "Meta_L",
+    "cmd": "Super_L",
+}
+
+# characters that xdotool type maps to keys instead of their keysym
+CHARACTER_KEYS = {"\n": "Return", "\t": "Tab"}
+
+
+class XTestInput:
+    """
+    Injects mouse and keyboard events over the XTEST extension of a persistent
+    connection to the display. Each event costs a few microseconds instead of a
+    /bin/sh + xdotool fork/exec. Anything that can't be mapped to a key of the
+    current keyboard layout raises InputError, so the caller can fall back to xdotool.
+    `events_sent` tells the caller whether an action failed before or after its first
+    event; only in the first case can the action be repeated with xdotool.
+    """
+
+    def __init__(self, display_num: int | None = None):
+        self.display_name = f":{display_num}" if display_num is not None else None
+        self._display = None
+        self._failed = xdisplay is None
+        self.events_sent = 0
+        # buttons and keycodes that were pressed and not released yet
+        self._held_buttons: set[int] = set()
+        self._held_keys: set[int] = set()
+
+    @property
+    def available(self) -> bool:
+        """Whether input can be injected in-process. Turns False if the display can't be opened."""
+        return not self._failed
+
+    def _connect(self):
+        if self._failed:
+            raise InputError("In-process input is not available")
+        if self._display is None:
+            try:
+                self._display = xdisplay.Display(self.display_name)
+                if not self._display.has_extension("XTEST"):
+                    raise InputError("The display has no XTEST extension")
+            except Exception as e:
+                self._failed = True
+                raise InputError(f"Cannot open display {self.display_name}: {e}") from e
+        return self._display
+
+    def _fake_input(self, event_type: int, detail: int = 0, **kwargs):
+        try:
+            xtest.fake_input(self._connect(), event_type, detail, **kwargs)
+        except InputError:
+            raise
+        except Exception as e:
+            self._failed = True
+            raise InputError(f"Failed to inject input: {e}") from e
+        self.events_sent += 1
+        if event_type == X.ButtonPress:
+            self._held_buttons.add(detail)
+        elif event_type == X.ButtonRelease:
+            self._held_buttons.discard(detail)
+        elif event_type == X.KeyPress:
+            self._held_keys.add(detail)
+        elif event_type == X.KeyRelease:
+            self._held_keys.discard(detail)
+
+    def release_held(self):
+        """Release the buttons and keys an interrupted action left pressed, if possible."""
+        held = [(X.ButtonRelease, button) for button in self._held_buttons]
+        held += [(X.KeyRelease, keycode) for keycode in self._held_keys]
+        self._held_buttons.clear()
+        self._held_keys.clear()
+        if not held or self._display is None:
+            return
+        try:
+            for event_type, detail in held:
+                xtest.fake_input(self._display, event_type, detail)
+            self._display.sync()
+        except Exception:
+            # the connection is broken, the server releases everything when it closes
+            self.close()
+
+    def _sync(self):
+        try:
+            self._connect().sync()
+        except InputError:
+            raise
+        except Exception as e:
+            self._failed = True
+            raise InputError(f"Failed to inject input: {e}") from e
+
+    def mouse_move(self, x: int, y: int):
+        self._fake_input(X.MotionNotify, x=x, y=y)
+        self._sync()
+
+    def mouse_down(self, button: int):
+        self._fake_input(X.ButtonPress, button)
+        self._sync()
+
+    def mouse_up(self, button: int):
+        self._fake_input(X.ButtonRelease, button)
+        self._sync()
+
+    async def click(self, button: int, repeat: int = 1, delay: float = 0.0):
+        for i in range(repeat):
+            if i:
+                await asyncio.sleep(delay)
+            self.mouse_down(button)
+            self.mouse_up(button)
+
+    def cursor_position(self) -> tuple[int, int]:
+        try:
+            pointer = self._connect().screen().root.query_pointer()
+        except InputError:
+            raise
+        except Exception as e:
+            self._failed = True
+            raise InputError(f"Failed to query the pointer: {e}") from e
+        return pointer.root_x, pointer.root_y
+
+    def _keycode(self, keysym: int) -> tuple[int, bool]:
+        """Return the keycode for the keysym and whether shift has to be held for it."""
+        d = self._connect()
+        keycode = d.keysym_to_keycode(keysym)
+        if not keycode:
+            raise InputError(f"No key for keysym {keysym:#x} in the current layout")
+        if d.keycode_to_keysym(keycode, 0) == keysym:
+            return keycode, False
+        if d.keycode_to_keysym(keycode, 1) == keysym:
+            return keycode, True
+        raise InputError(f"Keysym {keysym:#x} needs a modifier other than shift")
+
+    def _press(self, keycodes: list[int]):
+        for keycode in keycodes:
+            self._fake_input(X.KeyPress, keycode)
+        for keycode in reversed(keycodes):
+            self._fake_input(X.KeyRelease, keycode)
+        self._sync()
+
+    def _combo_keycodes(self, combo: str) -> list[int]:
+        keycodes = []
+        for name in combo.split("+"):
+            keysym = XK.string_to_keysym(MODIFIER_ALIASES.get(name.lower(), name))
+            if not keysym:
+                raise InputError(f"Unknown key: {name}")
+            keycode, shift = self._keycode(keysym)
+            if shift:
+                keycodes.append(self._keycode(XK.XK_Shift_L)[0])
+            keycodes.append(keycode)
+        return keycodes
+
+    def key(self, text: str):
+        """Press key combinations in xdotool syntax, e.g. "ctrl+a BackSpace"."""
+        # resolve all combinations first, so nothing is pressed if one of them is unknown
+        combos = [self._combo_keycodes(combo) for combo in text.split()]
+        for keycodes in combos:
+            self._press(keycodes)
+
+    def _char_keycodes(self, char: str) -> list[int]:
+        if char in CHARACTER_KEYS:
+            keysym = XK.string_to_keysym(CHARACTER_KEYS[char])
+        elif 0x20 <= ord(char) <= 0x7E or 0xA0 <= ord(char) <= 0xFF:
+            keysym = ord(char)  # Latin-1 keysyms equal their code point
+        else:
+            keysym = 0x01000000 | ord(char)
+        keycode, shift = self._keycode(keysym)
+        return [self._keycode(XK.XK_Shift_L)[0], keycode] if shift else [keycode]
+
+    async def type_text(self, text: str, delay: float = 0.0):
+        """Type the text character by character, waiting `delay` seconds in between."""
+        keycodes = [self._char_keycodes(char) for char in text]
+        for i, char_keycodes in enumerate(keycodes):
+            if i and delay:
+                await asyncio.sleep(delay)
+            self._press(char_keycodes)
+
+    def close(self):
+        if self._display is not None:
+            self._display.close()
+            self._display = None
@@ -0,0 +1,310 @@
+"""
+Background worker that runs the agent loop of one session outside the Streamlit script
+thread. The worker has its own thread and event loop and works through a queue of tasks.
+After every task it waits for the feedback of the user before it starts the next one,
+so the feedback belongs to the right task. The page never waits for the loop: it sends
+commands (submit, cancel, pause, resume, feedback, report) and polls the worker's event
+queue. The session is only used on the worker's loop, and one command at a time: a task,
+the feedback or the report waits until the one before it is done.
+
+The worker never calls Streamlit. Tool results and HTTP exchanges are stored in the dicts
+the page renders from, everything else is reported as an event.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from enum import StrEnum
+
+import httpx
+from anthropic.types.beta import BetaContentBlockParam, BetaTextBlockParam
+from models.sender import Sender
+from tools import ToolResult
+
+import computer_use_demo.oai as oai
+from computer_use_demo.anthropic_access import ExecutorSettings
+from computer_use_demo.openai_loop import custom_loop
+from computer_use_demo.reports import create_report
+from computer_use_demo.session import SessionContext
+
+logger = logging.getLogger(__name__)
+
+
+class EventKind(StrEnum):
+    TASK_STARTED = "task_started"
+    MESSAGE = "message"  # rendered by the loop, e.g. an instruction or a correction
+    STEP = "step"  # the executor answered or a tool ran, the chat history grew
+    ERROR = "error"
+    TASK_FINISHED = "task_finished"  # the worker now waits for the feedback
+    FEEDBACK_SENT = "feedback_sent"
+    REPORT_CREATED = (
+        "report_created"  # also after a failure, reported as an ERROR before
+    )
+
+
+@dataclass(frozen=True)
+class WorkerEvent:
+    kind: EventKind
+    text: str = ""
+    sender: str = ""
+    error: Exception | None = None
+    cancelled: bool = False  # TASK_FINISHED of a task that was stopped early
+
+
+class AgentWorker:
+    def __init__(
+        self,
+        session: SessionContext,
+        tools: dict[str, ToolResult],
+        responses: dict[str, tuple[httpx.Request, httpx.Response | object | None]],
+    ):
+        self.session = session
+        self.tools = tools
+        self.responses = responses
+        self.events: queue.Queue[WorkerEvent] = queue.Queue()
+        self.current_task: str | None = None
+        self.queued: list[str] = []
+        self.paused = False
+        self.awaiting_feedback = False
+        self._sending_feedback = False
+        self._creating_report = False
+        self._shutting_down = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._started = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether the worker has something to do that the page should follow. This includes
+        folding the planner history in the background after the feedback.
+        """
+        return bool(
+            self.current_task
+            or self.queued
+            or self._sending_feedback
+            or self._creating_report
+            or self.session.planner_history.folding
+        )
+
+    # Commands of the page. They return immediately, the worker's loop carries them out.
+
+    def submit(self, mission: str, settings: ExecutorSettings):
+        self._start()
+        self.queued.append(mission)
+        self._call(self._jobs.put_nowait, (mission, settings))
+
+    def cancel(self):
+        """Stop the running task, the worker then waits for its feedback."""
+        if self._loop:
+            self._call(self._cancel_task)
+
+    def pause(self):
+        """Hold the running task before its next step."""
+        self.paused = True
+        if self._loop:
+            self._call(self._running.clear)
+
+    def resume(self):
+        self.paused = False
+        if self._loop:
+            self._call(self._running.set)
+
+    def give_feedback(self, feedback: dict[str, str]):
+        self._start()
+        self._sending_feedback = True
+        self._call(self._receive_feedback, feedback)
+
+    def create_report(self, output_dir: str, file_name: str):
+        """Generate the SUS answers and write the report of the session."""
+        self._start()
+        self._creating_report = True
+        self._call(self._start_report, output_dir, file_name)
+
+    def shutdown(self):
+        """Stop the running task and the worker's loop, e.g. when the page is reset."""
+        self._shutting_down = True
+        if self._loop:
+            self._call(self._main_task.cancel)
+
+    # Function will return the events since the last call, oldest first
+    def drain(self) -> list[WorkerEvent]:
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    # The rest runs in the worker's thread
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="agent-worker", daemon=True
+            )
+            self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        try:
+            asyncio.run(self._main())
+        except asyncio.CancelledError:
+            logger.info("The agent worker was shut down")
+
+    def _call(self, callback, *args):
+        assert self._loop
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def _emit(self, kind: EventKind, **fields):
+        self.events.put(WorkerEvent(kind, **fields))
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._main_task = asyncio.current_task()
+        self._jobs: asyncio.Queue[tuple[str, ExecutorSettings]] = asyncio.Queue()
+        self._running = asyncio.Event()
+        if not self.paused:
+            self._running.set()
+        self._task: asyncio.Task | None = None
+        self._feedbacks: asyncio.Queue[dict[str, str]] = asyncio.Queue()
+        # held while a task, the feedback or the report uses the session
+        self._session_lock = asyncio.Lock()
+        self._started.set()
+        while True:
+            mission, settings = await self._jobs.get()
+            async with self._session_lock:
+                self.queued.remove(mission)
+                await self._run_task(mission, settings)
+            # the next task starts after the user gave feedback on this one
+            self.awaiting_feedback = True
+            feedback = await self._feedbacks.get()
+            self.awaiting_feedback = False
+            await self._send_feedback(feedback)
+
+    async def _run_task(self, mission: str, settings: ExecutorSettings):
+        session = self.session
+        session.messages.append(
+            {
+                "role": Sender.USER,
+                "content": [BetaTextBlockParam(type="text", text=mission)],
+            }
+        )
+        session.data_handler.new_task(mission)
+        self.current_task = mission
+        self._emit(EventKind.TASK_STARTED, text=mission)
+        self._task = asyncio.create_task(
+            custom_loop(
+                session=session,
+                mission=mission,
+                settings=settings,
+                context=None,
+                render_message=self._render_message,
+                output_callback=self._output_callback,
+                tool_output_callback=self._tool_output_callback,
+                api_response_callback=self._api_response_callback,
+                checkpoint=self._running.wait,
+            )
+        )
+        cancelled = False
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            if self._shutting_down:
+                raise
+            cancelled = True
+        except Exception as e:
+            logger.exception("The task failed: %s", e)
+            self._emit(EventKind.ERROR, error=e)
+        finally:
+            self._task = None
+            self.current_task = None
+        self._emit(EventKind.TASK_FINISHED, text=mission, cancelled=cancelled)
+
+    def _cancel_task(self):
+        if self._task:
+            self._task.cancel()
+
+    def _receive_feedback(self, feedback: dict[str, str]):
+        # the feedback can arrive before the stopped task has finished
+        if self._task or self.awaiting_feedback:
+            self._feedbacks.put_nowait(feedback)
+        else:
+            # feedback without a task, e.g. "Early Stop" before the first task
+            self._feedback_task = asyncio.create_task(self._send_feedback(feedback))
+
+    async def _send_feedback(self, feedback: dict[str, str]):
+        async with self._session_lock:
+            await self._give_feedback(feedback)
+        self._emit(EventKind.FEEDBACK_SENT)
+
+    async def _give_feedback(self, feedback: dict[str, str]):
+        session = self.session
+        try:
+            message = await oai.give_feedback(
+                session, feedback, self._render_message, None
+            )
+            session.data_handler.new_feedback(feedback)
+            session.messages.append(
+                {
+                    "role": Sender.FEEDBACK,
+                    "content": [{"type": "text", "text": message}],
+                }
+            )
+            session.data_handler.reset_task_interactions()
+        except Exception as e:
+            logger.exception("The feedback could not be sent: %s", e)
+            self._emit(EventKind.ERROR, error=e)
+        finally:
+            self._sending_feedback = False
+
+    def _start_report(self, output_dir: str, file_name: str):
+        self._report_task = asyncio.create_task(
+            self._create_report(output_dir, file_name)
+        )
+
+    async def _create_report(self, output_dir: str, file_name: str):
+        session = self.session
+        try:
+            async with self._session_lock:
+                await oai.generate_sus_answers(session)
+                # the summary in the report is complete once the last fold is done
+                await session.planner_history.wait_for_fold()
+                # the SUS answers are already generated, the report doesn't ask again.
+                # The lock keeps the next task away while the PDF is written.
+                await asyncio.to_thread(create_report, session, output_dir, file_name)
+        except Exception as e:
+            logger.exception("The report could not be created: %s", e)
+            self._emit(EventKind.ERROR, error=e)
+        finally:
+            self._creating_report = False
+        self._emit(EventKind.REPORT_CREATED, text=f"{output_dir}/{file_name}.pdf")
+
+    def _render_message(self, message, sender: Sender, container=None):
+        if isinstance(message, dict):
+            message = message.get("text", "")
+        if message:
+            self._emit(EventKind.MESSAGE, text=str(message), sender=sender)
+
+    def _output_callback(self, block: BetaContentBlockParam):
+        self._emit(EventKind.STEP)
+
+    def _tool_output_callback(self, tool_output: ToolResult, tool_id: str):
+        # stored before the tool result is added to the chat history, which refers to it
+        self.tools[tool_id] = tool_output
+        if tool_output.settle_time is not None:
+            self.session.data_handler.add_settle_time(tool_output.settle_time)
+        self._emit(EventKind.STEP)
+
+    def _api_response_callback(
+        self,
+        request: httpx.Request,
+        response: httpx.Response | object | None,
+        error: Exception | None,
+    ):
+        self.responses[datetime.now().isoformat()] = (request, response)
+        if error:
+            self._emit(EventKind.ERROR, error=error)
@@ -29,7 +29,12 @@ echo "HOST_STREAMLIT_PORT: $HOST_STREAMLIT_PORT"
 
 envsubst < /home/computeruse/static_content/index.template.html > /home/computeruse/static_content/index.html
 
-./start_all.sh
+if [ "${DISPLAY_POOL_SIZE:-1}" -gt 1 ]; then
+    # several desktops with their own Firefox, noVNC shows the first one
+    ./start_pool.sh
+else
+    ./start_all.sh
+fi
 ./novnc_startup.sh
 
 # Start http_server in the background and log output
@@ -57,7 +62,10 @@ echo "➡️  Open http://localhost:8080 in your browser to begin"
 
 export DISPLAY=:$DISPLAY_NUM
 # Check if WEBSITE_URL is set and not empty
-if [ -n "$WEBSITE_URL" ]; then
+if [ "${DISPLAY_POOL_SIZE:-1}" -gt 1 ]; then
+    # every pool display already runs its own Firefox
+    :
+elif [ -n "$WEBSITE_URL" ]; then
     # If WEBSITE_URL is set, open it in a new tab along with about:preferences
     firefox-esr --new-tab "$WEBSITE_URL" --new-tab about:preferences --remote-debugging-port=9222 --no-remote
 else
@@ -0,0 +1,41 @@
+#!/bin/bash
+# Starts DISPLAY_POOL_SIZE virtual desktops in this container, one Xvfb display with its
+# own Firefox each. Display i (counting from 0) is :$((DISPLAY_NUM + i)), its Firefox
+# listens for remote debugging on $((FIREFOX_DEBUGGING_PORT + i)) with the profile
+# $FIREFOX_PROFILE_DIR/display-<display> and its VNC server on $((5900 + i)).
+# computer_use_demo/models/display_pool.py derives the same slots from these variables.
+set -e
+
+DISPLAY_POOL_SIZE=${DISPLAY_POOL_SIZE:-1}
+FIRST_DISPLAY=${DISPLAY_NUM:-1}
+FIREFOX_DEBUGGING_PORT=${FIREFOX_DEBUGGING_PORT:-9222}
+FIREFOX_PROFILE_DIR=${FIREFOX_PROFILE_DIR:-/tmp/firefox-profiles}
+
+for ((i = 0; i < DISPLAY_POOL_SIZE; i++)); do
+    export DISPLAY_NUM=$((FIRST_DISPLAY + i))
+    export DISPLAY=:${DISPLAY_NUM}
+    echo "starting pool display $DISPLAY"
+
+    ./xvfb_startup.sh
+    ./tint2_startup.sh
+    ./mutter_startup.sh
+
+    (x11vnc -display $DISPLAY -forever -shared -wait 50 -rfbport $((5900 + i)) -nopw \
+        2>/tmp/x11vnc_stderr_${DISPLAY_NUM}.log) &
+
+    profile="$FIREFOX_PROFILE_DIR/display-$DISPLAY_NUM"
+    mkdir -p "$profile"
+    if [ -n "$WEBSITE_URL" ]; then
+        firefox-esr --profile "$profile" --new-tab "$WEBSITE_URL" \
+            --remote-debugging-port=$((FIREFOX_DEBUGGING_PORT + i)) --no-remote \
+            >/tmp/firefox_${DISPLAY_NUM}.log 2>&1 &
+    else
+        firefox-esr --profile "$profile" --new-tab about:blank \
+            --remote-debugging-port=$((FIREFOX_DEBUGGING_PORT + i)) --no-remote \
+            >/tmp/firefox_${DISPLAY_NUM}.log 2>&1 &
+    fi
+done
+
+export DISPLAY_NUM=$FIRST_DISPLAY
+export DISPLAY=:${DISPLAY_NUM}
+echo "started $DISPLAY_POOL_SIZE pool displays from :$FIRST_DISPLAY"
@@ -0,0 +1,3 @@
+# the app imports its modules both as computer_use_demo.* and as top-level modules (tools,
+# models), importing the package puts the app directory on sys.path for the latter
+import computer_use_demo  # noqa: F401
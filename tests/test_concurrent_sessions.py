@@ -0,0 +1,132 @@
+"""
+Runs several mocked executor sessions on one event loop and checks that they overlap,
+i.e. that nothing in the executor path blocks the event loop. The Anthropic API is
+replaced by a mock transport that answers after API_LATENCY seconds with a screenshot tool
+call, and the computer tool by one that takes TOOL_LATENCY seconds, so no display or API
+key is needed.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+
+import httpx
+import pytest
+from anthropic.types.beta import BetaMessageParam, BetaToolComputerUse20241022Param
+from tools import ToolCollection, ToolResult
+from tools.base import BaseAnthropicTool
+
+from computer_use_demo.anthropic_access import AnthropicExecutor, APIProvider
+from computer_use_demo.models.rate_limiter import RateLimiter
+
+SESSIONS = 4
+STEPS = 3
+API_LATENCY = 0.2
+TOOL_LATENCY = 0.05
+
+logger = logging.getLogger(__name__)
+
+tool_ids = itertools.count()
+
+
+class MockComputerTool(BaseAnthropicTool):
+    """Takes as long as a real action, without a display."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def __call__(self, **kwargs) -> ToolResult:
+        await asyncio.sleep(self.latency)
+        return ToolResult(output=f"did {kwargs.get('action')}")
+
+    def to_params(self) -> BetaToolComputerUse20241022Param:
+        return {
+            "name": "computer",
+            "type": "computer_20241022",
+            "display_width_px": 1024,
+            "display_height_px": 768,
+        }
+
+
+def mock_api(latency: float) -> httpx.MockTransport:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        return httpx.Response(
+            200,
+            json={
+                "id": "msg_mock",
+                "type": "message",
+                "role": "assistant",
+                "model": "mock",
+                "content": [
+                    {
+                        "type": "tool_use",
+                        "id": f"toolu_{next(tool_ids)}",
+                        "name": "computer",
+                        "input": {"action": "screenshot"},
+                    }
+                ],
+                "stop_reason": "tool_use",
+                "stop_sequence": None,
+                "usage": {"input_tokens": 100, "output_tokens": 10},
+            },
+        )
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(monkeypatch, tmp_path):
+    # don't touch the shared rate limits of real sessions, and don't throttle the mock
+    monkeypatch.setenv("RATE_LIMIT_DIR", str(tmp_path))
+    monkeypatch.setenv("ANTHROPIC_REQUESTS_PER_MINUTE", "100000")
+    monkeypatch.setenv("ANTHROPIC_TOKENS_PER_MINUTE", "100000000")
+    monkeypatch.setattr(
+        "computer_use_demo.anthropic_access.rate_limiter", RateLimiter()
+    )
+
+
+async def run_session(executor: AnthropicExecutor) -> tuple[float, float]:
+    tool_collection = ToolCollection(MockComputerTool(TOOL_LATENCY))
+    messages: list[BetaMessageParam] = []
+    errors: list[Exception | None] = []
+    start = time.perf_counter()
+    for step in range(STEPS):
+        prepped_messages: list[BetaMessageParam] = [
+            {"role": "user", "content": f"Instruction {step}: take a screenshot"}
+        ]
+        await executor.sampling_loop(
+            model="mock",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=messages,
+            prepped_messages=prepped_messages,
+            output_callback=lambda block: None,
+            tool_output_callback=lambda result, tool_id: None,
+            api_response_callback=lambda request, response, error: errors.append(error),
+            api_key="mock",
+            tool_collection=tool_collection,
+        )
+    assert errors == []
+    return start, time.perf_counter()
+
+
+async def test_sessions_dont_block_each_other():
+    executor = AnthropicExecutor(transport=mock_api(API_LATENCY))
+    start = time.perf_counter()
+    intervals = await asyncio.gather(*(run_session(executor) for _ in range(SESSIONS)))
+    wall = time.perf_counter() - start
+
+    durations = [end - begin for begin, end in intervals]
+    sequential = STEPS * (API_LATENCY + TOOL_LATENCY)
+    logger.info(
+        "wall clock %.2fs, one session alone ~%.2fs, concurrency %.2f (ideal %d)",
+        wall,
+        sequential,
+        sum(durations) / wall,
+        SESSIONS,
+    )
+    # every session started before any of them finished
+    assert max(begin for begin, _ in intervals) < min(end for _, end in intervals)
+    assert wall < 1.5 * sequential
@@ -0,0 +1,89 @@
+from computer_use_demo.models.history import SUMMARY_PREFIX, PlannerHistory
+
+
+def user_message(text: str, image: bool = False) -> dict:
+    content = [{"type": "text", "text": text}]
+    if image:
+        content.append({"type": "image_ref", "image_id": f"image-{text}"})
+    return {"role": "user", "content": content}
+
+
+def texts(messages: list[dict]) -> list[str]:
+    return [
+        message["content"]
+        if isinstance(message["content"], str)
+        else message["content"][0]["text"]
+        for message in messages
+    ]
+
+
+async def summarize(summary: str, turns: list[dict]) -> str:
+    return " ".join([summary, *texts(turns)]).strip()
+
+
+def test_only_the_recent_screenshots_are_kept():
+    history = PlannerHistory(window=10, image_window=2, fold_batch=2)
+    for i in range(4):
+        history.append(user_message(str(i), image=True))
+    images = [len(message["content"]) - 1 for message in history]
+    assert images == [0, 0, 1, 1]
+
+
+async def test_turns_that_leave_the_window_are_folded_into_the_summary():
+    history = PlannerHistory(window=2, image_window=2, fold_batch=2)
+    history.append({"role": "system", "content": "rules"})
+    for i in range(4):
+        history.append(user_message(str(i)))
+    history.compact(summarize)
+    assert history.folding
+    request = await history.request_messages(summarize)
+    assert texts(request) == ["rules", f"{SUMMARY_PREFIX}0 1", "2", "3"]
+    assert history.stats() == {
+        "Messages": 5,
+        "Window": 2,
+        "Folds": 1,
+        "Summary Characters": 3,
+    }
+
+
+async def test_window_isnt_folded_before_a_full_batch():
+    history = PlannerHistory(window=2, image_window=2, fold_batch=2)
+    for i in range(3):
+        history.append(user_message(str(i)))
+    history.compact(summarize)
+    assert not history.folding
+    assert texts(await history.request_messages(summarize)) == ["0", "1", "2"]
+
+
+async def test_turns_stay_in_the_window_if_the_summary_fails():
+    async def failing_summarize(summary: str, turns: list[dict]) -> str:
+        raise RuntimeError("no summary")
+
+    history = PlannerHistory(window=2, image_window=2, fold_batch=2)
+    for i in range(4):
+        history.append(user_message(str(i)))
+    history.compact(failing_summarize)
+    request = await history.request_messages(failing_summarize)
+    assert texts(request) == ["0", "1", "2", "3"]
+    assert history.folds == 0
+
+
+async def test_request_over_the_token_budget_is_folded_right_away():
+    history = PlannerHistory(window=10, image_window=2, fold_batch=10, token_budget=30)
+    for i in range(4):
+        history.append(user_message(str(i) * 40))  # 10 tokens each
+    request = await history.request_messages(summarize)
+    assert texts(request)[-2:] == ["2" * 40, "3" * 40]
+    assert request[0]["content"].startswith(SUMMARY_PREFIX)
+    assert history.folds == 1
+
+
+async def test_pop_removes_the_last_message():
+    history = PlannerHistory(window=10, image_window=2, fold_batch=2)
+    history.append(user_message("0", image=True))
+    history.append(user_message("1", image=True))
+    assert texts([history.pop()]) == ["1"]
+    history.append(user_message("2", image=True))
+    history.append(user_message("3", image=True))
+    # the popped message doesn't count towards the image window
+    assert [len(message["content"]) - 1 for message in history] == [0, 1, 1]
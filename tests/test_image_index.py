@@ -0,0 +1,61 @@
+from computer_use_demo.models.image_index import ImageIndex
+
+
+def tool_result(step: int, images: int = 1) -> dict:
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "tool_result",
+                "tool_use_id": f"toolu_{step}",
+                "content": [{"type": "text", "text": f"step {step}"}]
+                + [{"type": "image", "source": {"data": str(step)}}] * images,
+            }
+        ],
+    }
+
+
+def images(messages: list[dict]) -> list[str]:
+    return [
+        part["source"]["data"]
+        for message in messages
+        for block in message["content"]
+        if block["type"] == "tool_result"
+        for part in block["content"]
+        if part["type"] == "image"
+    ]
+
+
+def test_prune_keeps_the_most_recent_images():
+    messages = [tool_result(step) for step in range(5)]
+    ImageIndex().prune(messages, images_to_keep=2, min_removal_threshold=1)
+    assert images(messages) == ["3", "4"]
+    # the text of the pruned results is kept
+    assert messages[0]["content"][0]["content"] == [{"type": "text", "text": "step 0"}]
+
+
+def test_prune_removes_images_in_chunks():
+    messages = [tool_result(step) for step in range(5)]
+    ImageIndex().prune(messages, images_to_keep=1, min_removal_threshold=3)
+    assert images(messages) == ["3", "4"]
+
+
+def test_only_new_messages_are_scanned():
+    index = ImageIndex()
+    messages = [tool_result(step) for step in range(3)]
+    index.prune(messages, images_to_keep=2, min_removal_threshold=1)
+    assert (index.scanned, index.total) == (3, 2)
+    messages.append(
+        {"role": "assistant", "content": [{"type": "text", "text": "next step"}]}
+    )
+    messages.append(tool_result(3, images=2))
+    index.prune(messages, images_to_keep=2, min_removal_threshold=1)
+    assert (index.scanned, index.total) == (5, 2)
+    assert images(messages) == ["3", "3"]
+
+
+def test_index_is_rebuilt_when_the_history_is_reset():
+    index = ImageIndex()
+    index.update([tool_result(step) for step in range(3)])
+    index.update([tool_result(0, images=2)])
+    assert (index.scanned, index.total) == (1, 2)
@@ -0,0 +1,101 @@
+import pytest
+
+from computer_use_demo.models.instruction_compiler import (
+    DEFAULT_WAIT_SECONDS,
+    MAX_WAIT_SECONDS,
+    compile_instruction,
+)
+
+
+@pytest.mark.parametrize(
+    "instruction, key",
+    [
+        ("Scroll down", "Page_Down"),
+        ("Scroll up a bit.", "Page_Up"),
+        ("scroll down the page to see more products", "Page_Down"),
+        ("Scroll to the bottom of the page", "End"),
+        ("Scroll to the top", "Home"),
+        ("Scroll down -> [To see the rest of the products]", "Page_Down"),
+    ],
+)
+def test_scroll(instruction, key):
+    compiled = compile_instruction(instruction)
+    assert compiled is not None
+    assert compiled.actions == [{"action": "key", "text": key}]
+
+
+@pytest.mark.parametrize(
+    "instruction, key",
+    [
+        ("Press Enter", "Return"),
+        ("Press the Enter key", "Return"),
+        ("press 'Escape'", "Escape"),
+        ("Press the down arrow key", "Down"),
+        ("Press Page Down", "Page_Down"),
+        ("Press F5", "F5"),
+        ("Press 'ctrl + a'", "ctrl+a"),
+        ("Press Ctrl+Shift+T", "ctrl+shift+t"),
+        ("Press Enter -> [Press the Enter key to start the search]", "Return"),
+    ],
+)
+def test_press(instruction, key):
+    compiled = compile_instruction(instruction)
+    assert compiled is not None
+    assert compiled.actions == [{"action": "key", "text": key}]
+
+
+@pytest.mark.parametrize(
+    "instruction, text",
+    [
+        ('Type "Hello World"', "Hello World"),
+        ("Type 'john.doe@example.com'", "john.doe@example.com"),
+        ("Type “Berlin”", "Berlin"),
+    ],
+)
+def test_type(instruction, text):
+    compiled = compile_instruction(instruction)
+    assert compiled is not None
+    assert compiled.actions == [{"action": "type", "text": text}]
+
+
+@pytest.mark.parametrize(
+    "instruction, seconds",
+    [
+        ("Wait", DEFAULT_WAIT_SECONDS),
+        ("Wait 3 seconds", 3.0),
+        ("Wait for 1.5s until the page has loaded", 1.5),
+        ("Wait until the search results appear", DEFAULT_WAIT_SECONDS),
+        ("Wait 60 seconds", MAX_WAIT_SECONDS),
+        ("Wait for the page -> [the results list below the header]", 2.0),
+    ],
+)
+def test_wait(instruction, seconds):
+    compiled = compile_instruction(instruction)
+    assert compiled is not None
+    assert compiled.wait == seconds
+    assert compiled.actions == []
+
+
+@pytest.mark.parametrize(
+    "instruction",
+    [
+        # refer to an element on the screen
+        "Click on 'Sign Up'",
+        "Hover over the 'Products' menu",
+        "Press the 'Submit' button",
+        "Type 'a' into the 'b' field",
+        'Type "Berlin" -> [the search field below the header]',
+        "Scroll down in the dropdown",
+        "Scroll down inside the list of countries",
+        "Press Enter -> [the button in the sign up form]",
+        # not a key, text or amount of time
+        "Press the purple key",
+        "Type Berlin",
+        'Type ""',
+        "Scroll sideways",
+        "Wait a moment",
+        "",
+    ],
+)
+def test_needs_the_llm(instruction):
+    assert compile_instruction(instruction) is None
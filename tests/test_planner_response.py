@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from computer_use_demo.models.planner_response import (
+    PlannerResponseError,
+    complete_field,
+    parse_response,
+)
+
+RESPONSE = {
+    "chain_of_thought": "The sign up form is open [see the header].",
+    "instruction": " Click on 'Sign Up' ",
+    "additional_info": "The button is in the top right corner",
+    "self_reflection": "",
+    "usability_notes": "The button is hard to find",
+    "flag": "",
+}
+
+
+def test_parse_response():
+    parts = parse_response(json.dumps(RESPONSE))
+    assert parts == {
+        "instruction": "Click on 'Sign Up'",
+        "additional_info": "The button is in the top right corner",
+        "self_reflection": "",
+        "usability_notes": "The button is hard to find",
+        "flag": "",
+    }
+
+
+def test_response_that_is_no_json():
+    with pytest.raises(PlannerResponseError, match="no JSON"):
+        parse_response("<Click on 'Sign Up'>")
+
+
+def test_response_that_doesnt_match_the_schema():
+    response = {key: value for key, value in RESPONSE.items() if key != "flag"}
+    with pytest.raises(PlannerResponseError, match="schema"):
+        parse_response(json.dumps(response))
+
+
+def test_complete_field_of_a_streamed_response():
+    text = json.dumps(RESPONSE)
+    # the instruction is complete before the object is closed
+    partial = text[: text.index('"additional_info"') + 25]
+    assert complete_field(partial, "instruction") == "Click on 'Sign Up'"
+    assert complete_field(partial, "additional_info") is None
+
+
+def test_complete_field_with_escaped_quotes():
+    text = '{"chain_of_thought": "", "instruction": "Click on \\"Sign Up\\""'
+    assert complete_field(text, "instruction") == 'Click on "Sign Up"'
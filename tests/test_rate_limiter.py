@@ -0,0 +1,148 @@
+import pytest
+
+from computer_use_demo.models.rate_limiter import (
+    IMAGE_TOKENS,
+    RateLimit,
+    RateLimiter,
+    _parse_duration,
+    default_limit,
+    estimate_tokens,
+)
+
+
+@pytest.fixture
+def limiter(tmp_path) -> RateLimiter:
+    return RateLimiter(path=str(tmp_path / "rate_limits.sqlite"))
+
+
+@pytest.fixture
+def clock(monkeypatch) -> list[float]:
+    # the buckets are refilled by the wall clock time since their last update
+    now = [1_000_000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+    return now
+
+
+def test_requests_and_tokens_are_taken_from_the_buckets(limiter, clock):
+    limit = RateLimit(requests_per_minute=60, tokens_per_minute=1000)
+    assert limiter._try_acquire("openai:m", limit, 100) == 0.0
+    # 900 tokens left, the missing 50 refill at 1000 per minute
+    assert limiter._try_acquire("openai:m", limit, 950) == pytest.approx(3.0)
+    assert limiter._try_acquire("openai:m", limit, 900) == 0.0
+
+
+def test_waits_for_the_next_request(limiter, clock):
+    limit = RateLimit(requests_per_minute=2, tokens_per_minute=1_000_000)
+    assert limiter._try_acquire("openai:m", limit, 1) == 0.0
+    assert limiter._try_acquire("openai:m", limit, 1) == 0.0
+    assert limiter._try_acquire("openai:m", limit, 1) == pytest.approx(30.0)
+
+
+def test_buckets_refill_over_time(limiter, clock):
+    limit = RateLimit(requests_per_minute=60, tokens_per_minute=1000)
+    assert limiter._try_acquire("openai:m", limit, 1000) == 0.0
+    clock[0] += 30
+    # half a minute refilled half of the tokens
+    assert limiter._try_acquire("openai:m", limit, 500) == 0.0
+    assert limiter._try_acquire("openai:m", limit, 60) == pytest.approx(3.6)
+
+
+def test_buckets_dont_refill_beyond_the_limit(limiter, clock):
+    limit = RateLimit(requests_per_minute=60, tokens_per_minute=1000)
+    assert limiter._try_acquire("openai:m", limit, 1) == 0.0
+    clock[0] += 3600
+    assert limiter._try_acquire("openai:m", limit, 999) == 0.0
+    assert limiter._try_acquire("openai:m", limit, 60) > 0.0
+
+
+def test_request_larger_than_the_bucket_waits_for_a_full_bucket(limiter, clock):
+    limit = RateLimit(requests_per_minute=60, tokens_per_minute=1000)
+    assert limiter._try_acquire("openai:m", limit, 5000) == 0.0
+    assert limiter._try_acquire("openai:m", limit, 5000) == pytest.approx(60.0)
+
+
+def test_buckets_are_shared_through_the_database(tmp_path, clock):
+    path = str(tmp_path / "rate_limits.sqlite")
+    limit = RateLimit(requests_per_minute=1, tokens_per_minute=1000)
+    assert RateLimiter(path)._try_acquire("openai:m", limit, 1) == 0.0
+    assert RateLimiter(path)._try_acquire("openai:m", limit, 1) == pytest.approx(60.0)
+
+
+async def test_retry_after_blocks_the_bucket(limiter, clock):
+    await limiter.update_from_headers("anthropic", "m", {"retry-after": "20"})
+    assert limiter._try_acquire(
+        "anthropic:m", default_limit("anthropic"), 1
+    ) == pytest.approx(20.0)
+
+
+async def test_headers_correct_the_limits(limiter, clock):
+    await limiter.update_from_headers(
+        "openai",
+        "m",
+        {
+            "x-ratelimit-limit-requests": "10",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "6s",
+        },
+    )
+    limit = default_limit("openai")
+    assert limiter._try_acquire("openai:m", limit, 1) == pytest.approx(6.0)
+    clock[0] += 6
+    # 10 requests per minute refill one request in 6 seconds
+    assert limiter._try_acquire("openai:m", limit, 1) == 0.0
+    assert limiter._try_acquire("openai:m", limit, 1) == pytest.approx(6.0)
+
+
+async def test_headers_without_rate_limits_change_nothing(limiter, clock):
+    await limiter.update_from_headers("openai", "m", {"content-type": "text/plain"})
+    assert not limiter._created
+
+
+async def test_acquire_keeps_running_totals_of_the_queue_wait(limiter):
+    limit = RateLimit(requests_per_minute=60, tokens_per_minute=1000)
+    for _ in range(3):
+        await limiter.acquire("openai", "m", 10, limit)
+    stats = limiter.stats()["openai:m"]
+    assert stats["Requests"] == 3
+    assert stats["Max Wait (s)"] <= stats["Total Wait (s)"]
+
+
+def test_default_limits_can_be_configured(monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_REQUESTS_PER_MINUTE", "5")
+    assert default_limit("anthropic").requests_per_minute == 5.0
+    assert default_limit("anthropic").tokens_per_minute == 40_000.0
+
+
+@pytest.mark.parametrize(
+    "value, seconds",
+    [("20ms", 0.02), ("1s", 1.0), ("6m0s", 360.0), ("1h2m", 3720.0), ("1.5s", 1.5)],
+)
+def test_parse_duration(value, seconds):
+    assert _parse_duration(value) == pytest.approx(seconds)
+
+
+def test_parse_duration_without_a_duration():
+    assert _parse_duration("soon") is None
+
+
+def test_estimate_tokens():
+    messages = [
+        {"role": "system", "content": "a" * 40},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "b" * 80},
+                {"type": "image_url", "image_url": {"url": "data:..."}},
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "content": [{"type": "image", "source": {}}],
+                }
+            ],
+        },
+    ]
+    assert estimate_tokens(messages, max_tokens=100) == 10 + 20 + 2 * IMAGE_TOKENS + 100
@@ -0,0 +1,115 @@
+import time
+from email.utils import formatdate
+
+import anthropic
+import httpx
+import openai
+import pytest
+
+from computer_use_demo.models.retry import RetryPolicy, is_retryable, retry_after
+
+REQUEST = httpx.Request("POST", "https://api.example.com/v1/messages")
+
+
+def status_error(status_code: int, headers: dict[str, str] | None = None):
+    response = httpx.Response(status_code, headers=headers, request=REQUEST)
+    return anthropic.APIStatusError("error", response=response, body=None)
+
+
+class FailingCall:
+    """Raises the given errors one after another, then returns "done"."""
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+@pytest.fixture
+def policy() -> RetryPolicy:
+    # no backoff, the tests don't wait
+    return RetryPolicy("test", max_attempts=3, base_delay=0.0)
+
+
+async def test_transient_errors_are_retried(policy):
+    call = FailingCall(httpx.ConnectError("reset"), status_error(529))
+    assert await policy.run(call) == "done"
+    assert call.calls == 3
+
+
+async def test_other_errors_are_raised_at_once(policy):
+    call = FailingCall(status_error(400))
+    with pytest.raises(anthropic.APIStatusError):
+        await policy.run(call)
+    assert call.calls == 1
+
+
+async def test_gives_up_after_the_last_attempt(policy):
+    call = FailingCall(*(status_error(503) for _ in range(3)))
+    with pytest.raises(anthropic.APIStatusError):
+        await policy.run(call)
+    assert call.calls == 3
+
+
+async def test_doesnt_wait_beyond_the_deadline(policy):
+    call = FailingCall(status_error(429, {"retry-after": "30"}))
+    start = time.monotonic()
+    with pytest.raises(anthropic.APIStatusError):
+        await policy.run(call, deadline=time.monotonic() + 1)
+    assert call.calls == 1
+    assert time.monotonic() - start < 1
+
+
+def test_backoff_stays_below_the_maximum_delay():
+    policy = RetryPolicy("test", base_delay=1.0, max_delay=5.0)
+    for attempt in range(10):
+        assert 0.0 <= policy.backoff(attempt) <= min(5.0, 2**attempt)
+
+
+def test_policy_from_env(monkeypatch):
+    monkeypatch.setenv("OPENAI_RETRY_ATTEMPTS", "2")
+    monkeypatch.setenv("OPENAI_RETRY_DEADLINE", "10")
+    policy = RetryPolicy.from_env("openai")
+    assert (policy.max_attempts, policy.deadline) == (2, 10.0)
+    assert policy.base_delay == RetryPolicy.base_delay
+
+
+@pytest.mark.parametrize(
+    "error, retryable",
+    [
+        (httpx.ReadTimeout("timeout"), True),
+        (anthropic.APIConnectionError(request=REQUEST), True),
+        (openai.APITimeoutError(request=REQUEST), True),
+        (status_error(429), True),
+        (status_error(529), True),
+        (status_error(401), False),
+        (ValueError("bug"), False),
+    ],
+)
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) == retryable
+
+
+def test_retry_after_in_milliseconds():
+    assert retry_after(status_error(429, {"retry-after-ms": "1500"})) == 1.5
+
+
+def test_retry_after_in_seconds():
+    assert retry_after(status_error(429, {"retry-after": "3"})) == 3.0
+
+
+def test_retry_after_as_a_date():
+    date = formatdate(time.time() + 60, usegmt=True)
+    assert retry_after(status_error(429, {"retry-after": date})) == pytest.approx(
+        60, abs=2
+    )
+
+
+def test_retry_after_without_a_response():
+    assert retry_after(httpx.ConnectError("reset")) is None
+    assert retry_after(status_error(429)) is None
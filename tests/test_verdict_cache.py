@@ -0,0 +1,52 @@
+import threading
+
+from computer_use_demo.models.oai_rule import OaiRule
+from computer_use_demo.models.verdict_cache import VerdictCache, normalize_instruction
+
+
+def test_normalize_instruction():
+    assert normalize_instruction("Instruction: Click on 'Sign Up'.") == (
+        "click on sign up"
+    )
+    assert normalize_instruction("  click ON   sign-up ") == "click on sign up"
+
+
+def test_verdict_is_reused_for_the_same_screenshot():
+    cache = VerdictCache()
+    cache.put("image-1", "Instruction: Click on 'Sign Up'", OaiRule.BROKEN)
+    assert cache.get("image-1", "click on Sign Up") == OaiRule.BROKEN
+    assert cache.get("image-2", "click on Sign Up") is None
+    assert cache.get("image-1", "Click on 'Log In'") is None
+
+
+def test_verdicts_expire():
+    cache = VerdictCache(ttl=-1)
+    cache.put("image-1", "Scroll down", OaiRule.OK)
+    assert cache.get("image-1", "Scroll down") is None
+
+
+def test_least_recently_used_verdict_is_evicted():
+    cache = VerdictCache(max_items=2)
+    cache.put("image-1", "a", OaiRule.OK)
+    cache.put("image-2", "b", OaiRule.OK)
+    cache.get("image-1", "a")
+    cache.put("image-3", "c", OaiRule.OK)
+    assert cache.get("image-1", "a") == OaiRule.OK
+    assert cache.get("image-2", "b") is None
+    assert cache.get("image-3", "c") == OaiRule.OK
+
+
+def test_cache_can_be_used_from_several_threads():
+    cache = VerdictCache(max_items=50)
+
+    def work(thread: int):
+        for i in range(500):
+            cache.put(f"image-{thread}-{i}", "a", OaiRule.OK)
+            cache.get(f"image-{thread}-{i - 1}", "a")
+
+    threads = [threading.Thread(target=work, args=(t,)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(cache._verdicts) == 50